@@ -1 +1,6 @@
-from .network import NetworkManager
+def __getattr__(name):
+    # NetworkManager pulls in flask and zeroconf, so only import it when it's used
+    if name == "NetworkManager":
+        from .network import NetworkManager
+        return NetworkManager
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import logging
+
+from .metrics import registry
+
+logger = logging.getLogger('pychat')
+
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+CACHE_HITS = registry.counter('pychat_decrypt_cache_hits_total', 'Decryptions answered from the cache')
+CACHE_MISSES = registry.counter('pychat_decrypt_cache_misses_total', 'Decryptions that missed the cache')
+CACHE_EVICTIONS = registry.counter('pychat_decrypt_cache_evictions_total', 'Entries evicted from the decrypt cache')
+CACHE_ENTRIES = registry.gauge('pychat_decrypt_cache_entries', 'Entries held by the decrypt cache')
+CACHE_BYTES = registry.gauge('pychat_decrypt_cache_bytes', 'Plaintext bytes held by the decrypt cache')
+
+# Stored for records the key can't decrypt, so they aren't retried either
+UNDECRYPTABLE = None
+
+
+def key_fingerprint(private_key):
+    """Short, non-reversible ID of a private key, so entries for different keys never mix."""
+    return hashlib.sha256(private_key).hexdigest()[:32]
+
+
+def _zeroize(buf):
+    if buf is not None:
+        buf[:] = bytes(len(buf))
+
+
+class DecryptCache:
+    """Bounded LRU cache of decrypted plaintexts, keyed by record ID and key fingerprint.
+
+    Plaintexts are held as bytearrays and overwritten with zeros when they are
+    evicted or cleared. (The str handed back by get() is a copy Python can't
+    scrub; this only bounds how long the cache itself keeps plaintext around.)
+    Nothing is written to disk: chat keys are made fresh every session, so
+    saved entries could never be looked up again, and keeping plaintexts
+    would outlive the keys meant to make them unrecoverable.
+
+    Args:
+        max_entries: Entries kept before the least recently used are evicted
+        max_bytes: Plaintext bytes kept before the least recently used are evicted
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = max_entries > 0
+        self._entries = OrderedDict()  # cache key -> bytearray or UNDECRYPTABLE
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def cache_key(record, private_key):
+        return f"{hashlib.sha256(record).hexdigest()}:{key_fingerprint(private_key)}"
+
+    def get(self, cache_key):
+        """Returns (found, plaintext). `plaintext` is None for records cached as undecryptable."""
+        if not self.enabled:
+            return False, None
+        with self._lock:
+            if cache_key not in self._entries:
+                self.misses += 1
+                CACHE_MISSES.inc()
+                return False, None
+            self._entries.move_to_end(cache_key)
+            value = self._entries[cache_key]
+            self.hits += 1
+        CACHE_HITS.inc()
+        return True, None if value is UNDECRYPTABLE else value.decode('utf-8')
+
+    def put(self, cache_key, plaintext):
+        """Caches the plaintext of a record, or None if it couldn't be decrypted."""
+        if not self.enabled:
+            return
+        value = UNDECRYPTABLE if plaintext is None else bytearray(plaintext.encode('utf-8'))
+        size = 0 if value is None else len(value)
+        if size > self.max_bytes:
+            _zeroize(value)
+            return
+        with self._lock:
+            old = self._entries.pop(cache_key, UNDECRYPTABLE)
+            if old is not UNDECRYPTABLE:
+                self._bytes -= len(old)
+                _zeroize(old)
+            self._entries[cache_key] = value
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                if evicted is not UNDECRYPTABLE:
+                    self._bytes -= len(evicted)
+                    _zeroize(evicted)
+                self.evictions += 1
+                CACHE_EVICTIONS.inc()
+            self._update_gauges()
+
+    def clear(self):
+        """Drops every entry, zeroizing the plaintexts."""
+        with self._lock:
+            for value in self._entries.values():
+                _zeroize(value)
+            self._entries.clear()
+            self._bytes = 0
+            self._update_gauges()
+
+    def _update_gauges(self):
+        CACHE_ENTRIES.set(len(self._entries))
+        CACHE_BYTES.set(self._bytes)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+# Process-wide cache used by decrypt_message, so history views and re-polled records skip the
+# ML-KEM decapsulation. PYCHAT_DECRYPT_CACHE sets the number of entries (0 turns it off).
+decrypt_cache = DecryptCache(max_entries=int(os.environ.get("PYCHAT_DECRYPT_CACHE", str(DEFAULT_MAX_ENTRIES))))
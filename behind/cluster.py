@@ -0,0 +1,306 @@
+"""Multi-process server: a supervisor and N worker processes, with rooms sharded by chat code.
+
+Every worker listens on its own port and hosts the rooms whose chat code
+hashes to it (see discovery.shard_for), each as a regular NetworkManager
+mounted under /rooms/<chat_code>. A room's log, clients and keys therefore
+live in exactly one process, and rooms on different workers never share a
+GIL. The supervisor publishes a single mDNS record listing every worker's
+port, restarts workers that die (rooms come back from their persisted
+session state) and stops them on exit.
+
+    python -m behind.cluster --workers 4
+"""
+import os
+import re
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+import multiprocessing
+
+import logging
+
+from .discovery import shard_for, get_local_ip
+
+logger = logging.getLogger('pychat')
+
+# Chat codes end up in file names, so only simple ones get a room
+CHAT_CODE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# Rooms one worker creates before refusing new ones
+MAX_ROOMS_PER_WORKER = 1000
+# Seconds to wait before restarting a worker that died
+RESTART_DELAY = 1.0
+ROOM_PREFIX = "/rooms/"
+
+
+def _json_response(environ, start_response, payload, status):
+    from werkzeug.wrappers import Response
+    return Response(json.dumps(payload), status=status, mimetype='application/json')(environ, start_response)
+
+
+class RoomRouter:
+    """WSGI app of one worker: sends /rooms/<code>/... to that room's app, creating rooms on first use.
+
+    Rooms with saved session state are reopened when the worker starts (see
+    resume_rooms). Requests for a room that belongs to another worker get a
+    421 naming the right port, so a client with a stale shard map can
+    correct itself.
+    """
+
+    def __init__(self, shard, ports, name="pychat", chats_dir="chats", host='0.0.0.0', rate_limits=True):
+        self.shard = shard
+        self.ports = ports
+        self.name = name
+        self.chats_dir = chats_dir
+        self.host = host
+        self.rate_limits = rate_limits
+        self.rooms = {}  # chat code -> (NetworkManager, Flask app)
+        self._lock = threading.Lock()
+
+    def room(self, chat_code):
+        """Returns the app for `chat_code`, creating the room if it doesn't exist yet."""
+        room = self.rooms.get(chat_code)
+        if room:
+            return room[1]
+        from .network import NetworkManager
+        from .ratelimit import AdmissionController
+        with self._lock:
+            if chat_code not in self.rooms:
+                if len(self.rooms) >= MAX_ROOMS_PER_WORKER:
+                    return None
+                manager = NetworkManager(self.name, chat_code, host=self.host, port=self.ports[self.shard],
+                                         advertise=False, chats_dir=self.chats_dir,
+                                         admission=None if self.rate_limits else AdmissionController.unlimited())
+                app = manager.build_app()
+                manager.start_background()
+                self.rooms[chat_code] = (manager, app)
+                logger.info(f"Worker {self.shard} opened room {chat_code}")
+            return self.rooms[chat_code][1]
+
+    def resume_rooms(self):
+        """Reopens this shard's rooms that have saved session state, so their fan-out resumes right away.
+
+        Without this a room would only come back (and push what its clients
+        missed, renew their leases and reap dead ones) once someone sent it
+        a request. Returns the chat codes reopened.
+        """
+        from .state import MAX_SNAPSHOT_AGE
+        suffix = ".session.json"
+        resumed = []
+        try:
+            entries = os.listdir(self.chats_dir)
+        except FileNotFoundError:
+            return resumed
+        for entry in sorted(entries):
+            chat_code = entry[:-len(suffix)]
+            if not entry.endswith(suffix) or not CHAT_CODE_PATTERN.match(chat_code):
+                continue
+            if shard_for(chat_code, len(self.ports)) != self.shard:
+                continue
+            try:
+                if time.time() - os.path.getmtime(os.path.join(self.chats_dir, entry)) > MAX_SNAPSHOT_AGE:
+                    continue
+            except OSError:
+                continue
+            if self.room(chat_code) is not None:
+                resumed.append(chat_code)
+        if resumed:
+            logger.info(f"Worker {self.shard} resumed {len(resumed)} rooms from saved session state")
+        return resumed
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == '/metrics':
+            from .metrics import registry, PROMETHEUS_CONTENT_TYPE
+            start_response('200 OK', [('Content-Type', PROMETHEUS_CONTENT_TYPE)])
+            return [registry.render().encode('utf-8')]
+        if path == '/shards':
+            return _json_response(environ, start_response, {'shard': self.shard, 'ports': self.ports}, 200)
+        if not path.startswith(ROOM_PREFIX):
+            return _json_response(environ, start_response, {'error': "not found"}, 404)
+
+        chat_code, _, rest = path[len(ROOM_PREFIX):].partition('/')
+        if not CHAT_CODE_PATTERN.match(chat_code):
+            return _json_response(environ, start_response, {'error': "invalid chat code"}, 400)
+        owner = shard_for(chat_code, len(self.ports))
+        if owner != self.shard:
+            return _json_response(environ, start_response,
+                                  {'error': "room lives on another shard", 'shard': owner, 'port': self.ports[owner]}, 421)
+
+        app = self.room(chat_code)
+        if app is None:
+            return _json_response(environ, start_response, {'error': "too many rooms"}, 503)
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + ROOM_PREFIX + chat_code
+        environ['PATH_INFO'] = '/' + rest
+        return app(environ, start_response)
+
+    def stop(self):
+        for manager, _ in list(self.rooms.values()):
+            try:
+                manager.stop()
+            except Exception as e:
+                logger.error(f"Error stopping room {manager.chat_code}: {e}")
+
+
+def _run_worker(shard, ports, host, ssl_context, chats_dir, name, rate_limits, ready):
+    from werkzeug.serving import make_server
+    # The supervisor stops workers with SIGTERM; Ctrl-C is its to handle
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    router = RoomRouter(shard, ports, name=name, chats_dir=chats_dir, host=host, rate_limits=rate_limits)
+    server = make_server(host, ports[shard], router, threaded=True, ssl_context=ssl_context)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    router.resume_rooms()
+    ready.set()
+    while not stop.wait(1):
+        pass
+    router.stop()
+    server.shutdown()
+    server.server_close()
+
+
+class ShardedServer:
+    """Supervisor of the worker processes.
+
+    Args:
+        name: Service name advertised over mDNS
+        workers: Number of worker processes (default: CPU count)
+        host: Address the workers bind to
+        base_port: Worker i listens on base_port + i; free ports are picked if not given
+        ssl_context: (cert, key) paths for TLS, False for plain HTTP, or None for the default certificate
+        chats_dir: Directory the room logs and session state are written to
+        advertise: Whether to publish the shard map over mDNS
+        rate_limits: Whether rooms get the default admission limits
+    """
+
+    def __init__(self, name, workers=None, host='0.0.0.0', base_port=None, ssl_context=None,
+                 chats_dir="chats", advertise=True, rate_limits=True):
+        from .network import find_free_port, DEFAULT_SSL_CONTEXT
+        self.name = name
+        self.workers = workers or os.cpu_count() or 1
+        self.host = host
+        self.ssl_context = DEFAULT_SSL_CONTEXT if ssl_context is None else (ssl_context or None)
+        self.chats_dir = os.path.abspath(chats_dir)
+        self.advertise = advertise
+        self.rate_limits = rate_limits
+        self.ports = [base_port + i if base_port else find_free_port() for i in range(self.workers)]
+        self._ctx = multiprocessing.get_context("spawn")
+        self._processes = [None] * self.workers
+        # Kept so the events outlive the spawn that unpickles them in the child
+        self._ready = [None] * self.workers
+        self._stopping = False
+        self._monitor = None
+        self.zeroconf = None
+        self.service_info = None
+
+    @property
+    def scheme(self):
+        return "https" if self.ssl_context else "http"
+
+    def room_url(self, chat_code, host='127.0.0.1'):
+        """URL of a room's routes, on the worker that owns it."""
+        return f"{self.scheme}://{host}:{self.ports[shard_for(chat_code, self.workers)]}{ROOM_PREFIX}{chat_code}"
+
+    def pids(self):
+        return [process.pid for process in self._processes if process is not None and process.is_alive()]
+
+    def _spawn(self, shard):
+        ready = self._ctx.Event()
+        process = self._ctx.Process(
+            target=_run_worker,
+            args=(shard, self.ports, self.host, self.ssl_context, self.chats_dir, self.name,
+                  self.rate_limits, ready),
+            name=f"pychat-shard-{shard}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[shard] = process
+        self._ready[shard] = ready
+        return ready
+
+    def start(self, timeout=30):
+        os.makedirs(self.chats_dir, exist_ok=True)
+        readies = [self._spawn(shard) for shard in range(self.workers)]
+        for shard, ready in enumerate(readies):
+            if not ready.wait(timeout):
+                raise RuntimeError(f"Shard {shard} did not start")
+        logger.info(f"Started {self.workers} shards on ports {self.ports}")
+
+        if self.advertise:
+            from zeroconf import Zeroconf, ServiceInfo
+            from .network import SERVICE_TYPE
+            self.zeroconf = Zeroconf()
+            self.service_info = ServiceInfo(
+                SERVICE_TYPE,
+                f"{self.name}.{SERVICE_TYPE}",
+                addresses=[socket.inet_aton(get_local_ip())],
+                port=self.ports[0],
+                properties={b'shards': ",".join(str(p) for p in self.ports).encode('utf-8')},
+            )
+            self.zeroconf.register_service(self.service_info)
+
+        self._monitor = threading.Thread(target=self._watch, name="pychat-supervisor", daemon=True)
+        self._monitor.start()
+
+    def _watch(self):
+        while not self._stopping:
+            for shard, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stopping:
+                    logger.error(f"Shard {shard} exited with {process.exitcode}; restarting it")
+                    time.sleep(RESTART_DELAY)
+                    if not self._stopping:
+                        self._spawn(shard)
+            time.sleep(0.5)
+
+    def stop(self):
+        self._stopping = True
+        if self.service_info:
+            self.zeroconf.unregister_service(self.service_info)
+            self.zeroconf.close()
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.kill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run PyChat as a supervisor with sharded worker processes")
+    parser.add_argument("--name", default=socket.gethostname(), help="service name advertised over mDNS")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--host", default='0.0.0.0')
+    parser.add_argument("--base-port", type=int, help="worker i listens on BASE_PORT + i")
+    parser.add_argument("--chats-dir", default=None, help="where room logs are kept")
+    parser.add_argument("--no-tls", action="store_true", help="serve plain HTTP")
+    parser.add_argument("--no-mdns", action="store_true", help="don't advertise the shard map")
+    args = parser.parse_args(argv)
+
+    from .config import CHATS_DIR
+    from .diagnostics import setup_logging
+    log_listener = setup_logging(level=logging.INFO)
+    server = ShardedServer(args.name, workers=args.workers, host=args.host, base_port=args.base_port,
+                           ssl_context=False if args.no_tls else None, chats_dir=args.chats_dir or CHATS_DIR,
+                           advertise=not args.no_mdns)
+    server.start()
+    print(f"Serving {server.workers} shards on ports {', '.join(map(str, server.ports))}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        log_listener.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import os
+import zlib
+
+from .metrics import registry
+
+# Plaintexts that start with this byte are compressed; the next byte says how.
+# Chat text is UTF-8 and never starts with NUL, so older records still decode as-is.
+COMPRESSED_FLAG = b'\x00'
+METHOD_ZLIB = 1
+METHOD_ZLIB_DICT = 2
+
+# Plaintexts shorter than this are sent as-is (the zlib framing would eat any savings)
+DEFAULT_THRESHOLD = int(os.environ.get("PYCHAT_COMPRESS_THRESHOLD", "96"))
+# Set PYCHAT_COMPRESS=0 to turn compression off for outgoing messages
+ENABLED = os.environ.get("PYCHAT_COMPRESS", "1") != "0"
+# Refuse to inflate a message past this size
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+# Preset dictionary of strings common in chat lines, pasted logs and code.
+# zlib favours the end of the dictionary, so the most common strings are last.
+# Changing it breaks every stored message that used it: add a new method instead.
+CHAT_DICTIONARY = (
+    b"Traceback (most recent call last):\n  File \"\", line , in \n"
+    b"    raise Exception Error: ValueError: TypeError: KeyError: ImportError: "
+    b"ModuleNotFoundError: No module named AttributeError: object has no attribute "
+    b"def self, return None True False import from class for in if else elif while try except "
+    b"finally with as lambda yield async await print( len( range( __init__ __name__ \"__main__\" "
+    b"function const let var => console.log( null undefined this.</div><div class=\"\">"
+    b"#include <stdio.h> int main(void) { } std:: public static void "
+    b"SELECT * FROM WHERE ORDER BY GROUP BY INSERT INTO VALUES UPDATE SET "
+    b"git commit -m push pull origin main master branch merge rebase checkout "
+    b"sudo apt install pip install npm install cd ls -la cat grep echo export PATH=/usr/bin/ "
+    b"https://www.github.com/ http://localhost:8080/ .com .org .html .json .py .js .txt "
+    b"DEBUG INFO WARNING ERROR CRITICAL 2025-01-01 00:00:00,000 - pychat - "
+    b"{\"id\": , \"name\": \"\", \"type\": \"status\": \"ok\", \"error\": \"message\": \"data\": []}\n"
+    b"    \n        \n            \n\t\t\n"
+    b"thanks thank you please sorry okay ok yeah yes no lol haha :) :D "
+    b"can you could you would you do you know I think I don't I'm it's that's what's "
+    b"there is there are have been going to want to need to let me know "
+    b"what when where why how who which about because should would could "
+    b"the and that this with have from they will your just about some time "
+    b"you are not but was for are the of to and a in is it I you "
+)
+
+COMPRESSED_MESSAGES = registry.counter('pychat_compressed_messages_total', 'Outgoing messages compressed before encryption')
+COMPRESSION_BYTES_SAVED = registry.counter('pychat_compression_bytes_saved_total', 'Plaintext bytes saved by compression')
+
+
+def compress(plaintext, threshold=None, enabled=None):
+    """Compresses a plaintext before encryption when that makes it smaller.
+
+    Returns either the plaintext unchanged or COMPRESSED_FLAG + method + data.
+    Compressed and plain messages can be mixed freely in one chat log.
+    """
+    threshold = DEFAULT_THRESHOLD if threshold is None else threshold
+    enabled = ENABLED if enabled is None else enabled
+    if not enabled or len(plaintext) < threshold:
+        return plaintext
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=CHAT_DICTIONARY)
+    packed = COMPRESSED_FLAG + bytes([METHOD_ZLIB_DICT]) + compressor.compress(plaintext) + compressor.flush()
+    if len(packed) >= len(plaintext):
+        return plaintext
+
+    COMPRESSED_MESSAGES.inc()
+    COMPRESSION_BYTES_SAVED.inc(len(plaintext) - len(packed))
+    return packed
+
+
+def decompress(plaintext):
+    """Undoes compress(); plaintexts without the flag are returned unchanged."""
+    if not plaintext.startswith(COMPRESSED_FLAG):
+        return plaintext
+    if len(plaintext) < 2:
+        raise ValueError("Truncated compressed message")
+
+    method = plaintext[1]
+    if method == METHOD_ZLIB_DICT:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=CHAT_DICTIONARY)
+    elif method == METHOD_ZLIB:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        raise ValueError(f"Unknown compression method {method}")
+
+    data = decompressor.decompress(plaintext[2:], MAX_DECOMPRESSED_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Compressed message is too large")
+    return data + decompressor.flush()
@@ -7,6 +7,14 @@ APP_BASE_DIR = os.environ.get("PYCHAT_BASE_DIR", os.path.dirname(os.path.dirname
 KEYS_DIR = os.path.join(APP_BASE_DIR, "keys")
 SHARED_KEYS_DIR = os.path.join(APP_BASE_DIR, "sharedkeys")
 CHATS_DIR = os.path.join(APP_BASE_DIR, "chats")
+# Secrets of unfinished uploads, kept so they can be resumed
+TRANSFERS_DIR = os.path.join(KEYS_DIR, "transfers")
+DOWNLOADS_DIR = os.path.join(APP_BASE_DIR, "downloads")
+# Control socket of the multi-session daemon (behind/daemon.py)
+DAEMON_SOCKET = os.environ.get(
+    "PYCHAT_DAEMON_SOCKET",
+    os.path.join(os.environ.get("XDG_RUNTIME_DIR", APP_BASE_DIR), "pychat.sock"),
+)
 
 def initialize_directories():
     """Creates the necessary directories if they don't exist."""
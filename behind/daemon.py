@@ -0,0 +1,766 @@
+"""Headless daemon that runs many chat sessions in one process.
+
+Sessions share one Zeroconf instance (for advertising and for finding
+peers) and are driven through a Unix domain socket that speaks JSON lines:
+every request is one JSON object with a "cmd" (plus an optional "id" echoed
+in the reply), and every reply is one JSON object with "ok" set.
+
+    python -m behind.daemon run                     # start the daemon
+    python -m behind.daemon open team --name alice  # host chat "team"
+    python -m behind.daemon attach team             # interactive thin client
+    python -m behind.daemon status
+
+Commands: open, close, send, history, search, subscribe, set_peer, status, shutdown.
+After "subscribe" the connection only carries events, one JSON object per line.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import base64
+import socket
+import argparse
+import threading
+import socketserver
+from collections import deque
+
+import requests
+
+from .config import CHATS_DIR, KEYS_DIR, DAEMON_SOCKET, initialize_directories
+from .history import record_id, log_size, read_records_before
+from .replica import LogReplica, replica_path
+from .lanes import LaneSessions
+from .peers import fingerprint
+from .dialer import dialer
+from .diagnostics import events
+import logging
+
+logger = logging.getLogger('pychat')
+
+# Decoded messages a session keeps for "history" when it has no local log (joined sessions)
+RECENT_MESSAGES = 1000
+# Record IDs a session remembers to drop duplicate deliveries (oldest forgotten first)
+SEEN_RECORDS = 10000
+# Seconds between polls of a joined peer
+POLL_INTERVAL = 0.5
+# Events buffered for one subscriber before new ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 1000
+DEFAULT_HISTORY_COUNT = 50
+
+
+class DaemonError(Exception):
+    """A request the daemon can't carry out; the message is sent back to the client."""
+
+
+def _loopback_session():
+    session = requests.Session()
+    # Our own server on loopback, possibly with a self-signed certificate
+    session.verify = False
+    session.trust_env = False
+    return session
+
+
+class Session:
+    """One chat code, either hosted here ('host') or joined on a peer's server ('join').
+
+    Args:
+        daemon: Owning Daemon (for publishing events and the shared Zeroconf)
+        chat_code: Chat code of the session
+        name: Name messages are sent under
+        role: 'host' to run a NetworkManager for the chat, 'join' to use `peer_url`'s
+        peer_url: Server messages are sent to (required for 'join', optional for 'host')
+        encrypt: Whether messages are end-to-end encrypted (plaintext like the GUI if not)
+        peer_public_key: Key outgoing messages are encrypted for
+    """
+
+    def __init__(self, daemon, chat_code, name, role='host', peer_url=None, encrypt=True, peer_public_key=None):
+        if role not in ('host', 'join'):
+            raise DaemonError(f"unknown role '{role}'")
+        if role == 'join' and not peer_url:
+            raise DaemonError("joining a chat needs a peer_url (or a discoverable host)")
+        self.daemon = daemon
+        self.chat_code = chat_code
+        self.name = name
+        self.role = role
+        self.peer_url = peer_url
+        self.encrypt = encrypt
+        self.peer_public_key = peer_public_key
+        self.public_key = None
+        self.private_key = None
+        self.network_manager = None
+        self.search_index = None
+        self.started = time.time()
+        self.received = 0
+        self.sent = 0
+        self._recent = deque(maxlen=RECENT_MESSAGES)
+        # Record IDs already handled; the deque keeps them in arrival order so the set stays bounded
+        self._seen = set()
+        self._seen_order = deque()
+        self._sent_texts = {}  # record ID -> text of our own messages (encrypted for the peer, so unreadable to us)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._poller = None
+        # Local copy of a joined room's log; history is read from it
+        self.replica = None
+        # One session per traffic lane, so the snapshot download never holds up sends or polls
+        self._http = LaneSessions()
+        self._loopback = _loopback_session()
+
+    # --- Lifecycle ---
+
+    def start(self):
+        from .network import NetworkManager
+        from .search import SearchIndex, load_or_create_key
+
+        if self.encrypt:
+            from .main import kem
+            self.public_key, self.private_key = kem.keygen()
+        self.search_index = SearchIndex(
+            os.path.join(CHATS_DIR, f"{self.chat_code}.index"),
+            load_or_create_key(os.path.join(KEYS_DIR, f"{self.chat_code}_index.key")),
+        )
+
+        if self.role == 'host':
+            self.network_manager = NetworkManager(
+                self.name,
+                self.chat_code,
+                on_message=self._on_record,
+                ssl_context=self.daemon.ssl_context,
+                advertise=self.daemon.zeroconf is not None,
+                chats_dir=CHATS_DIR,
+                zeroconf=self.daemon.zeroconf,
+                public_key=self.public_key,
+            )
+            # Encrypt for the first peer that exchanged keys with us, or one trusted with set_peer since
+            self.network_manager.peer_keys.subscribe(self._peer_key_changed)
+            self.network_manager.start()
+        else:
+            if self.encrypt:
+                self._exchange_keys()
+            self.replica = LogReplica(replica_path(CHATS_DIR, self.chat_code), self.peer_url,
+                                      session=self._http.interactive, bulk_session=self._http.bulk)
+            self._poller = threading.Thread(target=self._poll_peer, name=f"pychat-poll-{self.chat_code}", daemon=True)
+            self._poller.start()
+        logger.info(f"Session {self.chat_code} started ({self.role})")
+
+    def _peer_key_changed(self, peer_id, public_key):
+        # A hosted chat encrypts for its keystore's trusted key, not whoever registered last
+        trusted = self.network_manager.peer_keys.trusted() if self.network_manager else public_key
+        self.peer_public_key = trusted
+        self.daemon.publish({'event': 'peer_key', 'chat_code': self.chat_code, 'peer_id': peer_id,
+                             'fingerprint': fingerprint(public_key), 'trusted': public_key == trusted})
+
+    def _exchange_keys(self):
+        """Registers our key with the joined server and takes its key from the reply."""
+        try:
+            response = self._http.control.post(f"{self.peer_url}/public_key", json={
+                'public_key': base64.b64encode(self.public_key).decode('utf-8'),
+                'peer_id': self.name,
+            }, timeout=5)
+            server_key = response.json().get('server_public_key') if response.ok else None
+            if server_key:
+                self._peer_key_changed('server', base64.b64decode(server_key))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.warning(f"Key exchange with {self.peer_url} failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        if self.network_manager:
+            self.network_manager.stop()
+        if self._poller:
+            self._poller.join(timeout=5)
+        logger.info(f"Session {self.chat_code} stopped")
+
+    @property
+    def server_url(self):
+        """URL of this session's own server, or None for joined sessions."""
+        if not self.network_manager:
+            return None
+        scheme = "https" if self.network_manager.ssl_context else "http"
+        return f"{scheme}://127.0.0.1:{self.network_manager.port}"
+
+    # --- Messages ---
+
+    def _decode(self, record):
+        """Returns the text of a stored record, or None if this session can't read it."""
+        rid = record_id(record)
+        with self._lock:
+            if rid in self._sent_texts:
+                return self._sent_texts[rid]
+        if not self.encrypt:
+            try:
+                return record.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+        from .main import decrypt_message
+        return decrypt_message(record, self.private_key, skip_errors=True)
+
+    def _on_record(self, record, offset=None):
+        rid = record_id(record)
+        with self._lock:
+            if rid in self._seen:
+                return
+            self._seen.add(rid)
+            self._seen_order.append(rid)
+            if len(self._seen_order) > SEEN_RECORDS:
+                self._seen.discard(self._seen_order.popleft())
+            own = self._sent_texts.pop(rid, None)
+        text = own if own is not None else self._decode(record)
+        if text is None:
+            events.record("daemon.undecryptable", chat_code=self.chat_code)
+            return
+        self.received += 1
+        message = {'id': rid, 'offset': offset, 'text': text, 'own': own is not None}
+        self._recent.append(message)
+        try:
+            self.search_index.add(record, text, offset)
+        except Exception as e:
+            logger.error(f"Error updating search index for {self.chat_code}: {e}")
+        self.daemon.publish({'event': 'message', 'chat_code': self.chat_code, **message})
+
+    def _poll_peer(self):
+        incremental = True
+        try:
+            # Seeds the replica from a /snapshot the first time, later only fetches what was missed
+            for offset, record in self.replica.bootstrap():
+                self._on_record(record, offset)
+        except ValueError as e:
+            # Servers from before /messages?after=: poll the full log, without a replica
+            logger.warning(f"Can't keep a replica of {self.peer_url}, polling the full log instead: {e}")
+            incremental = False
+        except Exception as e:
+            events.record("daemon.poll_error", chat_code=self.chat_code, error=str(e))
+        last_poll = 0
+        consumed = 0  # records of the full log already handled, in the fallback
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                if incremental:
+                    # Incremental sync: only the records stored after the replica's end
+                    for offset, record in self.replica.sync():
+                        self._on_record(record, offset)
+                else:
+                    response = self._http.interactive.get(f"{self.peer_url}/messages", params={'since': last_poll}, timeout=5)
+                    response.raise_for_status()
+                    # The reply is the whole log whenever it changed: only the records past
+                    # the ones already handled are new, and the seen set can't hold them all
+                    records = [base64.b64decode(message_b64) for message_b64 in response.json()]
+                    if len(records) < consumed:
+                        # The log was replaced; the seen set skips what is still recent
+                        consumed = 0
+                    offset = sum(len(record) + 1 for record in records[:consumed])
+                    for record in records[consumed:]:
+                        self._on_record(record, offset)
+                        offset += len(record) + 1
+                    consumed = len(records)
+                    last_poll = started
+            except Exception as e:
+                self._check_reachable(e)
+                events.record("daemon.poll_error", chat_code=self.chat_code, error=str(e))
+            self._stop.wait(POLL_INTERVAL)
+
+    def _check_reachable(self, error):
+        """Drops the cached route to the peer if `error` means its address didn't answer."""
+        if self.peer_url and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            dialer.unreachable(self.peer_url)
+
+    def send(self, text):
+        """Sends `text` as this session's name. Returns the record ID."""
+        full_message = f"{self.name}: {text}"
+        if self.encrypt:
+            if not self.peer_public_key:
+                raise DaemonError("no peer public key yet; use set_peer")
+            from .main import encrypt_message
+            record = encrypt_message(full_message, self.peer_public_key)
+        else:
+            record = full_message.encode('utf-8')
+        rid = record_id(record)
+        with self._lock:
+            self._sent_texts[rid] = full_message
+
+        if self.peer_url:
+            try:
+                response = self._http.interactive.post(f"{self.peer_url}/message",
+                                           json={'message': base64.b64encode(record).decode('utf-8')}, timeout=5)
+            except requests.RequestException as e:
+                with self._lock:
+                    self._sent_texts.pop(rid, None)
+                self._check_reachable(e)
+                raise
+        else:
+            response = self._loopback.post(f"{self.server_url}/message",
+                                           json={'message': base64.b64encode(record).decode('utf-8')}, timeout=5)
+        if response.status_code == 429:
+            with self._lock:
+                self._sent_texts.pop(rid, None)
+            raise DaemonError(f"sending too fast, try again in {response.headers.get('Retry-After', '1')}s")
+        if not response.ok:
+            with self._lock:
+                self._sent_texts.pop(rid, None)
+            raise DaemonError(f"server rejected the message: {response.status_code}")
+        self.sent += 1
+
+        if self.role == 'host' and self.peer_url:
+            # Sent to the peer's server, so it never shows up in our own log
+            self._on_record(record)
+        return rid
+
+    def history(self, before=None, count=DEFAULT_HISTORY_COUNT):
+        """Returns (next_before, messages): up to `count` messages older than log offset `before`."""
+        if self.network_manager:
+            path = self.network_manager.chat_filename
+        elif self.replica:
+            path = self.replica.path
+        else:
+            recent = list(self._recent)[-count:]
+            return None, recent
+        end = log_size(path) if before is None else before
+        start, records = read_records_before(path, end, count)
+        messages = []
+        for offset, record in records:
+            text = self._decode(record)
+            if text is not None:
+                messages.append({'id': record_id(record), 'offset': offset, 'text': text})
+        return (start if start > 0 else None), messages
+
+    def status(self):
+        return {
+            'chat_code': self.chat_code,
+            'name': self.name,
+            'role': self.role,
+            'encrypt': self.encrypt,
+            'peer_url': self.peer_url,
+            'server_url': self.server_url,
+            'port': self.network_manager.port if self.network_manager else None,
+            'log_path': self.network_manager.chat_filename if self.network_manager else (
+                self.replica.path if self.replica else None),
+            'public_key': base64.b64encode(self.public_key).decode('utf-8') if self.public_key else None,
+            'has_peer_key': bool(self.peer_public_key),
+            'peer_key_fingerprint': fingerprint(self.peer_public_key) if self.peer_public_key else None,
+            'received': self.received,
+            'sent': self.sent,
+            'uptime_s': round(time.time() - self.started, 1),
+        }
+
+
+class Daemon:
+    """Runs sessions and answers control requests.
+
+    Args:
+        socket_path: Unix socket to listen on
+        advertise: Whether to use mDNS (advertise hosted chats, discover peers to join)
+        ssl_context: (cert, key) for hosted sessions' servers; None uses the installed
+            certificate and False serves plain HTTP
+    """
+
+    def __init__(self, socket_path=DAEMON_SOCKET, advertise=True, ssl_context=None):
+        from .network import DEFAULT_SSL_CONTEXT
+        self.socket_path = socket_path
+        self.ssl_context = DEFAULT_SSL_CONTEXT if ssl_context is None else (ssl_context or None)
+        self.sessions = {}
+        self.zeroconf = None
+        self.discovery = None
+        self._browser = None
+        if advertise:
+            from zeroconf import Zeroconf, ServiceBrowser
+            from .discovery import ServiceListener
+            from .network import SERVICE_TYPE
+            self.zeroconf = Zeroconf()
+            self.discovery = ServiceListener()
+            self._browser = ServiceBrowser(self.zeroconf, SERVICE_TYPE, self.discovery)
+        self._subscribers = []  # (queue, chat_code or None)
+        self._sessions_lock = threading.Lock()
+        self._subscribers_lock = threading.Lock()
+        self._server = None
+        self._commands = {
+            'open': self.cmd_open,
+            'close': self.cmd_close,
+            'send': self.cmd_send,
+            'history': self.cmd_history,
+            'search': self.cmd_search,
+            'set_peer': self.cmd_set_peer,
+            'status': self.cmd_status,
+            'shutdown': self.cmd_shutdown,
+        }
+
+    # --- Events ---
+
+    def publish(self, event):
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+        for events_queue, chat_code in subscribers:
+            if chat_code and event.get('chat_code') != chat_code:
+                continue
+            try:
+                events_queue.put_nowait(event)
+            except queue.Full:
+                events.record("daemon.subscriber_overflow", chat_code=chat_code)
+
+    def subscribe(self, chat_code=None):
+        events_queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._subscribers_lock:
+            self._subscribers.append((events_queue, chat_code))
+        return events_queue
+
+    def unsubscribe(self, events_queue):
+        with self._subscribers_lock:
+            self._subscribers = [s for s in self._subscribers if s[0] is not events_queue]
+
+    # --- Commands ---
+
+    def _session(self, request):
+        chat_code = request.get('chat_code')
+        session = self.sessions.get(chat_code)
+        if session is None:
+            raise DaemonError(f"no session for chat '{chat_code}'")
+        return session
+
+    def cmd_open(self, request):
+        chat_code = request.get('chat_code')
+        if not chat_code:
+            raise DaemonError("chat_code is required")
+        role = request.get('role', 'host')
+        peer_url = request.get('peer_url')
+        if role == 'join' and not peer_url and self.discovery:
+            peer_url = self.discovery.get_address(chat_code)
+        peer_key = request.get('peer_public_key')
+        with self._sessions_lock:
+            if chat_code in self.sessions:
+                return {'session': self.sessions[chat_code].status(), 'existing': True}
+            session = Session(
+                self, chat_code, request.get('name') or "User", role=role, peer_url=peer_url,
+                encrypt=request.get('encrypt', True),
+                peer_public_key=base64.b64decode(peer_key) if peer_key else None,
+            )
+            session.start()
+            self.sessions[chat_code] = session
+        self.publish({'event': 'session_opened', 'chat_code': chat_code})
+        return {'session': session.status()}
+
+    def cmd_close(self, request):
+        with self._sessions_lock:
+            session = self._session(request)
+            del self.sessions[session.chat_code]
+        session.stop()
+        self.publish({'event': 'session_closed', 'chat_code': session.chat_code})
+        return {}
+
+    def cmd_send(self, request):
+        text = request.get('text')
+        if not text:
+            raise DaemonError("text is required")
+        return {'id': self._session(request).send(text)}
+
+    def cmd_history(self, request):
+        before, messages = self._session(request).history(request.get('before'),
+                                                            int(request.get('count', DEFAULT_HISTORY_COUNT)))
+        return {'before': before, 'messages': messages}
+
+    def cmd_search(self, request):
+        session = self._session(request)
+        return {'results': session.search_index.search(request.get('query', ''), int(request.get('limit', 20)))}
+
+    def cmd_set_peer(self, request):
+        """Sets where a session sends messages and/or the key they are encrypted for.
+
+        A hosted session can also be pointed at a key a peer registered, by its
+        `fingerprint` (see the peer_key event), once the user has checked it.
+        """
+        session = self._session(request)
+        if 'peer_url' in request:
+            session.peer_url = request['peer_url'] or None
+            if session.replica and session.peer_url:
+                session.replica.server_url = session.peer_url
+        if request.get('public_key'):
+            session.peer_public_key = base64.b64decode(request['public_key'])
+        if request.get('fingerprint'):
+            if not session.network_manager or not session.network_manager.peer_keys.trust(request['fingerprint']):
+                raise DaemonError(f"no peer registered a key with fingerprint {request['fingerprint']}")
+        return {'session': session.status()}
+
+    def cmd_status(self, request):
+        from .cache import decrypt_cache
+        return {
+            'pid': os.getpid(),
+            'socket': self.socket_path,
+            'sessions': [s.status() for s in self.sessions.values()],
+            'subscribers': len(self._subscribers),
+            'decrypt_cache': decrypt_cache.stats(),
+        }
+
+    def cmd_shutdown(self, request):
+        threading.Thread(target=self.shutdown, daemon=True).start()
+        return {}
+
+    def handle(self, request):
+        """Runs one control request and returns the reply."""
+        command = self._commands.get(request.get('cmd'))
+        reply = {'id': request['id']} if 'id' in request else {}
+        if command is None:
+            return {**reply, 'ok': False, 'error': f"unknown command '{request.get('cmd')}'"}
+        try:
+            return {**reply, 'ok': True, **command(request)}
+        except DaemonError as e:
+            return {**reply, 'ok': False, 'error': str(e)}
+        except Exception as e:
+            logger.error(f"Error handling daemon command {request.get('cmd')}: {e}", exc_info=True)
+            return {**reply, 'ok': False, 'error': str(e)}
+
+    # --- Control socket ---
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                    except ValueError:
+                        self._write({'ok': False, 'error': "invalid JSON"})
+                        continue
+                    if request.get('cmd') == 'subscribe':
+                        self._stream(request)
+                        return
+                    self._write(daemon.handle(request))
+
+            def _write(self, message):
+                self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+            def _stream(self, request):
+                events_queue = daemon.subscribe(request.get('chat_code'))
+                try:
+                    self._write({'id': request.get('id'), 'ok': True})
+                    while True:
+                        try:
+                            self._write(events_queue.get(timeout=15))
+                        except queue.Empty:
+                            self._write({'event': 'heartbeat'})
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    daemon.unsubscribe(events_queue)
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            if _socket_alive(self.socket_path):
+                raise DaemonError(f"a daemon is already listening on {self.socket_path}")
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.socket_path)), exist_ok=True)
+        # Only our user may talk to the daemon: it holds every session's keys
+        old_umask = os.umask(0o177)
+        try:
+            self._server = Server(self.socket_path, Handler)
+        finally:
+            os.umask(old_umask)
+        logger.info(f"PyChat daemon listening on {self.socket_path}")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        with self._sessions_lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            try:
+                session.stop()
+            except Exception as e:
+                logger.error(f"Error stopping session {session.chat_code}: {e}")
+        if self._browser:
+            self._browser.cancel()
+        if self.zeroconf:
+            self.zeroconf.close()
+        if self._server:
+            self._server.shutdown()
+
+
+def _socket_alive(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+class DaemonClient:
+    """Client for the daemon's control socket, used by the thin CLI and the Qt frontend."""
+
+    def __init__(self, socket_path=DAEMON_SOCKET, timeout=30):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock, sock.makefile('rwb')
+
+    def request(self, cmd, **args):
+        """Sends one command and returns its reply. Raises DaemonError if the daemon refused it."""
+        with self._lock:
+            if self._sock is None:
+                self._sock, self._file = self._connect()
+            self._next_id += 1
+            self._file.write(json.dumps({'cmd': cmd, 'id': self._next_id, **args}).encode('utf-8') + b'\n')
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            self.close()
+            raise ConnectionError("daemon closed the connection")
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise DaemonError(reply.get('error', "request failed"))
+        return reply
+
+    def subscribe(self, chat_code=None):
+        """Yields events (dicts) for `chat_code`, or every session, on a dedicated connection."""
+        sock, f = self._connect()
+        sock.settimeout(None)
+        try:
+            f.write(json.dumps({'cmd': 'subscribe', 'chat_code': chat_code}).encode('utf-8') + b'\n')
+            f.flush()
+            f.readline()  # acknowledgement
+            for line in f:
+                event = json.loads(line)
+                if event.get('event') != 'heartbeat':
+                    yield event
+        finally:
+            f.close()
+            sock.close()
+
+    def close(self):
+        with self._lock:
+            if self._sock:
+                self._file.close()
+                self._sock.close()
+            self._sock = self._file = None
+
+
+def attach(client, chat_code):
+    """Interactive thin client for one session of a running daemon."""
+    def print_events():
+        try:
+            for event in client.subscribe(chat_code):
+                if event.get('event') == 'message' and not event.get('own'):
+                    print(f"\r{event['text']}\n> ", end='', flush=True)
+                elif event.get('event') == 'peer_key' and not event.get('trusted'):
+                    print(f"\r[System] {event['peer_id']} registered a new key {event['fingerprint']}. Check it with "
+                          f"them, then type '.trust {event['fingerprint']}' to use it\n> ", end='', flush=True)
+        except (OSError, ValueError):
+            print("\n[System] Lost connection to the daemon")
+
+    threading.Thread(target=print_events, daemon=True).start()
+    print(f"--- Attached to '{chat_code}' ---")
+    print("Type '.exit' to detach, '.history' to view past messages or '.search <terms>' to find messages.")
+    print("Type '.trust <fingerprint>' to accept a partner's new key.")
+    while True:
+        try:
+            message = input("> ")
+        except EOFError:
+            break
+        try:
+            if message.lower() == '.exit':
+                break
+            if message.lower() == '.history':
+                for m in client.request('history', chat_code=chat_code)['messages']:
+                    print(m['text'])
+                continue
+            if message.lower().startswith('.search'):
+                for r in reversed(client.request('search', chat_code=chat_code,
+                                                 query=message[len('.search'):].strip())['results']):
+                    print(r['text'])
+                continue
+            if message.lower().startswith('.trust'):
+                reply = client.request('set_peer', chat_code=chat_code, fingerprint=message[len('.trust'):].strip())
+                print(f"Now encrypting for {reply['session']['peer_key_fingerprint']}.")
+                continue
+            if message:
+                client.request('send', chat_code=chat_code, text=message)
+        except DaemonError as e:
+            print(f"[local] {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PyChat multi-session daemon")
+    parser.add_argument("--socket", default=DAEMON_SOCKET, help="control socket path")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the daemon in the foreground")
+    run.add_argument("--no-mdns", action="store_true", help="don't advertise or discover chats over mDNS")
+    run.add_argument("--no-tls", action="store_true", help="serve hosted chats over plain HTTP")
+
+    open_ = commands.add_parser("open", help="open a session")
+    open_.add_argument("chat_code")
+    open_.add_argument("--name", default=os.environ.get("USER", "User"))
+    open_.add_argument("--join", metavar="PEER_URL", nargs='?', const="", help="join a peer's chat instead of hosting")
+    open_.add_argument("--plaintext", action="store_true", help="don't encrypt messages (like the GUI)")
+
+    close = commands.add_parser("close", help="close a session")
+    close.add_argument("chat_code")
+
+    send = commands.add_parser("send", help="send one message")
+    send.add_argument("chat_code")
+    send.add_argument("text")
+
+    attach_ = commands.add_parser("attach", help="chat interactively in a session")
+    attach_.add_argument("chat_code")
+
+    commands.add_parser("status", help="show the daemon's sessions")
+    commands.add_parser("shutdown", help="stop the daemon")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        from .diagnostics import setup_logging, install_dump_signal
+        initialize_directories()
+        log_listener = setup_logging(level=logging.INFO)
+        install_dump_signal()
+        daemon = Daemon(args.socket, advertise=not args.no_mdns, ssl_context=False if args.no_tls else None)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon.shutdown()
+            log_listener.stop()
+        return 0
+
+    client = DaemonClient(args.socket)
+    try:
+        if args.command == "open":
+            reply = client.request('open', chat_code=args.chat_code, name=args.name,
+                                   role='join' if args.join is not None else 'host',
+                                   peer_url=args.join or None, encrypt=not args.plaintext)
+            print(json.dumps(reply['session'], indent=2))
+        elif args.command == "close":
+            client.request('close', chat_code=args.chat_code)
+        elif args.command == "send":
+            client.request('send', chat_code=args.chat_code, text=args.text)
+        elif args.command == "attach":
+            attach(client, args.chat_code)
+        elif args.command == "status":
+            print(json.dumps(client.request('status'), indent=2))
+        elif args.command == "shutdown":
+            client.request('shutdown')
+    except (DaemonError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import os
+import sys
+import time
+import queue
+import random
+import signal
+import itertools
+import threading
+import logging
+import logging.handlers
+from collections import deque
+
+logger = logging.getLogger('pychat')
+
+
+class EventRing:
+    """Fixed-size in-memory ring buffer of structured diagnostic events.
+
+    Recording an event only appends a tuple to a deque under a short lock:
+    nothing is formatted and nothing touches the disk on the calling thread.
+    Events are turned into text when they are written out, either by the
+    background writer (if a path is set) or by an on-demand dump.
+
+    Args:
+        capacity: Number of most recent events kept in memory
+        sample_rate: Fraction of events that are recorded (1.0 keeps all)
+        path: File the background writer appends events to, or None
+        flush_interval: Seconds between background writes
+    """
+
+    def __init__(self, capacity=10000, sample_rate=1.0, path=None, flush_interval=1.0):
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.path = path
+        self.flush_interval = flush_interval
+        self._events = deque(maxlen=capacity)
+        # Numbering and appending happen together, so the deque stays in sequence order
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._written_seq = -1
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._stop = threading.Event()
+        if path:
+            self.start_writer()
+
+    def record(self, event, **fields):
+        """Records an event. `fields` are kept as-is and only formatted when written out."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        entry_time, thread_id = time.time(), threading.get_ident()
+        with self._lock:
+            self._events.append((next(self._seq), entry_time, thread_id, event, fields))
+
+    def snapshot(self):
+        """Returns the buffered events, oldest first."""
+        with self._lock:
+            return list(self._events)
+
+    @staticmethod
+    def format_event(entry):
+        seq, ts, thread_id, event, fields = entry
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts)) + f".{int(ts % 1 * 1000):03d}"
+        details = " ".join(f"{key}={value!r}" for key, value in fields.items())
+        return f"{stamp} [{thread_id}] {event} {details}".rstrip()
+
+    def _write_new(self, path):
+        with self._write_lock:
+            entries = [e for e in self.snapshot() if e[0] > self._written_seq]
+            if not entries:
+                return 0
+            with open(path, "a") as f:
+                f.write("\n".join(self.format_event(e) for e in entries) + "\n")
+            self._written_seq = entries[-1][0]
+            return len(entries)
+
+    def start_writer(self):
+        """Starts the background thread that appends new events to `path`."""
+        if self._writer or not self.path:
+            return
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                try:
+                    self._write_new(self.path)
+                except Exception as e:
+                    logger.error(f"Error writing diagnostic events: {e}")
+            self._write_new(self.path)
+
+        self._writer = threading.Thread(target=run, name="pychat-events", daemon=True)
+        self._writer.start()
+
+    def stop_writer(self):
+        self._stop.set()
+        if self._writer:
+            self._writer.join(timeout=5)
+            self._writer = None
+
+    def dump(self, path=None):
+        """Writes every buffered event to `path` (default: pychat-events-<pid>.log). Returns the path."""
+        path = path or f"pychat-events-{os.getpid()}.log"
+        entries = self.snapshot()
+        with open(path, "w") as f:
+            f.write("\n".join(self.format_event(e) for e in entries) + "\n")
+        return path
+
+
+def install_dump_signal(ring=None, signum=getattr(signal, 'SIGUSR1', None)):
+    """Dumps the event ring to disk whenever the process receives SIGUSR1 (POSIX only)."""
+    ring = ring or events
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+
+    def handler(signum, frame):
+        # Write from a thread so the signal handler returns straight away
+        threading.Thread(target=lambda: print(f"Dumped diagnostic events to {ring.dump()}", file=sys.stderr),
+                         daemon=True).start()
+
+    signal.signal(signum, handler)
+    return True
+
+
+def setup_logging(level=logging.WARNING, log_file='pychat.log'):
+    """Configures the 'pychat' entry points to log through a queue.
+
+    Handlers (console and `log_file`) run on a QueueListener thread, so a
+    logging call never waits on file I/O. Returns the listener; stop it on exit
+    to flush the queue.
+    """
+    log_queue = queue.SimpleQueue()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Leave formatting to the listener's handlers (basicConfig would add its own format here)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queue_handler])
+    return listener
+
+
+# Process-wide event ring, configured through the environment:
+#   PYCHAT_EVENT_LOG       file the background writer appends to (unset: memory only)
+#   PYCHAT_EVENT_CAPACITY  number of events kept in memory
+#   PYCHAT_EVENT_SAMPLE    fraction of events recorded
+events = EventRing(
+    capacity=int(os.environ.get("PYCHAT_EVENT_CAPACITY", "10000")),
+    sample_rate=float(os.environ.get("PYCHAT_EVENT_SAMPLE", "1.0")),
+    path=os.environ.get("PYCHAT_EVENT_LOG"),
+)
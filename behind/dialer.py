@@ -0,0 +1,168 @@
+"""Picks a working address for a discovered peer ("happy eyeballs", RFC 8305).
+
+Peers advertise every address they have over mDNS, and on hosts with
+docker bridges, VPNs or stale DHCP leases the first one is often
+unreachable. Instead of trying them one at a time, each with its own
+timeout, the addresses are raced: IPv6 and IPv4 interleaved, a new attempt
+started every ATTEMPT_DELAY seconds (or as soon as the previous one
+fails), and the first address that accepts a TCP connection wins. The
+winner is cached per peer and reused as long as the peer still advertises
+it, so only the first connect pays for the race. A request to the cached
+address that can't connect should report it with unreachable(), so the
+next connect races again instead of reusing a dead route.
+"""
+import time
+import queue
+import socket
+import threading
+from urllib.parse import urlsplit
+
+import logging
+
+from .metrics import registry
+
+logger = logging.getLogger('pychat')
+
+# Seconds the whole race may take before the peer counts as unreachable
+CONNECT_TIMEOUT = 2.0
+# RFC 8305's recommended delay before starting the next attempt
+ATTEMPT_DELAY = 0.25
+
+DIAL_SECONDS = registry.histogram('pychat_dial_seconds', 'Time to find a reachable address for a peer')
+DIALS = registry.counter('pychat_dials_total', 'Peer address lookups', ['result'])
+
+
+def sort_addresses(addresses):
+    """Orders addresses for a race: duplicates dropped, IPv6 and IPv4 alternating, IPv6 first."""
+    v6, v4 = [], []
+    for address in dict.fromkeys(addresses):
+        (v6 if ':' in address else v4).append(address)
+    ordered = []
+    for i in range(max(len(v6), len(v4))):
+        ordered.extend(family[i] for family in (v6, v4) if i < len(family))
+    return ordered
+
+
+def format_host(address):
+    """Host part of a URL for an address: IPv6 goes in brackets, with its zone ID escaped."""
+    if ':' not in address:
+        return address
+    return f"[{address.replace('%', '%25')}]"
+
+
+def peer_url(address, port, path=""):
+    return f"http://{format_host(address)}:{port}{path}"
+
+
+def address_of(url):
+    """The address part of a peer URL made by peer_url() (IPv6 without brackets, zone unescaped)."""
+    host = urlsplit(url).hostname or ''
+    return host.replace('%25', '%')
+
+
+def _attempt(address, port, timeout, results):
+    started = time.perf_counter()
+    try:
+        family, type, proto, _, sockaddr = socket.getaddrinfo(address, port, type=socket.SOCK_STREAM)[0]
+        with socket.socket(family, type, proto) as sock:
+            sock.settimeout(timeout)
+            sock.connect(sockaddr)
+        results.put((address, True, time.perf_counter() - started))
+    except (OSError, ValueError) as e:
+        logger.debug(f"Could not reach {address} port {port}: {e}")
+        results.put((address, False, time.perf_counter() - started))
+
+
+def race(addresses, port, timeout=CONNECT_TIMEOUT, delay=ATTEMPT_DELAY):
+    """Returns the first of `addresses` that accepts a TCP connection on `port`, or None.
+
+    Attempts run in threads; ones still pending when a winner is found are
+    left to finish on their own (their sockets are closed when they do).
+    """
+    candidates = sort_addresses(addresses)
+    results = queue.Queue()
+    deadline = time.monotonic() + timeout
+    next_start = time.monotonic()
+    started = pending = 0
+    while started < len(candidates) or pending:
+        now = time.monotonic()
+        if started < len(candidates) and now >= next_start:
+            threading.Thread(target=_attempt, args=(candidates[started], port, timeout, results),
+                             name="pychat-dial", daemon=True).start()
+            started += 1
+            pending += 1
+            next_start = now + delay
+        if now >= deadline:
+            return None
+        wait = deadline - now
+        if started < len(candidates):
+            wait = min(wait, max(0, next_start - now))
+        try:
+            address, ok, _ = results.get(timeout=wait)
+        except queue.Empty:
+            continue
+        pending -= 1
+        if ok:
+            return address
+        # A failed attempt starts the next one right away
+        next_start = time.monotonic()
+    return None
+
+
+class Dialer:
+    """Races a peer's addresses once and remembers the winner.
+
+    Args:
+        timeout: Seconds a race may take
+        delay: Seconds between starting two attempts
+    """
+
+    def __init__(self, timeout=CONNECT_TIMEOUT, delay=ATTEMPT_DELAY):
+        self.timeout = timeout
+        self.delay = delay
+        self._routes = {}  # peer -> address that won its last race
+        self._lock = threading.Lock()
+
+    def resolve(self, peer, addresses, port):
+        """Returns the address to reach `peer` at, or None if none of `addresses` answered.
+
+        A cached route is reused while the peer still advertises it (also for
+        another port of the same peer, like the workers of a sharded server);
+        otherwise the addresses are raced.
+        """
+        with self._lock:
+            route = self._routes.get(peer)
+        if route in addresses:
+            DIALS.inc(result='cached')
+            return route
+        with DIAL_SECONDS.time():
+            address = race(addresses, port, self.timeout, self.delay)
+        if address is None:
+            DIALS.inc(result='unreachable')
+            logger.warning(f"None of {peer}'s addresses {list(addresses)} answered on port {port}")
+            return None
+        DIALS.inc(result='raced')
+        logger.debug(f"Reaching {peer} at {address}")
+        with self._lock:
+            self._routes[peer] = address
+        return address
+
+    def forget(self, peer):
+        """Drops a peer's cached route, e.g. after it stopped answering there."""
+        with self._lock:
+            self._routes.pop(peer, None)
+
+    def unreachable(self, url):
+        """Drops every cached route to the address of `url` (a request to it couldn't connect)."""
+        address = address_of(url)
+        with self._lock:
+            stale = [peer for peer, route in self._routes.items() if route.lower() == address.lower()]
+            for peer in stale:
+                del self._routes[peer]
+        if stale:
+            DIALS.inc(len(stale), result='forgotten')
+            logger.info(f"{address} stopped answering; racing {', '.join(stale)}'s addresses again next time")
+
+
+# Shared by everything in this process that connects to discovered peers
+dialer = Dialer()
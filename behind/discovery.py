@@ -1,8 +1,10 @@
-import os
 import socket
+import hashlib
 import logging
 from zeroconf import IPVersion
 
+from .dialer import dialer, peer_url
+
 # Import config
 from . import config
 
@@ -10,53 +12,83 @@ from . import config
 logger = logging.getLogger('pychat')
 
 def load_peer_public_key(my_public_key):
-    """Loads the peer's public key from the sharedkeys directory."""
-    os.makedirs(config.SHARED_KEYS_DIR, exist_ok=True)
-    for filename in os.listdir(config.SHARED_KEYS_DIR):
-        if filename.startswith("public_"):
-            try:
-                peer_pk_path = os.path.join(config.SHARED_KEYS_DIR, filename)
-                with open(peer_pk_path, "rb") as f:
-                    peer_pk = f.read()
-                if peer_pk != my_public_key:
-                    logger.debug(f"Found peer public key: {filename}")
-                    return peer_pk
-            except Exception as e:
-                logger.error(f"Error loading peer public key {filename}: {e}")
-    return None
+    """Loads the peer's public key from the sharedkeys directory (through the indexed keystore)."""
+    from .keystore import keystore
+    keystore.ensure_dir(config.SHARED_KEYS_DIR)
+    return keystore.peer_public_key(my_public_key)
+
+def shard_for(chat_code, shards):
+    """Index of the worker that hosts `chat_code` on a sharded server with `shards` workers."""
+    digest = hashlib.sha256(chat_code.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
 
 class ServiceListener:
     def __init__(self):
         self.found_services = {}
+        # Service name -> chat code it was stored under, so removals find the entry
+        self._chat_codes = {}
+        # Sharded servers (behind/cluster.py) host any chat code, so they are kept by service name
+        self.sharded_services = {}
 
     def remove_service(self, zeroconf, type, name):
         logger.debug(f"Service {name} removed")
-        if name in self.found_services:
-            del self.found_services[name]
+        chat_code = self._chat_codes.pop(name, None)
+        # Only if no newer service has taken over the chat code since
+        if chat_code is not None and chat_code not in self._chat_codes.values():
+            self.found_services.pop(chat_code, None)
+        self.sharded_services.pop(name, None)
+        dialer.forget(name)
+
+    def _store(self, name, info):
+        if b'shards' in info.properties:
+            self.sharded_services[name] = info
+        else:
+            chat_code = info.properties.get(b'chat_code', b'').decode('utf-8')
+            self.found_services[chat_code] = info
+            self._chat_codes[name] = chat_code
 
     def add_service(self, zeroconf, type, name):
         info = zeroconf.get_service_info(type, name)
         if info:
-            chat_code = info.properties.get(b'chat_code', b'').decode('utf-8')
-            self.found_services[chat_code] = info
+            self._store(name, info)
             logger.debug(f"Service {name} added, service info: {info}")
 
     def update_service(self, zeroconf, type, name):
         """Handle service updates - required by zeroconf."""
         info = zeroconf.get_service_info(type, name)
         if info:
-            chat_code = info.properties.get(b'chat_code', b'').decode('utf-8')
-            self.found_services[chat_code] = info
+            self._store(name, info)
             logger.debug(f"Service {name} updated, new info: {info}")
 
     def get_address(self, chat_code):
+        """Returns the URL of the server hosting `chat_code`, or None.
+
+        All of the service's IPv4 and IPv6 addresses are raced (see
+        behind/dialer.py) and the one that answers first is used; if none
+        does, the first advertised address is returned as before.
+        """
         if chat_code in self.found_services:
             info = self.found_services[chat_code]
-            addresses = info.addresses_by_version(IPVersion.V4Only)
-            if addresses:
-                return f"http://{socket.inet_ntoa(addresses[0])}:{info.port}"
+            address = self._reachable(info.name, info, info.port)
+            if address:
+                return peer_url(address, info.port)
+        # Fall back to a sharded server, on the worker that owns the room
+        for name, info in list(self.sharded_services.items()):
+            ports = [int(p) for p in info.properties[b'shards'].decode('utf-8').split(',') if p]
+            if not ports:
+                continue
+            port = ports[shard_for(chat_code, len(ports))]
+            address = self._reachable(name, info, port)
+            if address:
+                return peer_url(address, port, f"/rooms/{chat_code}")
         return None
 
+    def _reachable(self, name, info, port):
+        addresses = info.parsed_scoped_addresses(IPVersion.All)
+        if not addresses:
+            return None
+        return dialer.resolve(name, addresses, port) or addresses[0]
+
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
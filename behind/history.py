@@ -0,0 +1,123 @@
+import os
+import hashlib
+
+# Records in a chat log are raw payloads terminated by a null byte
+RECORD_SEPARATOR = b'\0'
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def record_id(record):
+    """Returns the stable ID of a stored record (hex SHA-256 of its raw bytes)."""
+    return hashlib.sha256(record).hexdigest()
+
+
+def log_size(path):
+    """Returns the size of a chat log in bytes, or 0 if it doesn't exist yet."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def last_record_end(path, end, block_size=READ_BLOCK_SIZE):
+    """Returns the offset just past the last complete record that ends at or before `end` (0 if none).
+
+    A record still being appended has no separator yet, so this is where a
+    reader can safely stop while the log grows.
+    """
+    with open(path, "rb") as f:
+        pos = end
+        while pos > 0:
+            read_from = max(0, pos - block_size)
+            f.seek(read_from)
+            cut = f.read(pos - read_from).rfind(RECORD_SEPARATOR)
+            if cut != -1:
+                return read_from + cut + 1
+            pos = read_from
+    return 0
+
+
+def record_ending_at(path, end):
+    """Returns the record that ends (separator included) exactly at byte offset `end`, or None."""
+    if end <= 0:
+        return None
+    _, records = read_records_before(path, end, 1)
+    if records and records[-1][0] + len(records[-1][1]) + 1 == end:
+        return records[-1][1]
+    return None
+
+
+def read_records_before(path, end, count, block_size=READ_BLOCK_SIZE):
+    """Reads up to `count` records that come before byte offset `end`.
+
+    The file is read backwards in blocks, so the cost depends on how much is
+    returned and not on how long the log is.
+
+    Returns:
+        (start, records): `records` is a list of (offset, data) tuples in file
+        order and `start` is the offset to pass back as `end` for the next page.
+    """
+    records = []
+    if not os.path.exists(path):
+        return 0, records
+
+    with open(path, "rb") as f:
+        pos = min(end, os.fstat(f.fileno()).st_size)
+        tail = b''  # bytes between pos and the oldest record returned so far
+        while len(records) < count:
+            if pos > 0:
+                read_from = max(0, pos - block_size)
+                f.seek(read_from)
+                tail = f.read(pos - read_from) + tail
+                pos = read_from
+
+            while len(records) < count:
+                body = tail[:-1] if tail.endswith(RECORD_SEPARATOR) else tail
+                cut = body.rfind(RECORD_SEPARATOR)
+                if cut == -1 and pos > 0:
+                    break  # record starts in an earlier block
+                if body[cut + 1:]:
+                    records.append((pos + cut + 1, body[cut + 1:]))
+                tail = tail[:cut + 1]
+                if cut == -1:
+                    break
+
+            if pos == 0 and not tail:
+                break
+
+    records.reverse()
+    return pos + len(tail), records
+
+
+def read_records_after(path, start, count, block_size=READ_BLOCK_SIZE):
+    """Reads up to `count` complete records starting at byte offset `start`.
+
+    Returns:
+        (end, records): `records` is a list of (offset, data) tuples in file
+        order and `end` is the offset just past the last record returned.
+    """
+    records = []
+    if not os.path.exists(path):
+        return start, records
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start  # file offset of buf[0]
+        buf = b''
+        while len(records) < count:
+            block = f.read(block_size)
+            if not block:
+                break
+            buf += block
+            i = 0
+            while len(records) < count:
+                cut = buf.find(RECORD_SEPARATOR, i)
+                if cut == -1:
+                    break
+                if cut > i:
+                    records.append((pos + i, buf[i:cut]))
+                i = cut + 1
+            buf = buf[i:]
+            pos += i
+
+    return pos, records
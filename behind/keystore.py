@@ -0,0 +1,260 @@
+"""Key files in keys/ and sharedkeys/, indexed by chat code and fingerprint.
+
+Key bytes are cached in memory and revalidated with one stat() of the file
+(mtime and size), so repeated loads (e.g. the private key on every
+.history) don't read the disk, and a key replaced on disk is picked up on
+the next load. Lookups by chat code or fingerprint go through an index that
+is only rebuilt when a directory's mtime changes; the index is also kept on
+disk so a rebuild doesn't have to read and hash unchanged files.
+"""
+import os
+import json
+import threading
+
+import logging
+
+from . import config
+from .metrics import registry
+from .peers import fingerprint
+
+logger = logging.getLogger('pychat')
+
+# Kept in a subdirectory so writing it doesn't change the mtime of keys/ itself
+INDEX_DIRNAME = ".keystore"
+INDEX_FILENAME = "index.json"
+INDEX_VERSION = 1
+KEY_SUFFIX = ".key"
+# Files in sharedkeys/ that hold peers' public keys
+SHARED_PREFIX = "public_"
+KINDS = ('private', 'public', 'index', 'cache')
+
+KEY_READS = registry.counter('pychat_keystore_reads_total', 'Key loads through the keystore', ['result'])
+KEY_RESCANS = registry.counter('pychat_keystore_rescans_total', 'Key directories rescanned after they changed')
+
+
+def parse_key_filename(filename):
+    """Returns (chat_code, kind) for a key file name like 'team_private.key', or (None, None)."""
+    if not filename.endswith(KEY_SUFFIX):
+        return None, None
+    chat_code, _, kind = filename[:-len(KEY_SUFFIX)].rpartition('_')
+    if chat_code and kind in KINDS:
+        return chat_code, kind
+    return None, None
+
+
+class KeyStore:
+    """Cached, indexed access to the key directories.
+
+    Args:
+        keys_dir: This host's keys (<chat code>_<kind>.key)
+        shared_dir: Public keys of peers (public_*)
+    """
+
+    def __init__(self, keys_dir=config.KEYS_DIR, shared_dir=config.SHARED_KEYS_DIR):
+        self.keys_dir = keys_dir
+        self.shared_dir = shared_dir
+        self.index_path = os.path.join(keys_dir, INDEX_DIRNAME, INDEX_FILENAME)
+        self._lock = threading.RLock()
+        self._ensured = set()
+        self._cache = {}  # path -> (mtime_ns, size, key bytes)
+        self._entries = {}  # path -> {'mtime_ns', 'size', 'chat_code', 'kind', 'fingerprint'}
+        self._by_fingerprint = {}  # fingerprint -> path
+        self._by_chat = {}  # (chat code, kind) -> path
+        self._peers = []  # paths of shared keys, newest first
+        self._dir_mtimes = {}  # directory -> mtime_ns it was last scanned at
+        self._index_loaded = False
+
+    # --- Paths and files ---
+
+    def ensure_dir(self, directory):
+        """Creates `directory` the first time it's asked for; later calls cost nothing."""
+        if directory in self._ensured:
+            return
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+            os.chmod(directory, 0o755)
+        self._ensured.add(directory)
+
+    def path(self, chat_code, kind):
+        return os.path.join(self.keys_dir, f"{chat_code}_{kind}{KEY_SUFFIX}")
+
+    def read(self, path):
+        """Returns the bytes of a key file, from memory if the file hasn't changed.
+
+        Raises:
+            FileNotFoundError: The file doesn't exist
+        """
+        st = os.stat(path)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                KEY_READS.inc(result='hit')
+                return cached[2]
+        with open(path, "rb") as f:
+            key = f.read()
+        KEY_READS.inc(result='miss')
+        with self._lock:
+            self._cache[path] = (st.st_mtime_ns, st.st_size, key)
+        return key
+
+    def write(self, path, key):
+        """Writes a key file (0600, atomically) and caches it."""
+        self.ensure_dir(os.path.dirname(path))
+        tmp = path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+        os.replace(tmp, path)
+        st = os.stat(path)
+        with self._lock:
+            self._cache[path] = (st.st_mtime_ns, st.st_size, key)
+        return path
+
+    def get(self, chat_code, kind):
+        """Returns a chat's key of the given kind ('private', 'public', ...), or None."""
+        try:
+            return self.read(self.path(chat_code, kind))
+        except FileNotFoundError:
+            return None
+
+    def save(self, chat_code, kind, key):
+        return self.write(self.path(chat_code, kind), key)
+
+    # --- Index ---
+
+    def _load_index(self):
+        self._index_loaded = True
+        try:
+            with open(self.index_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable key index {self.index_path}: {e}")
+            return
+        if snapshot.get('version') == INDEX_VERSION:
+            self._entries = snapshot.get('entries', {})
+
+    def _save_index(self):
+        if not os.path.isdir(self.keys_dir):
+            return
+        os.makedirs(os.path.dirname(self.index_path), mode=0o700, exist_ok=True)
+        tmp = self.index_path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({'version': INDEX_VERSION, 'entries': self._entries}, f)
+        os.replace(tmp, self.index_path)
+
+    def _scan(self, directory, shared):
+        """Brings the entries of one directory up to date; only new or changed files are read."""
+        KEY_RESCANS.inc()
+        changed = False
+        seen = set()
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if shared:
+                if not name.startswith(SHARED_PREFIX):
+                    continue
+                chat_code, kind = None, 'peer'
+            else:
+                chat_code, kind = parse_key_filename(name)
+                if kind is None:
+                    continue
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+            entry = self._entries.get(path)
+            if entry and entry['mtime_ns'] == st.st_mtime_ns and entry['size'] == st.st_size:
+                continue
+            try:
+                key_fingerprint = fingerprint(self.read(path))
+            except OSError as e:
+                logger.error(f"Error reading key {path}: {e}")
+                continue
+            self._entries[path] = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                                   'chat_code': chat_code, 'kind': kind, 'fingerprint': key_fingerprint}
+            changed = True
+        prefix = os.path.join(directory, '')
+        for path in [p for p in self._entries if p.startswith(prefix) and p not in seen]:
+            del self._entries[path]
+            self._cache.pop(path, None)
+            changed = True
+        return changed
+
+    def _refresh(self):
+        """Rescans the directories whose mtime changed (a key was added, removed or replaced)."""
+        with self._lock:
+            if not self._index_loaded:
+                self._load_index()
+            rebuild = dirty = False
+            for directory, shared in ((self.keys_dir, False), (self.shared_dir, True)):
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    mtime = None
+                if self._dir_mtimes.get(directory, -1) != mtime:
+                    # Taken before the scan, so a key written during it triggers another one
+                    self._dir_mtimes[directory] = mtime
+                    dirty |= self._scan(directory, shared)
+                    rebuild = True
+            if rebuild:
+                self._by_fingerprint = {e['fingerprint']: p for p, e in self._entries.items()}
+                self._by_chat = {(e['chat_code'], e['kind']): p for p, e in self._entries.items() if e['chat_code']}
+                self._peers = sorted((p for p, e in self._entries.items() if e['kind'] == 'peer'),
+                                     key=lambda p: self._entries[p]['mtime_ns'], reverse=True)
+            if dirty:
+                try:
+                    self._save_index()
+                except OSError as e:
+                    logger.debug(f"Could not save key index: {e}")
+
+    def find(self, key_fingerprint):
+        """Returns the key with the given fingerprint (see peers.fingerprint), or None."""
+        self._refresh()
+        path = self._by_fingerprint.get(key_fingerprint)
+        if path is None:
+            return None
+        try:
+            key = self.read(path)
+        except FileNotFoundError:
+            return None
+        # An in-place rewrite keeps the directory mtime; don't hand out a different key
+        return key if fingerprint(key) == key_fingerprint else None
+
+    def chat_codes(self, kind='private'):
+        """Chat codes that have a key of the given kind."""
+        self._refresh()
+        return sorted(code for code, k in self._by_chat if k == kind)
+
+    def peer_public_key(self, my_public_key):
+        """Returns the newest peer key in sharedkeys/ that isn't our own, or None."""
+        self._refresh()
+        mine = fingerprint(my_public_key) if my_public_key else None
+        for path in self._peers:
+            if self._entries[path]['fingerprint'] == mine:
+                continue
+            try:
+                key = self.read(path)
+            except OSError as e:
+                logger.error(f"Error loading peer public key {path}: {e}")
+                continue
+            if key != my_public_key:
+                logger.debug(f"Found peer public key: {os.path.basename(path)}")
+                return key
+        return None
+
+    def invalidate(self):
+        """Drops cached keys and forces a rescan on the next lookup."""
+        with self._lock:
+            self._cache.clear()
+            self._dir_mtimes.clear()
+
+
+# Shared store for this process's key directories
+keystore = KeyStore()
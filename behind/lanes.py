@@ -0,0 +1,250 @@
+"""Traffic lanes: interactive messages, control requests and bulk transfers don't queue behind each other.
+
+Every request a room serves is put in one of three lanes:
+
+- interactive: sending a message, polling for new ones, pushes to clients
+- control: /connect, /heartbeat, key exchange, metrics and the like
+- bulk: whole-history reads, backfill pages, /snapshot and file chunks
+
+Inbound, a LaneScheduler bounds how many requests of each lane run at once
+out of a shared number of slots. When slots are scarce, waiting
+interactive requests are admitted first, and bulk can never hold more than
+its own small share, so a client pulling a big history or many clients
+reconnecting at once don't delay chat. A lane whose queue is full turns
+new requests away with 503 and Retry-After instead of piling up threads.
+
+Outbound, OutboundLanes runs pushes to clients on a bounded pool per lane
+(interactive message pushes, control announcements, bulk catch-up replays)
+instead of a new thread per push, and LaneSessions gives a client one HTTP
+session per lane so a bulk download never shares connections with a send.
+"""
+import time
+import json
+import threading
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import logging
+
+from .metrics import registry
+
+logger = logging.getLogger('pychat')
+
+# Highest priority first
+LANES = ('interactive', 'control', 'bulk')
+# Requests of all lanes that run at once
+DEFAULT_SLOTS = 32
+# lane -> (requests running at once, requests waiting before new ones are rejected)
+DEFAULT_LIMITS = {
+    'interactive': (32, 256),
+    'control': (8, 64),
+    'bulk': (4, 16),
+}
+# Worker threads per lane for pushes to clients
+DEFAULT_OUTBOUND_WORKERS = {
+    'interactive': 32,
+    'control': 4,
+    'bulk': 4,
+}
+# Seconds a rejected client is told to wait
+RETRY_AFTER = 1
+
+LANE_QUEUE_DEPTH = registry.gauge('pychat_lane_queue_depth', 'Work waiting in each traffic lane', ['lane', 'direction'])
+LANE_ACTIVE = registry.gauge('pychat_lane_active', 'Work running in each traffic lane', ['lane', 'direction'])
+LANE_WAIT_SECONDS = registry.histogram('pychat_lane_wait_seconds', 'Time requests waited for a slot in their lane', ['lane'])
+LANE_REJECTED = registry.counter('pychat_lane_rejected_total', 'Requests turned away because their lane was full', ['lane'])
+
+_INTERACTIVE_ROUTES = {('POST', '/message'), ('POST', '/client_message')}
+
+
+def _cursor(args, name):
+    try:
+        return float(args[name][0])
+    except (KeyError, ValueError):
+        return 0
+
+
+def classify(method, path, query=""):
+    """Returns the lane of a request to a room's routes."""
+    if (method, path) in _INTERACTIVE_ROUTES:
+        return 'interactive'
+    if path == '/messages':
+        # Polls for what's new are interactive; reads from the start of the log
+        # (no cursor, since=0 or after=0) return the whole history and are bulk
+        args = parse_qs(query)
+        if _cursor(args, 'since') > 0 or _cursor(args, 'after') > 0:
+            return 'interactive'
+        return 'bulk'
+    if path == '/snapshot' or (path.startswith('/files/') and '/chunks/' in path):
+        return 'bulk'
+    return 'control'
+
+
+class LaneFull(Exception):
+    """The lane's queue is full; try again later."""
+
+
+class LaneScheduler:
+    """Admits requests to a shared pool of slots, per lane and by priority.
+
+    Args:
+        slots: Requests of all lanes that may run at once
+        limits: lane -> (max running, max waiting); see DEFAULT_LIMITS
+    """
+
+    def __init__(self, slots=DEFAULT_SLOTS, limits=None):
+        self.slots = slots
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self._active = {lane: 0 for lane in LANES}
+        self._waiting = {lane: 0 for lane in LANES}
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def _can_run(self, lane):
+        if self._running >= self.slots or self._active[lane] >= self.limits[lane][0]:
+            return False
+        # A free slot goes to a waiting request of a higher lane that can take it
+        for other in LANES[:LANES.index(lane)]:
+            if self._waiting[other] and self._active[other] < self.limits[other][0]:
+                return False
+        return True
+
+    def acquire(self, lane):
+        """Blocks until `lane` may run another request. Returns the seconds waited.
+
+        Raises:
+            LaneFull: Too many requests are already waiting in the lane
+        """
+        started = time.perf_counter()
+        with self._cond:
+            if not self._can_run(lane):
+                if self._waiting[lane] >= self.limits[lane][1]:
+                    LANE_REJECTED.inc(lane=lane)
+                    raise LaneFull(lane)
+                self._waiting[lane] += 1
+                LANE_QUEUE_DEPTH.inc(lane=lane, direction='inbound')
+                try:
+                    while not self._can_run(lane):
+                        self._cond.wait()
+                finally:
+                    self._waiting[lane] -= 1
+                    LANE_QUEUE_DEPTH.dec(lane=lane, direction='inbound')
+            self._active[lane] += 1
+            self._running += 1
+        LANE_ACTIVE.inc(lane=lane, direction='inbound')
+        waited = time.perf_counter() - started
+        LANE_WAIT_SECONDS.observe(waited, lane=lane)
+        return waited
+
+    def release(self, lane):
+        with self._cond:
+            self._active[lane] -= 1
+            self._running -= 1
+            self._cond.notify_all()
+        LANE_ACTIVE.dec(lane=lane, direction='inbound')
+
+
+class _Released:
+    """Response iterable that frees the lane slot once the body has been sent (or abandoned)."""
+
+    def __init__(self, iterable, release):
+        self._iterable = iterable
+        self._release = release
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._release()
+
+
+class LaneMiddleware:
+    """WSGI middleware that runs each request in its lane's slot; installed on a room's Flask app."""
+
+    def __init__(self, app, scheduler):
+        self.app = app
+        self.scheduler = scheduler
+
+    def __call__(self, environ, start_response):
+        lane = classify(environ.get('REQUEST_METHOD', 'GET'), environ.get('PATH_INFO', ''),
+                        environ.get('QUERY_STRING', ''))
+        try:
+            self.scheduler.acquire(lane)
+        except LaneFull:
+            start_response('503 Service Unavailable', [('Content-Type', 'application/json'),
+                                                       ('Retry-After', str(RETRY_AFTER))])
+            return [json.dumps({'error': f"{lane} lane is full", 'retry_after': RETRY_AFTER}).encode('utf-8')]
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.scheduler.release(lane)
+
+        try:
+            # Streamed bodies (e.g. /snapshot) keep the slot until they've been sent
+            return _Released(self.app(environ, start_response), release)
+        except BaseException:
+            release()
+            raise
+
+
+class OutboundLanes:
+    """A bounded worker pool per lane for requests this server makes to its clients.
+
+    Args:
+        workers: lane -> worker threads; see DEFAULT_OUTBOUND_WORKERS
+    """
+
+    def __init__(self, workers=None):
+        workers = dict(DEFAULT_OUTBOUND_WORKERS, **(workers or {}))
+        self._pools = {lane: ThreadPoolExecutor(max_workers=workers[lane], thread_name_prefix=f"pychat-{lane}")
+                       for lane in LANES}
+
+    def submit(self, lane, fn, *args):
+        """Runs fn(*args) on the lane's pool. Returns a Future."""
+        LANE_QUEUE_DEPTH.inc(lane=lane, direction='outbound')
+
+        def run():
+            LANE_QUEUE_DEPTH.dec(lane=lane, direction='outbound')
+            LANE_ACTIVE.inc(lane=lane, direction='outbound')
+            try:
+                return fn(*args)
+            finally:
+                LANE_ACTIVE.dec(lane=lane, direction='outbound')
+
+        future = self._pools[lane].submit(run)
+        # Work cancelled by shutdown() never runs, so it leaves the queue here
+        future.add_done_callback(
+            lambda f: f.cancelled() and LANE_QUEUE_DEPTH.dec(lane=lane, direction='outbound'))
+        return future
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class LaneSessions:
+    """One requests session per lane, for a client of a room.
+
+    Sessions keep their own connection pools, so a snapshot download or a
+    file transfer never holds the connection a message send would reuse.
+    """
+
+    def __init__(self, configure=None):
+        self.interactive = requests.Session()
+        self.control = requests.Session()
+        self.bulk = requests.Session()
+        if configure:
+            for session in (self.interactive, self.control, self.bulk):
+                configure(session)
+
+    def close(self):
+        for session in (self.interactive, self.control, self.bulk):
+            session.close()
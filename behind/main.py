@@ -2,8 +2,10 @@ import os
 import time
 import threading
 import base64
+import hashlib
 import random
 import shutil
+from urllib.parse import urlsplit
 from quantcrypt.cipher import Krypton
 from quantcrypt.kem import MLKEM_1024
 
@@ -15,8 +17,23 @@ from .network import (
     SERVER_PORT,
     NetworkManager,
 )
-from .config import KEYS_DIR, CHATS_DIR, initialize_directories
+from .config import KEYS_DIR, CHATS_DIR, TRANSFERS_DIR, DOWNLOADS_DIR, initialize_directories
 from .discovery import ServiceListener, get_local_ip
+from .dialer import dialer
+from .metrics import registry
+from .tracing import tracer, trace_id
+from .diagnostics import events, setup_logging, install_dump_signal
+from . import transfer
+from .compression import compress, decompress
+from .search import SearchIndex, load_or_create_key
+from .cache import decrypt_cache
+from .peers import PeerKeyStore, fingerprint
+from .keystore import keystore
+from .multicast import MulticastReceiver
+from .state import DEFAULT_LEASE
+from .replica import LogReplica, replica_path
+from .lanes import LaneSessions
+from .history import read_records_after
 import logging
 
 # Set up logging
@@ -29,20 +46,28 @@ name = ""
 # (These remain here as they involve direct user interaction via print)
 
 kem = MLKEM_1024()
+
+ENCRYPT_SECONDS = registry.histogram('pychat_encrypt_seconds', 'Time to encrypt one message')
+DECRYPT_SECONDS = registry.histogram('pychat_decrypt_seconds', 'Time to decrypt one message')
+DECRYPT_FAILURES = registry.counter('pychat_decrypt_failures_total', 'Messages that could not be decrypted')
 # hashes of encrypted payloads the local host wrote (so the file-watcher can ignore them)
 sent_message_hashes = set()
+# SearchIndex of the current chat, opened in main()
+search_index = None
+# Keys of the partner we encrypt for (client mode); updated by the key exchange and /peer_key pushes,
+# though a changed key is only used once the user .trusts it
+partner_keys = PeerKeyStore()
+SERVER_PEER = 'server'
 
 def get_key_path(filename, keys_dir):
     """Get absolute path for a key file, ensuring the directory exists."""
-    ensure_directory(keys_dir)
+    keystore.ensure_dir(keys_dir)
     return os.path.join(keys_dir, filename)
 
 def load_private_key(key_path):
-    """Loads the user's private key from a given path."""
+    """Loads the user's private key from a given path (cached until the file changes)."""
     try:
-        with open(key_path, "rb") as f:
-            private_key = f.read()
-        return private_key
+        return keystore.read(key_path)
     except FileNotFoundError:
         print(f"Error: Private key file not found at '{key_path}'.")
         return None
@@ -54,10 +79,7 @@ def save_key(key, key_type, keys_dir):
     """Save a key to the keys directory."""
     key_path = get_key_path(f"{key_type}.key", keys_dir)
     try:
-        with open(key_path, 'wb') as f:
-            f.write(key)
-        os.chmod(key_path, 0o600)  # Secure permissions
-        return key_path
+        return keystore.write(key_path, key)  # Written 0600
     except Exception as e:
         print(f"Error saving {key_type} key: {e}")
         return None
@@ -66,6 +88,14 @@ def save_key(key, key_type, keys_dir):
 
 def encrypt_message(message, public_key):
     """Encrypts a message and returns the combined encapsulated key and ciphertext."""
+    start = time.time()
+    with ENCRYPT_SECONDS.time():
+        payload = _encrypt_message(message, public_key)
+    if tracer.enabled:
+        tracer.record('client.encrypt', start, time.time(), trace_id(payload), size=len(payload))
+    return payload
+
+def _encrypt_message(message, public_key):
     encaps, shared = kem.encaps(public_key)
     # Krypton requires a 64-byte secret; expand the KEM shared secret using SHA3_512
     from Cryptodome.Hash import SHA3_512
@@ -73,7 +103,8 @@ def encrypt_message(message, public_key):
     # Krypton usage: create instance with 64-byte shared secret
     k = Krypton(key64)
     k.begin_encryption()
-    ct = k.encrypt(message.encode('utf-8'))
+    # Compress before encrypting; ciphertext doesn't compress
+    ct = k.encrypt(compress(message.encode('utf-8')))
     verif = k.finish_encryption()
     payload = encaps + verif + ct
     # return raw payload (server stores raw bytes; transport uses base64)
@@ -87,6 +118,47 @@ def decrypt_message(encrypted_data, private_key, skip_errors=False):
         private_key: The private key to use for decryption
         skip_errors: If True, returns None on error instead of raising
     """
+    cache_key = _cache_key_of(encrypted_data, private_key)
+    if cache_key:
+        found, cached = decrypt_cache.get(cache_key)
+        if found and (cached is not None or skip_errors):
+            return cached
+
+    start = time.perf_counter()
+    wall_start = time.time()
+    try:
+        result = _decrypt_message(encrypted_data, private_key, skip_errors)
+    except Exception:
+        DECRYPT_FAILURES.inc()
+        raise
+    if cache_key:
+        decrypt_cache.put(cache_key, result)
+    DECRYPT_SECONDS.observe(time.perf_counter() - start)
+    if tracer.enabled:
+        tracer.record('client.decrypt', wall_start, time.time(), _trace_id_of(encrypted_data), ok=result is not None)
+    if result is None:
+        DECRYPT_FAILURES.inc()
+    return result
+
+def _cache_key_of(encrypted_data, private_key):
+    if not decrypt_cache.enabled or not private_key:
+        return None
+    try:
+        if isinstance(encrypted_data, (bytes, bytearray)):
+            return decrypt_cache.cache_key(bytes(encrypted_data), private_key)
+        return decrypt_cache.cache_key(base64.b64decode(encrypted_data), private_key)
+    except Exception:
+        return None
+
+def _trace_id_of(encrypted_data):
+    try:
+        if isinstance(encrypted_data, (bytes, bytearray)):
+            return trace_id(bytes(encrypted_data))
+        return trace_id(base64.b64decode(encrypted_data))
+    except Exception:
+        return None
+
+def _decrypt_message(encrypted_data, private_key, skip_errors):
     try:
         # normalize to raw bytes
         try:
@@ -133,7 +205,7 @@ def decrypt_message(encrypted_data, private_key, skip_errors=False):
 
             # Decrypt the actual message
             pt = k.decrypt(ct)
-            return pt.decode('utf-8')
+            return decompress(pt).decode('utf-8')
 
         except Exception as e:
             logger.debug(f"Decryption error: {e}, message length: {len(raw)} bytes")
@@ -146,6 +218,48 @@ def decrypt_message(encrypted_data, private_key, skip_errors=False):
         if not skip_errors:
             raise
 
+def index_message(record, text):
+    """Adds a decrypted message to the chat's search index."""
+    if search_index is None or not text:
+        return
+    try:
+        search_index.add(record, text)
+    except Exception as e:
+        logger.error(f"Error updating search index: {e}")
+
+def search_history(query):
+    """Prints the newest messages matching `query` from the search index."""
+    if search_index is None:
+        print("Search is not available.")
+        return
+    results = search_index.search(query)
+    if not results:
+        print(f"No messages match '{query}'.")
+        return
+    print(f"\n--- {len(results)} most recent matches for '{query}' ---")
+    for result in reversed(results):
+        print(result['text'])
+    print("--- End of Results ---")
+
+def trust_key(peer_keys, key_fingerprint):
+    """Switches to the partner key with this fingerprint (after the user checked it out of band)."""
+    key_fingerprint = key_fingerprint.strip()
+    if not key_fingerprint:
+        trusted = peer_keys.trusted()
+        print(f"Encrypting for {fingerprint(trusted) if trusted else 'nobody yet'}.")
+    elif peer_keys.trust(key_fingerprint):
+        print(f"Now encrypting for {key_fingerprint}.")
+    else:
+        print(f"No partner key has the fingerprint {key_fingerprint}.")
+
+def announce_peer_key(peer_keys, peer_id, key):
+    """Tells the host user about a key registered through /public_key, and whether it is used."""
+    if key == peer_keys.trusted():
+        display_message(f"[System] {peer_id} connected (key {fingerprint(key)})")
+    else:
+        display_message(f"[System] {peer_id} registered a new key {fingerprint(key)}. "
+                        f"Check it with your partner, then type '.trust {fingerprint(key)}' to use it")
+
 # --- Listener Functions ---
 
 def display_message(text):
@@ -156,7 +270,7 @@ def display_message(text):
     """
     try:
         # Log the message
-        logger.debug(f"Displaying message: {text}")
+        events.record("display", length=len(text))
         
         # Get the current input line to preserve it
         try:
@@ -187,7 +301,7 @@ def display_message(text):
         print('> ', end='', flush=True)
         print('> ', end='', flush=True)
 
-def client_message_listener(stop_event, server_url, private_key, client_name):
+def client_message_listener(stop_event, server_url, private_key, client_name, replica=None, sessions=None):
     """Poll the server for new messages and display them.
     
     Args:
@@ -195,12 +309,59 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
         server_url: Base URL of the server
         private_key: Private key for decrypting messages
         client_name: Name of the current client for filtering own messages
+        replica: LogReplica of the room's log; kept in sync, and polls only fetch what it lacks
+        sessions: LaneSessions for requests to the server (polls interactive, registration control)
     """
+    sessions = sessions or LaneSessions()
     last_poll = time.time()
     consecutive_errors = 0
     max_consecutive_errors = 5
     seen_messages = set()
-    
+
+    def handle_pushed(encrypted_message, source):
+        """Decrypts, indexes and shows a record the server pushed (over HTTP or multicast)."""
+        events.record("listener.push", size=len(encrypted_message), source=source)
+        tid = trace_id(encrypted_message) if tracer.enabled else None
+        with tracer.span('client.receive_push', tid):
+            decrypted = decrypt_message(encrypted_message, private_key, skip_errors=True)
+        if decrypted:
+            index_message(encrypted_message, decrypted)
+            if not decrypted.startswith(f"{client_name}:"):
+                events.record("listener.display", source=source)
+                with tracer.span('client.display', tid):
+                    display_message(decrypted)
+            else:
+                events.record("listener.own_message")
+        else:
+            events.record("listener.undecryptable", source=source)
+
+    def receive(encrypted_message, source, offset=None):
+        """Routes a pushed record through the replica, which fills any gap before it first."""
+        if not replica:
+            handle_pushed(encrypted_message, source)
+            return
+        for _, record in replica.receive(offset, encrypted_message):
+            handle_pushed(record, source)
+
+    def start_multicast_receiver():
+        """Joins the room's multicast group if the server sends one; returns the receiver or None."""
+        try:
+            response = sessions.control.get(f"{server_url}/multicast", timeout=2)
+            if response.status_code != 200:
+                return None
+            info = response.json()
+            receiver = MulticastReceiver(
+                info['chat_code'], server_url,
+                lambda start, record: receive(record, "multicast", start),
+                info['log_end'], group=(info['group'], info['port']),
+            )
+            receiver.start()
+            logger.debug(f"Receiving multicast from {info['group']}:{info['port']}")
+            return receiver
+        except Exception as e:
+            logger.warning(f"Multicast delivery unavailable, using pushes: {e}")
+            return None
+
     # Start a simple HTTP server to receive messages from other clients
     def start_message_receiver():
         from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -221,18 +382,7 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
                         encrypted_message_b64 = data.get('message')
                         if encrypted_message_b64:
                             try:
-                                logger.debug(f"Received encrypted message (b64): {encrypted_message_b64[:50]}...")
-                                encrypted_message = base64.b64decode(encrypted_message_b64)
-                                logger.debug(f"Decoded message length: {len(encrypted_message)} bytes")
-                                decrypted = decrypt_message(encrypted_message, private_key, skip_errors=True)
-                                if decrypted:
-                                    if not decrypted.startswith(f"{client_name}:"):
-                                        logger.debug(f"Displaying decrypted message: {decrypted}")
-                                        display_message(decrypted)
-                                    else:
-                                        logger.debug("Skipping own message")
-                                else:
-                                    logger.debug("Failed to decrypt message")
+                                receive(base64.b64decode(encrypted_message_b64), "push", data.get('offset'))
                             except Exception as e:
                                 logger.error(f"Error processing message: {e}")
                     except Exception as e:
@@ -240,6 +390,23 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
                     
                     self._set_headers()
                     self.wfile.write(json.dumps({"status": "ok"}).encode())
+                elif self.path == '/peer_key':
+                    # The server changed its key (e.g. after a restart). Anyone on the LAN can post here, so
+                    # only announcements from our server count, and the user has to .trust the new key
+                    if self.client_address[0] != urlsplit(server_url).hostname:
+                        logger.warning(f"Ignoring key announcement from {self.client_address[0]}")
+                        self.send_error(403, "Not our server")
+                        return
+                    try:
+                        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                        key = base64.b64decode(data['public_key'])
+                        if partner_keys.set(SERVER_PEER, key) and key != partner_keys.trusted():
+                            display_message(f"[System] Partner's key changed to {fingerprint(key)}. "
+                                            f"Check it with them, then type '.trust {fingerprint(key)}' to use it")
+                    except Exception as e:
+                        logger.error(f"Error handling key announcement: {e}")
+                    self._set_headers()
+                    self.wfile.write(json.dumps({"status": "ok"}).encode())
                 else:
                     self.send_error(404, "Not Found")
         
@@ -258,44 +425,92 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
     
     # Start the message receiver
     start_message_receiver()
-    
+
+    # With multicast the server doesn't need to push to us; the receiver repairs gaps from the log
+    multicast_receiver = start_multicast_receiver() if os.environ.get("PYCHAT_MULTICAST") == "1" else None
+
+    # Get the local IP address for callback
+    callback_url = f"http://{get_local_ip()}:{SERVER_PORT + 1}"
+
+    def register():
+        # With a lease the server stops pushing to us if we vanish, instead of timing out on every message
+        try:
+            sessions.control.post(
+                f"{server_url}/connect",
+                json={'url': callback_url, 'lease': DEFAULT_LEASE},
+                timeout=2
+            )
+            logger.debug(f"Registered client with server: {callback_url}/client_message")
+        except Exception as e:
+            logger.error(f"Failed to register client with server: {e}")
+
+    def send_heartbeat():
+        try:
+            response = sessions.control.post(f"{server_url}/heartbeat", json={'url': callback_url}, timeout=2)
+            if response.status_code == 404:
+                # The server forgot us (restart, or we were away longer than the grace period)
+                register()
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Heartbeat to {server_url} failed: {e}")
+
     # Register this client with the server
-    try:
-        # Get the local IP address for callback
-        local_ip = get_local_ip()
-        register_url = f"http://{local_ip}:{SERVER_PORT + 1}/client_message"
-        
-        requests.post(
-            f"{server_url}/connect",
-            json={'url': f"http://{local_ip}:{SERVER_PORT + 1}"},
-            timeout=2
-        )
-        logger.debug(f"Registered client with server: {register_url}")
-    except Exception as e:
-        logger.error(f"Failed to register client with server: {e}")
-    
+    if not multicast_receiver:
+        register()
+    last_heartbeat = time.time()
+
+    if replica:
+        try:
+            # Seeds the replica from a /snapshot the first time; later runs only fetch what they missed
+            replica.bootstrap()
+        except ValueError as e:
+            logger.warning(f"Can't keep a replica of {server_url}, polling the full log instead: {e}")
+            replica = None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Could not sync the chat history: {e}")
+
     while not stop_event.is_set():
+        if not multicast_receiver and time.time() - last_heartbeat >= DEFAULT_LEASE / 3:
+            send_heartbeat()
+            last_heartbeat = time.time()
+
+        if replica:
+            # Incremental sync: only the records stored after the replica's end
+            try:
+                for _, record in replica.sync():
+                    handle_pushed(record, "poll")
+                consecutive_errors = 0
+            except Exception as e:
+                logger.error(f"Request error: {e}")
+                consecutive_errors += 1
+                if consecutive_errors >= max_consecutive_errors:
+                    display_message("[System] Connection lost, attempting to reconnect...")
+                    time.sleep(5)  # Longer delay after multiple errors
+            time.sleep(0.5)
+            continue
+
         try:
             # Poll server for new messages
-            logger.debug(f"Polling for new messages since {last_poll}")
+            events.record("listener.poll", since=last_poll)
             response = None
             
             try:
-                response = requests.get(
+                poll_start = time.time()
+                response = sessions.interactive.get(
                     f"{server_url}/messages",
                     params={'since': last_poll},
                     timeout=2  # Increased timeout for better reliability
                 )
+                poll_end = time.time()
                 
                 if response.status_code == 200:
                     try:
                         new_messages_b64 = response.json()
                         if new_messages_b64:
-                            logger.debug(f"Received {len(new_messages_b64)} new messages")
+                            events.record("listener.poll_result", messages=len(new_messages_b64))
                             
                             for encrypted_message_b64 in new_messages_b64:
                                 if not encrypted_message_b64:
-                                    logger.debug("Skipping empty message")
+                                    events.record("listener.empty")
                                     continue
                                     
                                 try:
@@ -304,22 +519,27 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
                                     
                                     # Skip duplicate messages
                                     if msg_hash in seen_messages:
-                                        logger.debug("Skipping duplicate message")
+                                        events.record("listener.duplicate")
                                         continue
                                         
                                     seen_messages.add(msg_hash)
                                     
                                     # Try to decrypt the message with error handling
                                     encrypted_message = base64.b64decode(encrypted_message_b64)
+                                    if tracer.enabled:
+                                        # How long the message sat on the server before this poll picked it up
+                                        tracer.record('client.poll', last_poll, poll_end, trace_id(encrypted_message),
+                                                      request_ms=round((poll_end - poll_start) * 1000, 2))
                                     decrypted = decrypt_message(encrypted_message, private_key, skip_errors=True)
                                     
                                     if decrypted:
+                                        index_message(encrypted_message, decrypted)
                                         # Skip our own messages that might be echoed back
                                         if not decrypted.startswith(f"{client_name}:"):
                                             display_message(decrypted)
                                         consecutive_errors = 0  # Reset error counter on success
                                     else:
-                                        logger.debug("Skipping undecryptable message")
+                                        events.record("listener.undecryptable", source="poll")
                                         
                                 except Exception as e:
                                     logger.error(f"Error processing message: {e}")
@@ -340,6 +560,9 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
                     
             except requests.exceptions.RequestException as e:
                 logger.error(f"Request error: {e}")
+                if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    # Race the server's addresses again on the next connect
+                    dialer.unreachable(server_url)
                 consecutive_errors += 1
                 if consecutive_errors >= max_consecutive_errors:
                     display_message("[System] Connection lost, attempting to reconnect...")
@@ -354,6 +577,9 @@ def client_message_listener(stop_event, server_url, private_key, client_name):
         
         time.sleep(0.5)  # Base delay between polls for more responsive updates
 
+    if multicast_receiver:
+        multicast_receiver.stop()
+
 # --- Main Application ---
 
 def ensure_directory(directory):
@@ -362,21 +588,19 @@ def ensure_directory(directory):
         os.makedirs(directory, exist_ok=True)
         os.chmod(directory, 0o755)  # Ensure proper permissions
 
-def view_chat_history(chat_code):
+def view_chat_history(chat_code, chat_file_path=None):
     """
     Loads and decrypts chat history for a given chat code.
+
+    Reads the room's log, or `chat_file_path` (a client's local replica of it).
     """
     # Construct paths
-    chat_file_path = os.path.join(CHATS_DIR, f"{chat_code}.txt")
-    private_key_path = get_key_path(f"{chat_code}_private.key", KEYS_DIR)
+    chat_file_path = chat_file_path or os.path.join(CHATS_DIR, f"{chat_code}.txt")
 
-    # --- 1. Load Private Key ---
-    if not os.path.exists(private_key_path):
-        print(f"Error: Private key for chat '{chat_code}' not found.")
-        return
-        
-    private_key = load_private_key(private_key_path)
+    # --- 1. Load Private Key (kept in memory after the first .history) ---
+    private_key = keystore.get(chat_code, 'private')
     if not private_key:
+        print(f"Error: Private key for chat '{chat_code}' not found.")
         return
 
     # --- 2. Read and Decrypt Chat File ---
@@ -387,17 +611,15 @@ def view_chat_history(chat_code):
     print(f"\n--- Chat History for '{chat_code}' ---")
     
     try:
-        with open(chat_file_path, "rb") as f:
-            # Assuming each message is a base64 encoded string on a new line
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                
+        cursor = 0
+        while True:
+            # Records are raw ciphertext separated by a null byte (they may contain newlines)
+            cursor, records = read_records_after(chat_file_path, cursor, 500)
+            if not records:
+                break
+            for _, record in records:
                 try:
-                    # The file stores raw bytes, not base64 strings.
-                    # We pass the raw bytes directly to the decrypt function.
-                    decrypted_message = decrypt_message(line, private_key, skip_errors=True)
+                    decrypted_message = decrypt_message(record, private_key, skip_errors=True)
                     
                     if decrypted_message:
                         print(decrypted_message)
@@ -415,13 +637,57 @@ def view_chat_history(chat_code):
 
     print("--- End of History ---")
 
+def handle_file_command(message, server_url, partner_public_key, private_key, session=None):
+    """Runs a `.send <path>` or `.get <file id>` command.
+
+    Returns None if `message` isn't a file command, otherwise the text to post
+    to the chat (empty if there's nothing to post). Chunks go through
+    `session`, if given (the bulk lane's).
+    """
+    command, _, argument = message.partition(' ')
+    command = command.lower()
+    argument = argument.strip()
+    if command not in ('.send', '.get'):
+        return None
+    if not argument:
+        print(f"Usage: {command} <{'path' if command == '.send' else 'file id'}>")
+        return ""
+
+    try:
+        if command == '.send':
+            path = os.path.expanduser(argument)
+            if not os.path.isfile(path):
+                print(f"Error: '{path}' is not a file.")
+                return ""
+            print(f"Uploading {os.path.basename(path)}...")
+            # Resume an earlier, interrupted upload of the same file if there is one
+            file_id = transfer.find_upload(TRANSFERS_DIR, path)
+            file_id = transfer.upload_file(server_url, path, partner_public_key, TRANSFERS_DIR, file_id=file_id,
+                                           session=session)
+            return f"[file] {os.path.basename(path)} ({os.path.getsize(path)} bytes) - .get {file_id}"
+
+        print(f"Downloading {argument}...")
+        saved = transfer.download_file(server_url, argument, private_key, DOWNLOADS_DIR, session=session)
+        print(f"Saved to {saved}")
+    except (requests.exceptions.RequestException, ValueError, OSError) as e:
+        print(f"Error: file transfer failed: {e}")
+    return ""
+
 def main():
+    global search_index
+
     # Create necessary directories
     initialize_directories()
     
     chat_code = input("Enter a unique Chat Code for this session: ") # SAME FOR HERE
     chat_filename = os.path.join(CHATS_DIR, f"{chat_code}.txt") # NOT HERE
-    
+
+    # The index has its own key: the chat key pair is regenerated every session
+    search_index = SearchIndex(
+        os.path.join(CHATS_DIR, f"{chat_code}.index"),
+        load_or_create_key(get_key_path(f"{chat_code}_index.key", KEYS_DIR)),
+    )
+
     # chat file is now managed by the server, no need to clear it here
 
     # Generate and save key pair
@@ -449,39 +715,39 @@ def main():
             # --- Client Mode ---
             print(f"Partner found! Connecting to {server_url}...")
             logger.debug(f"Starting client with server URL: {server_url}")
+            # One session per traffic lane, so history downloads and file transfers never hold up sends
+            sessions = LaneSessions()
             
-            # Send my public key to the server and try to obtain the server's public key from the response
-            server_pk = None
-            if server_url and my_public_key:
-                try:
-                    import requests as _requests
-                    resp = _requests.post(server_url + '/public_key', json={'public_key': base64.b64encode(my_public_key).decode('utf-8')}, timeout=5)
-                    if resp.ok:
-                        data = resp.json()
-                        server_pk_b64 = data.get('server_public_key')
-                        if server_pk_b64:
-                            server_pk = base64.b64decode(server_pk_b64)
-                except Exception:
-                    pass
-
-            # Fetch partner's public key if we didn't get it from the POST response
-            if not server_pk:
-                try:
-                    response = requests.get(f"{server_url}/public_key")
-                    partner_public_key = base64.b64decode(response.json().get('public_key'))
-                except Exception:
-                    partner_public_key = None
-            else:
-                partner_public_key = server_pk
-
-            if not partner_public_key:
+            # One round trip: register my public key and get the server's in the reply
+            try:
+                resp = sessions.control.post(
+                    f"{server_url}/public_key",
+                    json={'public_key': base64.b64encode(my_public_key).decode('utf-8'), 'peer_id': name},
+                    timeout=5,
+                )
+                reply = resp.json() if resp.ok else {}
+                server_pk_b64 = reply.get('server_public_key')
+                if server_pk_b64:
+                    partner_keys.set(SERVER_PEER, base64.b64decode(server_pk_b64))
+                if reply.get('trusted') is False:
+                    print(f"Your partner already has a key for this chat; ask them to "
+                          f"'.trust {fingerprint(my_public_key)}' so they can write to you.")
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.debug(f"Key exchange failed: {e}")
+
+            if not partner_keys.get(SERVER_PEER):
                 print("Could not get partner's public key. Exiting.")
                 return
+            print(f"Partner's key fingerprint: {fingerprint(partner_keys.get(SERVER_PEER))}")
+
+            # Local copy of the room's log, so .history doesn't need the server
+            replica = LogReplica(replica_path(CHATS_DIR, chat_code), server_url,
+                                 session=sessions.interactive, bulk_session=sessions.bulk)
 
             # Start the client message listener in a separate thread
             listener_thread = threading.Thread(
                 target=client_message_listener,
-                args=(stop_event, server_url, my_private_key, name),  # Pass the client name
+                args=(stop_event, server_url, my_private_key, name, replica, sessions),  # Pass the client name
                 daemon=True
             )
             listener_thread.start()
@@ -491,14 +757,29 @@ def main():
 
             print("\n--- E2EE Chat Started (Client Mode) ---")
             print("Type '.exit' to quit or '.history' to view past messages.")
+            print("Type '.send <path>' to share a file or '.get <file id>' to download one.")
+            print("Type '.search <terms>' to find past messages.")
+            print("Type '.trust <fingerprint>' to accept a partner's new key.")
 
             while True:
                 message = input("> ")
                 if message.lower() == '.exit':
                     break
                 if message.lower() == '.history':
-                    view_chat_history(chat_code)
+                    view_chat_history(chat_code, replica.path)
                     continue
+                if message.lower().startswith('.search'):
+                    search_history(message[len('.search'):].strip())
+                    continue
+                if message.lower().startswith('.trust'):
+                    trust_key(partner_keys, message[len('.trust'):])
+                    continue
+                # Cached locally; a key change arrives as a /peer_key push and is used once trusted
+                partner_public_key = partner_keys.trusted()
+                announcement = handle_file_command(message, server_url, partner_public_key, my_private_key,
+                                                   session=sessions.bulk)
+                if announcement is not None:
+                    message = announcement
                 if message:
                     full_message = f"{name}: {message}"
                     encrypted_message = encrypt_message(full_message, partner_public_key)
@@ -508,16 +789,21 @@ def main():
                     sent_message_hashes.add(message_hash)
                     
                     try:
-                        resp = requests.post(
-                            f"{server_url}/message",
-                            json={'message': base64.b64encode(encrypted_message).decode('utf-8')},
-                            timeout=2
-                        )
+                        with tracer.span('client.send', trace_id(encrypted_message) if tracer.enabled else None):
+                            resp = sessions.interactive.post(
+                                f"{server_url}/message",
+                                json={'message': base64.b64encode(encrypted_message).decode('utf-8')},
+                                timeout=2
+                            )
                         if resp.ok:
+                            index_message(encrypted_message, full_message)
                             display_message(full_message)
+                        elif resp.status_code == 429:
+                            display_message(f"[local] Sending too fast, try again in {resp.headers.get('Retry-After', '1')}s")
                         else:
                             display_message("[local] Failed to send message")
                     except requests.exceptions.RequestException as e:
+                        dialer.unreachable(server_url)
                         print(f"Error: Could not connect to partner: {e}")
                         break
         
@@ -535,17 +821,23 @@ def main():
                         
                     text = decrypt_message(encrypted_bytes, my_private_key)
                     if text:
+                        index_message(encrypted_bytes, text)
                         display_message(text)
                 except Exception as e:
                     logger.debug(f"Server callback error: {e}")
 
             # Start server with callback for immediate message display
-            network_manager = NetworkManager(name, chat_code, on_message=on_message)
+            network_manager = NetworkManager(name, chat_code, on_message=on_message, public_key=my_public_key)
+            network_manager.peer_keys.subscribe(
+                lambda peer_id, key: announce_peer_key(network_manager.peer_keys, peer_id, key))
             network_manager.start()
             server_base_url = f"http://127.0.0.1:{SERVER_PORT}"
 
             print("\n--- E2EE Chat Started (Server Mode) ---")
             print("Type '.exit' to quit or '.history' to view past messages.")
+            print("Type '.send <path>' to share a file or '.get <file id>' to download one.")
+            print("Type '.search <terms>' to find past messages.")
+            print("Type '.trust <fingerprint>' to accept a partner's new key.")
             print("Waiting for client to connect and exchange keys...")
             
             while True:
@@ -555,24 +847,29 @@ def main():
                 if message.lower() == '.history':
                     view_chat_history(chat_code)
                     continue
+                if message.lower().startswith('.search'):
+                    search_history(message[len('.search'):].strip())
+                    continue
+                if message.lower().startswith('.trust'):
+                    trust_key(network_manager.peer_keys, message[len('.trust'):])
+                    continue
                 if not message:
                     continue
 
-                # Try to get peer's public key from our server
+                # The peer's key comes from the in-memory keystore the /public_key exchange fills: the
+                # first key registered, or one the user trusted since, not whoever registered last
                 try:
-                    resp = requests.get(f"{server_base_url}/peer_public_key", timeout=2)
-                    if not resp.ok:
+                    partner_pk = network_manager.peer_keys.trusted()
+                    if not partner_pk:
                         display_message("[local] Waiting for client to connect...")
                         continue
 
-                    data = resp.json()
-                    pk_b64 = data.get('public_key')
-                    if not pk_b64:
-                        display_message("[local] No client public key available yet")
-                        continue
+                    announcement = handle_file_command(message, server_base_url, partner_pk, my_private_key)
+                    if announcement is not None:
+                        if not announcement:
+                            continue
+                        message = announcement
 
-                    partner_pk = base64.b64decode(pk_b64)
-                    
                     # Encrypt the message
                     full_message = f"{name}: {message}"
                     encrypted_message = encrypt_message(full_message, partner_pk)
@@ -587,14 +884,18 @@ def main():
                         message_data = base64.b64encode(encrypted_message).decode('utf-8')
                         logger.debug(f"Encoded message size: {len(message_data)} bytes")
                         
-                        resp = requests.post(
-                            f"{server_base_url}/message",
-                            json={'message': message_data},
-                            timeout=2
-                        )
+                        with tracer.span('client.send', trace_id(encrypted_message) if tracer.enabled else None):
+                            resp = requests.post(
+                                f"{server_base_url}/message",
+                                json={'message': message_data},
+                                timeout=2
+                            )
                         if resp.ok:
+                            index_message(encrypted_message, full_message)
                             display_message(full_message)
                             logger.debug("Message sent successfully")
+                        elif resp.status_code == 429:
+                            display_message(f"[local] Sending too fast, try again in {resp.headers.get('Retry-After', '1')}s")
                         else:
                             display_message("[local] Failed to send message")
                             logger.debug(f"Server rejected message: {resp.status_code} - {resp.text}")
@@ -610,18 +911,14 @@ def main():
     finally:
         print("\nExiting Pychat. Goodbye!")
         stop_event.set()
+        logger.info(f"Decrypt cache: {decrypt_cache.stats()}")
+        decrypt_cache.clear()
         zeroconf.close()
 
 if __name__ == "__main__":
-    # Configure logging
-    logging.basicConfig(
-        level=logging.WARNING,  # Changed from DEBUG to WARNING to reduce output
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler('pychat.log')
-        ]
-    )
+    # Configure logging; file output happens on a background thread
+    log_listener = setup_logging(level=logging.WARNING)
+    install_dump_signal()
     logger = logging.getLogger('pychat')
     logger.info("Starting PyChat...")
     
@@ -630,3 +927,5 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception("Unhandled exception in main:")
         raise
+    finally:
+        log_listener.stop()
@@ -0,0 +1,258 @@
+"""LAN multicast delivery of chat records, with repair from the server's log.
+
+The server sends every new record once, as one or more UDP datagrams, to a
+multicast group derived from the chat code, instead of one HTTP push per
+client. Each datagram carries the record's byte offsets in the chat log,
+which double as sequence numbers: a receiver knows where the next record
+must start, so a gap (a lost datagram, or a record it never finished
+reassembling) shows up as a record starting past that point. It then
+fetches the missing records from `/messages?after=<offset>` and delivers
+everything in log order. Heartbeats carrying the current log end let
+receivers notice a lost record even when nothing follows it.
+"""
+import time
+import struct
+import socket
+import base64
+import hashlib
+import threading
+
+import requests
+
+import logging
+
+from .metrics import registry
+
+logger = logging.getLogger('pychat')
+
+# Organization-local scope (RFC 2365); TTL 1 keeps datagrams on the LAN anyway
+GROUP_PREFIX = "239.255"
+PORT_BASE = 40000
+PORT_RANGE = 20000
+DEFAULT_TTL = 1
+# Datagrams stay under a typical MTU so the IP layer never fragments them
+MAX_DATAGRAM = 1200
+MAGIC = b'PCMC'
+# magic, room ID, record start offset, record end offset, fragment index, fragment count
+HEADER = struct.Struct('!4s8sQQHH')
+MAX_FRAGMENT = MAX_DATAGRAM - HEADER.size
+# Seconds between heartbeats from the server
+HEARTBEAT_INTERVAL = 1.0
+# Seconds a partly received record is kept before it is left to repair
+FRAGMENT_TIMEOUT = 2.0
+# Minimum seconds between two repair fetches
+REPAIR_INTERVAL = 0.2
+REPAIR_BATCH = 500
+
+MULTICAST_DATAGRAMS = registry.counter('pychat_multicast_datagrams_sent_total', 'Datagrams sent to the room multicast group')
+MULTICAST_GAPS = registry.counter('pychat_multicast_gaps_total', 'Gaps in the multicast stream detected by a receiver')
+MULTICAST_REPAIRED = registry.counter('pychat_multicast_repaired_total', 'Records a receiver fetched from the log after a gap')
+
+
+def room_id(chat_code):
+    return hashlib.sha256(chat_code.encode('utf-8')).digest()[:8]
+
+
+def group_for(chat_code):
+    """Returns the (group address, port) a room's records are multicast to."""
+    digest = hashlib.sha256(b'pychat-multicast:' + chat_code.encode('utf-8')).digest()
+    # Keep clear of x.x.0.x and x.x.255.x, which some switches treat specially
+    group = f"{GROUP_PREFIX}.{digest[0]}.{1 + digest[1] % 254}"
+    port = PORT_BASE + int.from_bytes(digest[2:4], 'big') % PORT_RANGE
+    return group, port
+
+
+def fragment(room, record, start, end):
+    """Splits a record into datagrams."""
+    pieces = [record[i:i + MAX_FRAGMENT] for i in range(0, len(record), MAX_FRAGMENT)] or [b'']
+    return [HEADER.pack(MAGIC, room, start, end, index, len(pieces)) + piece for index, piece in enumerate(pieces)]
+
+
+class MulticastSender:
+    """Sends a room's records to its multicast group.
+
+    Args:
+        chat_code: Room the records belong to
+        ttl: Multicast TTL (1 stays on the local network)
+        interface: Local address of the interface to send from (default: the OS route)
+    """
+
+    def __init__(self, chat_code, ttl=DEFAULT_TTL, interface=None):
+        self.chat_code = chat_code
+        self.room = room_id(chat_code)
+        self.group, self.port = group_for(chat_code)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        if interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self._lock = threading.Lock()
+
+    def send(self, record, start, end):
+        """Sends the record stored at log offsets [start, end)."""
+        datagrams = fragment(self.room, record, start, end)
+        with self._lock:
+            for datagram in datagrams:
+                self.sock.sendto(datagram, (self.group, self.port))
+        MULTICAST_DATAGRAMS.inc(len(datagrams))
+
+    def heartbeat(self, log_end):
+        """Tells receivers where the log ends, so they can spot a lost last record."""
+        with self._lock:
+            self.sock.sendto(HEADER.pack(MAGIC, self.room, log_end, log_end, 0, 0), (self.group, self.port))
+        MULTICAST_DATAGRAMS.inc()
+
+    def info(self):
+        return {'chat_code': self.chat_code, 'group': self.group, 'port': self.port}
+
+    def close(self):
+        self.sock.close()
+
+
+class MulticastReceiver:
+    """Receives a room's records from its multicast group and delivers them in log order.
+
+    Args:
+        chat_code: Room to listen to
+        server_url: Base URL of the room's server, for /messages repairs
+        on_record: Called with each record's start offset and bytes, in log order
+        cursor: Log offset of the first record to deliver (the log end from /multicast)
+        group: (address, port) to join instead of the one derived from the chat code
+        session: requests session for repairs
+    """
+
+    def __init__(self, chat_code, server_url, on_record, cursor, group=None, session=None):
+        self.chat_code = chat_code
+        self.server_url = server_url
+        self.on_record = on_record
+        self.cursor = cursor
+        self.room = room_id(chat_code)
+        self.group, self.port = group or group_for(chat_code)
+        self.session = session or requests.Session()
+        self.delivered = 0
+        self.repaired = 0
+        self._pending = {}  # start offset -> (end offset, record) of records past a gap
+        self._partial = {}  # start offset -> [end, fragment count, {index: bytes}, first seen]
+        self._last_repair = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Several clients of the same room may run on one host
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(('', self.port))
+        membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0'))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.sock.settimeout(HEARTBEAT_INTERVAL)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="pychat-multicast", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.sock.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                datagram = self.sock.recv(65535)
+            except socket.timeout:
+                self._expire_partial()
+                continue
+            except OSError:
+                break
+            try:
+                self.handle_datagram(datagram)
+            except Exception as e:
+                logger.error(f"Error handling multicast datagram: {e}")
+
+    def handle_datagram(self, datagram):
+        if len(datagram) < HEADER.size:
+            return
+        magic, room, start, end, index, count = HEADER.unpack_from(datagram)
+        if magic != MAGIC or room != self.room:
+            return
+        if count == 0:
+            # Heartbeat: anything stored before `end` that we haven't got was lost
+            if end > self.cursor:
+                self.repair()
+            return
+        if end <= self.cursor:
+            return  # already delivered
+
+        piece = datagram[HEADER.size:]
+        if count == 1:
+            self._accept(start, end, piece)
+            return
+        partial = self._partial.setdefault(start, [end, count, {}, time.monotonic()])
+        partial[2][index] = piece
+        if len(partial[2]) == count:
+            del self._partial[start]
+            self._accept(start, end, b''.join(partial[2][i] for i in range(count)))
+
+    def _accept(self, start, end, record):
+        if start == self.cursor:
+            self._deliver(start, end, record)
+            self._drain()
+        elif start > self.cursor:
+            self._pending[start] = (end, record)
+            MULTICAST_GAPS.inc()
+            self.repair()
+
+    def _deliver(self, start, end, record):
+        self.cursor = end
+        self.delivered += 1
+        try:
+            self.on_record(start, record)
+        except Exception as e:
+            logger.error(f"Error in multicast record callback: {e}")
+
+    def _drain(self):
+        """Delivers buffered records that now follow on, and drops ones a repair already covered."""
+        for start in sorted(self._pending):
+            end, record = self._pending[start]
+            if end <= self.cursor:
+                del self._pending[start]
+            elif start == self.cursor:
+                del self._pending[start]
+                self._deliver(start, end, record)
+            else:
+                break
+
+    def _expire_partial(self):
+        now = time.monotonic()
+        stale = [start for start, partial in self._partial.items() if now - partial[3] > FRAGMENT_TIMEOUT]
+        for start in stale:
+            del self._partial[start]
+        if stale or self._pending:
+            self.repair()
+
+    def repair(self):
+        """Fetches the records after the cursor from the server's log (a NACK, in effect)."""
+        now = time.monotonic()
+        if now - self._last_repair < REPAIR_INTERVAL:
+            return
+        self._last_repair = now
+        while True:
+            try:
+                response = self.session.get(f"{self.server_url}/messages",
+                                            params={'after': self.cursor, 'limit': REPAIR_BATCH}, timeout=5)
+                response.raise_for_status()
+                page = response.json()
+            except Exception as e:
+                logger.warning(f"Multicast repair from {self.server_url} failed: {e}")
+                return
+            records = page.get('messages', [])
+            for entry in records:
+                record = base64.b64decode(entry['message'])
+                if entry['end'] > self.cursor:
+                    self._deliver(entry['offset'], entry['end'], record)
+                    self.repaired += 1
+                    MULTICAST_REPAIRED.inc()
+            self._drain()
+            if len(records) < REPAIR_BATCH:
+                return
@@ -4,14 +4,28 @@ import threading
 import base64
 import socket
 import json
+import math
+from concurrent.futures import wait
 import requests
 
 # Pip-installed libraries
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, send_file
+from werkzeug.serving import make_server
 from zeroconf import ServiceBrowser, ServiceInfo, Zeroconf, IPVersion
 
 # Local imports
 from .discovery import get_local_ip
+from .metrics import registry, PROMETHEUS_CONTENT_TYPE
+from .tracing import tracer, trace_id
+from .diagnostics import events
+from .ratelimit import AdmissionController
+from .transfer import FileStore
+from .state import ServerState, MIN_LEASE, MAX_LEASE, LEASE_GRACE
+from .peers import PeerKeyStore, fingerprint
+from .history import read_records_after, log_size, record_id, record_ending_at
+from .multicast import MulticastSender, HEARTBEAT_INTERVAL
+from .snapshot import snapshot_end, stream_range, END_HEADER
+from .lanes import LaneScheduler, LaneMiddleware, OutboundLanes
 import logging
 
 # module logger
@@ -21,6 +35,35 @@ logger = logging.getLogger('pychat')
 # --- Shared Constants ---
 SERVICE_TYPE = "_pychat._tcp.local."
 SERVER_PORT = 443
+# TLS certificate and key written by other/post_install.sh
+DEFAULT_SSL_CONTEXT = ('/etc/QuanCha/cert.pem', '/etc/QuanCha/key.pem')
+
+# --- Metrics ---
+MESSAGES_RECEIVED = registry.counter('pychat_messages_received_total', 'Messages accepted on /message')
+MESSAGE_BYTES = registry.counter('pychat_message_bytes_total', 'Bytes of encrypted messages accepted on /message')
+HANDLE_SECONDS = registry.histogram('pychat_handle_message_seconds', 'Time to store and fan out a message on /message')
+APPEND_SECONDS = registry.histogram('pychat_message_append_seconds', 'Time to append a message to the chat log')
+BROADCAST_SECONDS = registry.histogram('pychat_broadcast_seconds', 'Time to push a message to all connected clients')
+# Labelled by why the push failed, not by client: callback URLs come from /connect and are unbounded
+BROADCAST_FAILURES = registry.counter('pychat_broadcast_failures_total', 'Failed pushes to a connected client', ['reason'])
+CONNECTED_CLIENTS = registry.gauge('pychat_connected_clients', 'Clients registered for broadcasts', ['chat_code'])
+POLL_SECONDS = registry.histogram('pychat_messages_poll_seconds', 'Time to answer a /messages poll')
+POLL_MESSAGES = registry.counter('pychat_messages_polled_total', 'Messages returned by /messages polls')
+REJECTED = registry.counter('pychat_requests_rejected_total', 'Requests turned away by admission control', ['endpoint', 'reason'])
+FILE_CHUNKS_STORED = registry.counter('pychat_file_chunks_stored_total', 'File chunks accepted on /files')
+FILE_BYTES_STORED = registry.counter('pychat_file_bytes_stored_total', 'Bytes of encrypted file chunks accepted on /files')
+LEASES_LAPSED = registry.counter('pychat_client_leases_lapsed_total', 'Client leases ended early by a failed push')
+CLIENTS_REAPED = registry.counter('pychat_clients_reaped_total', 'Leased clients forgotten after they stopped renewing')
+
+# Seconds between sweeps for clients whose lease ran out long ago
+REAP_INTERVAL = 30
+
+def rate_limited(retry_after, reason):
+    """Builds a 429 response telling the client how long to back off."""
+    response = jsonify({"error": "rate limited", "reason": reason, "retry_after": round(retry_after, 3)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
 
 def find_free_port():
     """Finds and returns an available TCP port."""
@@ -31,23 +74,80 @@ def find_free_port():
 
 # --- Networking Logic ---
 class NetworkManager:
-    def __init__(self, name, chat_code, on_message=None):
+    def __init__(self, name, chat_code, on_message=None, host='0.0.0.0', port=None,
+                 ssl_context=DEFAULT_SSL_CONTEXT, advertise=True, chats_dir="chats", admission=None,
+                 zeroconf=None, public_key=None, multicast=None, lanes=None):
+        """
+        Args:
+            name: Service name advertised over mDNS
+            chat_code: Chat code of the room this server hosts
+            on_message: Called with the raw encrypted bytes of each stored message
+            host: Address the HTTP server binds to
+            port: Port to listen on; a free port is picked if not given
+            ssl_context: (cert, key) paths for TLS, or None to serve plain HTTP
+            advertise: Whether to register the service over mDNS
+            chats_dir: Directory the chat log is written to
+            admission: AdmissionController for this room; one with the default limits is made if not given
+            zeroconf: Shared Zeroconf instance to advertise through; it is left open by stop()
+            public_key: This host's public key, handed out by the /public_key exchange
+            multicast: Also send new records to the room's LAN multicast group (default: $PYCHAT_MULTICAST=1)
+            lanes: LaneScheduler for this room's requests; one with the default limits is made if not given
+        """
         self.name = name
         self.chat_code = chat_code
         self.on_message = on_message
-        self.zeroconf = Zeroconf()
+        self.host = host
+        self.ssl_context = ssl_context
+        self.advertise = advertise
+        self._owns_zeroconf = zeroconf is None
+        self.zeroconf = zeroconf if zeroconf is not None else (Zeroconf() if advertise else None)
         self.service_info = None
         self.flask_thread = None
-        self.port = find_free_port()  # Assign a dynamic free port
-        self.chat_filename = os.path.join("chats", f"{self.chat_code}.txt")
-
-    def start(self):
+        self.http_server = None
+        self.port = port or find_free_port()  # Assign a dynamic free port
+        self.chat_filename = os.path.join(chats_dir, f"{self.chat_code}.txt")
+        # Callback clients, their push cursors and peer keys, snapshotted so a restart resumes fan-out
+        self.state = ServerState(os.path.join(chats_dir, f"{self.chat_code}.session.json"))
+        # File chunks live outside the chat log so transfers don't slow down history reads
+        self.files = FileStore(os.path.join(chats_dir, "files", self.chat_code))
+        self.admission = admission or AdmissionController()
+        # Interactive, control and bulk requests get their own bounded lanes, in and out
+        self.lanes = lanes or LaneScheduler()
+        self.outbound = OutboundLanes()
+        self.public_key = public_key
+        # Keys registered through /public_key; subscribe to hear about new or changed ones.
+        # Only the trusted one (see PeerKeyStore) is encrypted for
+        self.peer_keys = PeerKeyStore()
+        self.peer_keys.subscribe(self._peer_key_stored)
+        if multicast is None:
+            multicast = os.environ.get("PYCHAT_MULTICAST") == "1"
+        # One datagram per record for every receiver on the LAN, instead of one push per client
+        self.multicast = MulticastSender(chat_code) if multicast else None
+        self._heartbeat_stop = threading.Event()
+        self._reaper_stop = threading.Event()
+        # One lock per client, held while pushing to it: its records go out one at a time, in log
+        # order, so its cursor only ever moves past records it actually got
+        self._push_locks = {}
+        self._push_locks_lock = threading.Lock()
+        # Held while appending to the chat log, so a record's end offset is where it really ends
+        self._append_lock = threading.Lock()
+        # Leased clients being sent what they missed; they rejoin the fan-out when it's done
+        self._catching_up = set()
+        self._catching_up_lock = threading.Lock()
+
+    def build_app(self):
+        """Builds the Flask app serving this room's routes.
+
+        start() serves it on its own port; a sharded worker (behind/cluster.py)
+        mounts it under /rooms/<chat_code> next to the worker's other rooms.
+        """
         # Set up debugging but disable regular Flask logs
         log = logging.getLogger('werkzeug')
         log.setLevel(logging.ERROR)
 
         app = Flask(__name__)
         app.logger.disabled = True
+        app.wsgi_app = LaneMiddleware(app.wsgi_app, self.lanes)
 
         # Make sure we have an absolute path to the chat file
         self.chat_filename = os.path.abspath(self.chat_filename)
@@ -60,19 +160,34 @@ class NetworkManager:
 
         @app.route('/messages', methods=['GET'])
         def get_messages():
+            if 'after' in request.args:
+                try:
+                    offset, limit = int(request.args['after']), int(request.args.get('limit', '500'))
+                except ValueError:
+                    return jsonify({"error": "after and limit must be integers"}), 400
+                with POLL_SECONDS.time():
+                    page = read_messages_after(offset, limit)
+                POLL_MESSAGES.inc(len(page['messages']))
+                return jsonify(page)
+            with POLL_SECONDS.time():
+                messages = read_messages()
+            POLL_MESSAGES.inc(len(messages))
+            return jsonify(messages)
+
+        def read_messages():
             since_time = float(request.args.get('since', '0'))
-            logger.debug(f"Fetching messages since timestamp {since_time}")
+            events.record("poll.start", since=since_time)
 
             if not os.path.exists(self.chat_filename):
-                logger.debug(f"Chat file {self.chat_filename} does not exist")
-                return jsonify([])
+                events.record("poll.no_log", path=self.chat_filename)
+                return []
 
             messages = []
             try:
                 # Check if the file has been modified since the last poll
                 file_mod_time = os.path.getmtime(self.chat_filename)
                 if file_mod_time < since_time:
-                    return jsonify([])
+                    return []
 
                 with open(self.chat_filename, "rb") as f:
                     data = f.read()
@@ -80,100 +195,184 @@ class NetworkManager:
                 if data:
                     # Split into messages
                     chunks = data.split(b'\0')
-                    logger.debug(f"Found {len(chunks)} total chunks in file")
+                    events.record("poll.read", chunks=len(chunks))
 
                     # Include all non-empty chunks for now
                     for chunk in chunks:
                         if chunk:  # Skip empty chunks
                             messages.append(base64.b64encode(chunk).decode('utf-8'))
 
-                    logger.debug(f"Returning {len(messages)} messages")
+                    events.record("poll.done", messages=len(messages))
                 else:
-                    logger.debug("Chat file is empty")
+                    events.record("poll.empty")
 
             except Exception as e:
                 logger.error(f"Error reading messages: {e}")
 
-            return jsonify(messages)
-
-        # Store connected clients for broadcasting
-        connected_clients = set()
-
-        def broadcast_message(encrypted_message):
+            return messages
+
+        def read_messages_after(offset, limit):
+            """Records stored at or after log offset `offset`, with their offsets (multicast repair)."""
+            end, records = read_records_after(self.chat_filename, max(0, offset), max(1, min(limit, 1000)))
+            events.record("poll.after", offset=offset, messages=len(records))
+            previous = record_ending_at(self.chat_filename, offset)
+            return {
+                'messages': [{'offset': start, 'end': start + len(record) + 1,
+                              'message': base64.b64encode(record).decode('utf-8')} for start, record in records],
+                'next': end,
+                # Let a client replica notice that the log it copied was replaced: by its
+                # length, or (once the new log has grown past it) by the record before `offset`
+                'log_end': log_size(self.chat_filename),
+                'prev_id': record_id(previous) if previous is not None else None,
+            }
+
+        @app.route('/snapshot', methods=['GET'])
+        def get_snapshot():
+            """The raw chat log up to a record boundary, for late joiners; supports (parallel) Range requests"""
+            try:
+                end = snapshot_end(self.chat_filename, request.args.get('end', type=int))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+
+            start, stop, status = 0, end, 200
+            headers = {END_HEADER: str(end), 'Accept-Ranges': 'bytes'}
+            if request.range:
+                span = request.range.range_for_length(end)
+                if span is None:
+                    return Response(status=416, headers={'Content-Range': f"bytes */{end}"})
+                (start, stop), status = span, 206
+                headers['Content-Range'] = f"bytes {start}-{stop - 1}/{end}"
+            headers['Content-Length'] = str(stop - start)
+            events.record("snapshot.send", start=start, stop=stop, end=end)
+            body = stream_range(self.chat_filename, start, stop, request.environ.get('werkzeug.socket'))
+            return Response(body, status=status, headers=headers, content_type='application/octet-stream',
+                            direct_passthrough=True)
+
+        @app.route('/multicast', methods=['GET'])
+        def get_multicast():
+            """Where this room's records are multicast, and the log offset receivers start at"""
+            if not self.multicast:
+                return jsonify({"error": "multicast delivery is off"}), 404
+            return jsonify(dict(self.multicast.info(), log_end=log_size(self.chat_filename)))
+
+        # Connected clients (restored from the last run, if any) live in self.state
+        self.state.path = os.path.abspath(self.state.path)
+        self.state.load()
+        CONNECTED_CLIENTS.set(len(self.state), chat_code=self.chat_code)
+        for peer_id, key_b64 in list(self.state.peer_keys.items()):
+            key = base64.b64decode(key_b64)
+            self.peer_keys.restore(peer_id, key, trusted=fingerprint(key) == self.state.trusted_key)
+
+        def broadcast_message(encrypted_message, end_offset):
             """Broadcast a message to all connected clients"""
-            if not connected_clients:
-                logger.debug("No connected clients to broadcast to")
+            if self.multicast:
+                try:
+                    self.multicast.send(encrypted_message, end_offset - len(encrypted_message) - 1, end_offset)
+                except OSError as e:
+                    # Receivers repair from the log on the next heartbeat
+                    logger.error(f"Error multicasting message: {e}")
+            # Clients whose lease ran out are skipped; they catch up from their cursor when they renew
+            clients = self.state.live_client_urls()
+            if not clients:
+                events.record("broadcast.no_clients")
                 return
 
             message_b64 = base64.b64encode(encrypted_message).decode('utf-8')
-            logger.debug(f"Broadcasting message to {len(connected_clients)} clients")
+            # Where the record starts in the log, so client replicas can check they have everything before it
+            start_offset = end_offset - len(encrypted_message) - 1
+            events.record("broadcast.start", clients=len(clients))
+            tid = trace_id(encrypted_message) if tracer.enabled else None
 
             def send_to_client(client_url):
-                try:
-                    logger.debug(f"Sending to client at {client_url}")
-                    # Use the client's /client_message endpoint
-                    response = requests.post(
-                        f"{client_url}/client_message",
-                        json={'message': message_b64},
-                        timeout=2
-                    )
-                    if response.status_code != 200:
-                        logger.error(f"Error from {client_url}: {response.status_code} - {response.text}")
+                with self._push_lock(client_url):
+                    cursor = self.state.cursor(client_url)
+                    if cursor is None or cursor >= end_offset:
+                        # Dropped meanwhile, or a catch-up already sent it
+                        return True
+                    if not self.state.is_live(client_url):
+                        # Its lease lapsed while this push was queued (e.g. an earlier one failed):
+                        # it gets the record from the catch-up when it renews, not a timeout now
+                        return False
+                    if cursor < start_offset:
+                        # An earlier record hasn't reached this client yet (its push failed or is still
+                        # queued): send everything from the cursor, this record included, in order
+                        return self._send_from(client_url, cursor, live_only=True)
+                    try:
+                        events.record("broadcast.push", client=client_url)
+                        # Use the client's /client_message endpoint
+                        with tracer.span('server.push', tid, client=client_url):
+                            response = requests.post(
+                                f"{client_url}/client_message",
+                                json={'message': message_b64, 'offset': start_offset},
+                                timeout=2
+                            )
+                        if response.status_code != 200:
+                            logger.error(f"Error from {client_url}: {response.status_code} - {response.text}")
+                            BROADCAST_FAILURES.inc(reason='status')
+                            return False
+                        events.record("broadcast.pushed", client=client_url)
+                        self.state.advance(client_url, end_offset)
+                        return True
+                    except Exception as e:
+                        logger.error(f"Error broadcasting to {client_url}: {str(e)}")
+                        BROADCAST_FAILURES.inc(reason='unreachable')
+                        self._client_failed(client_url)
                         return False
-                    logger.debug(f"Successfully sent to {client_url}")
-                    return True
-                except Exception as e:
-                    logger.error(f"Error broadcasting to {client_url}: {str(e)}")
-                    # Remove disconnected client
-                    connected_clients.discard(client_url)
-                    logger.info(f"Removed disconnected client: {client_url}")
-                    return False
-
-            # Send to all clients in parallel
-            threads = []
-            results = {}
-
-            clients = list(connected_clients)  # Create a copy to avoid modification during iteration
-            logger.debug(f"Client URLs: {clients}")
 
-            for client_url in clients:
-                t = threading.Thread(
-                    target=lambda url=client_url: results.update({url: send_to_client(url)}),
-                    daemon=True
-                )
-                t.start()
-                threads.append(t)
+            # Send to all clients in parallel, on the bounded interactive lane
+            fanout_start = time.perf_counter()
+            fanout_wall_start = time.time()
+            pushes = [self.outbound.submit('interactive', send_to_client, client_url) for client_url in clients]
 
             # Wait for all sends to complete with a timeout
-            for t in threads:
-                t.join(timeout=5)
+            wait(pushes, timeout=5)
+            BROADCAST_SECONDS.observe(time.perf_counter() - fanout_start)
+            tracer.record('server.broadcast', fanout_wall_start, time.time(), tid, clients=len(clients))
 
         @app.route('/message', methods=['POST'])
         def handle_message():
             """Handle incoming messages from clients and other servers"""
+            retry_after, reason = self.admission.admit_message(request.remote_addr)
+            if retry_after:
+                REJECTED.inc(endpoint='message', reason=reason)
+                events.record("message.rejected", remote=request.remote_addr, reason=reason)
+                return rate_limited(retry_after, reason)
+
             encrypted_message_b64 = request.json.get('message')
             if not encrypted_message_b64:
-                logger.debug("Received empty message")
+                events.record("message.empty", remote=request.remote_addr)
                 return jsonify({"error": "empty message"}), 400
 
+            with HANDLE_SECONDS.time():
+                return store_message(encrypted_message_b64)
+
+        def store_message(encrypted_message_b64):
             try:
                 encrypted_message = base64.b64decode(encrypted_message_b64)
-                logger.debug(f"Received message from {request.remote_addr}, size: {len(encrypted_message)} bytes")
+                events.record("message.received", remote=request.remote_addr, size=len(encrypted_message))
+                MESSAGES_RECEIVED.inc()
+                MESSAGE_BYTES.inc(len(encrypted_message))
+                tid = trace_id(encrypted_message) if tracer.enabled else None
 
                 # Store the message in the chat file
-                with open(self.chat_filename, "ab") as f:
-                    # Write message followed by null byte as separator
-                    f.write(encrypted_message + b'\0')
-                    logger.debug(f"Wrote message to {self.chat_filename}")
+                with APPEND_SECONDS.time(), tracer.span('server.store', tid):
+                    with self._append_lock, open(self.chat_filename, "ab") as f:
+                        # Write message followed by null byte as separator
+                        f.write(encrypted_message + b'\0')
+                        # Taken after the flush: the record's end offset, with nothing appended after it
+                        f.flush()
+                        end_offset = f.tell()
+                    events.record("message.stored", path=self.chat_filename)
 
                 # Broadcast to all connected clients
-                broadcast_message(encrypted_message)
+                broadcast_message(encrypted_message, end_offset)
 
                 # Call the callback for the local server to process the message
                 if self.on_message:
                     try:
-                        self.on_message(encrypted_message)
-                        logger.debug("Message callback executed successfully")
+                        with tracer.span('server.callback', tid):
+                            self.on_message(encrypted_message)
+                        events.record("message.callback_done")
                     except Exception as e:
                         logger.error(f"Error in message callback: {e}")
 
@@ -183,44 +382,363 @@ class NetworkManager:
                 logger.error(f"Error processing message: {e}")
                 return jsonify({"error": str(e)}), 500
 
+        def callback_url(client_url):
+            # Remove http:// or https:// if present
+            client_url = client_url.replace('http://', '').replace('https://', '')
+            # Add http:// if no scheme is present
+            if not client_url.startswith(('http://', 'https://')):
+                client_url = f"http://{client_url}"
+            return client_url
+
         @app.route('/connect', methods=['POST'])
         def connect_client():
-            """Register a client for message broadcasting"""
+            """Register a client for message broadcasting, optionally with a lease it renews through /heartbeat"""
             client_url = request.json.get('url')
+            lease = None
             if client_url:
-                # Remove http:// or https:// if present
-                client_url = client_url.replace('http://', '').replace('https://', '')
-                # Add http:// if no scheme is present
-                if not client_url.startswith(('http://', 'https://')):
-                    client_url = f"http://{client_url}"
-                connected_clients.add(client_url)
-                logger.debug(f"Client connected: {client_url}")
-                logger.debug(f"Current connected clients: {connected_clients}")
+                client_url = callback_url(client_url)
+                if request.json.get('lease') is not None:
+                    try:
+                        lease = min(max(float(request.json['lease']), MIN_LEASE), MAX_LEASE)
+                    except (TypeError, ValueError):
+                        return jsonify({"error": "lease must be a number of seconds"}), 400
+                retry_after, reason = self.admission.admit_connect(request.remote_addr, client_url, self.state)
+                if retry_after:
+                    REJECTED.inc(endpoint='connect', reason=reason)
+                    events.record("client.rejected", client=client_url, reason=reason)
+                    return rate_limited(retry_after, reason)
+                # New clients get pushes from here on; a known client keeps its cursor
+                if not self.state.add_client(client_url, log_size(self.chat_filename), lease):
+                    self.renew_client(client_url)
+                CONNECTED_CLIENTS.set(len(self.state), chat_code=self.chat_code)
+                events.record("client.connected", client=client_url, clients=len(self.state), lease=lease)
+            return jsonify({"status": "ok", "lease": lease})
+
+        @app.route('/heartbeat', methods=['POST'])
+        def heartbeat():
+            """Renew a client's lease; a 404 means it was forgotten and must /connect again"""
+            client_url = (request.json or {}).get('url')
+            if not client_url:
+                return jsonify({"error": "url required"}), 400
+            client_url = callback_url(client_url)
+            if self.renew_client(client_url) is None:
+                return jsonify({"error": "not connected"}), 404
+            return jsonify({"status": "ok", "lease": self.state.lease_ttls.get(client_url)})
+
+        # --- File transfer ---
+        self.files.root = os.path.abspath(self.files.root)
+
+        @app.route('/files', methods=['POST'])
+        def create_file():
+            """Register an upload: the KEM encapsulation, the encrypted metadata and the chunk count"""
+            data = request.json or {}
+            try:
+                chunk_count = int(data.get('chunk_count', 0))
+                if not data.get('encaps') or not data.get('meta') or chunk_count < 1:
+                    raise ValueError("missing encaps, meta or chunk_count")
+                manifest = self.files.create(data.get('file_id'), data['encaps'], data['meta'], chunk_count)
+            except (TypeError, ValueError) as e:
+                return jsonify({"error": str(e)}), 400
+            events.record("file.created", file_id=manifest['file_id'], chunks=chunk_count)
+            return jsonify({"status": "ok", "file_id": manifest['file_id']})
+
+        @app.route('/files/<file_id>', methods=['GET'])
+        def get_file(file_id):
+            """Return an upload's manifest, including which chunks the server already has"""
+            try:
+                manifest = self.files.manifest(file_id)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if manifest is None:
+                return jsonify({"error": "unknown file"}), 404
+            return jsonify(manifest)
+
+        @app.route('/files/<file_id>/chunks/<int:index>', methods=['PUT'])
+        def put_file_chunk(file_id, index):
+            """Store one encrypted chunk; the body must match the X-Chunk-SHA256 header"""
+            # Charged by size, before the body is read, against the transfer buckets rather than the chat's
+            retry_after, reason = self.admission.admit_transfer(request.remote_addr, request.content_length or 0)
+            if retry_after:
+                REJECTED.inc(endpoint='files', reason=reason)
+                return rate_limited(retry_after, reason)
+            data = request.get_data()
+            try:
+                self.files.put_chunk(file_id, index, data, request.headers.get('X-Chunk-SHA256', ''))
+            except KeyError:
+                return jsonify({"error": "unknown file"}), 404
+            except ValueError as e:
+                events.record("file.chunk_rejected", file_id=file_id, index=index, error=str(e))
+                return jsonify({"error": str(e)}), 400
+            FILE_CHUNKS_STORED.inc()
+            FILE_BYTES_STORED.inc(len(data))
+            events.record("file.chunk_stored", file_id=file_id, index=index, size=len(data))
+            return jsonify({"status": "ok"})
+
+        @app.route('/files/<file_id>/chunks/<int:index>', methods=['GET'])
+        def get_file_chunk(file_id, index):
+            """Return one encrypted chunk"""
+            try:
+                path = self.files.chunk_path(file_id, index)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if path is None:
+                return jsonify({"error": "unknown chunk"}), 404
+            return send_file(path, mimetype='application/octet-stream')
+
+        @app.route('/files/<file_id>/complete', methods=['POST'])
+        def complete_file(file_id):
+            """Mark an upload complete once every chunk is stored"""
+            try:
+                missing = self.files.complete(file_id)
+            except KeyError:
+                return jsonify({"error": "unknown file"}), 404
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if missing:
+                return jsonify({"error": "missing chunks", "missing": missing}), 409
+            events.record("file.completed", file_id=file_id)
             return jsonify({"status": "ok"})
 
+        # --- Key exchange ---
+
+        @app.route('/public_key', methods=['POST'])
+        def exchange_public_key():
+            """Register the caller's public key and answer with ours, in one round trip"""
+            data = request.json or {}
+            try:
+                peer_key = base64.b64decode(data.get('public_key') or '', validate=True)
+            except ValueError:
+                peer_key = b''
+            if not peer_key:
+                return jsonify({"error": "missing or invalid public_key"}), 400
+            peer_id = str(data.get('peer_id') or request.remote_addr)
+            self.peer_keys.set(peer_id, peer_key)
+            events.record("keys.exchanged", peer=peer_id, fingerprint=fingerprint(peer_key))
+            # Until the host user trusts it, a key that isn't the first one registered isn't encrypted for
+            return jsonify({"status": "ok", "server_public_key": self._public_key_b64(),
+                            "trusted": peer_key == self.peer_keys.trusted()})
+
+        @app.route('/public_key', methods=['GET'])
+        def get_public_key():
+            """Return this host's public key"""
+            if not self.public_key:
+                return jsonify({"error": "no public key"}), 404
+            return jsonify({"public_key": self._public_key_b64()})
+
+        @app.route('/metrics', methods=['GET'])
+        def metrics():
+            """Expose runtime metrics in Prometheus text format"""
+            return Response(registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+        return app
+
+    def start(self):
+        app = self.build_app()
+
         # Register the service
-        service_name = f"{self.name}.{SERVICE_TYPE}"
-        self.service_info = ServiceInfo(
-            SERVICE_TYPE,
-            service_name,
-            addresses=[socket.inet_aton(get_local_ip())],
-            port=self.port,
-            properties={b'chat_code': os.path.basename(self.chat_filename).split('.')[0].encode('utf-8')}
-        )
-        self.zeroconf.register_service(self.service_info)
-        logger.debug(f"Registered service: {service_name}")
+        if self.advertise:
+            service_name = f"{self.name}.{SERVICE_TYPE}"
+            self.service_info = ServiceInfo(
+                SERVICE_TYPE,
+                service_name,
+                addresses=[socket.inet_aton(get_local_ip())],
+                port=self.port,
+                properties={b'chat_code': os.path.basename(self.chat_filename).split('.')[0].encode('utf-8')}
+            )
+            self.zeroconf.register_service(self.service_info)
+            logger.debug(f"Registered service: {service_name}")
+
+        # Bind now so the port is open when start() returns, and keep the server so stop() can shut it down
+        # lower werkzeug log level to avoid noisy HTTP logs
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.http_server = make_server(self.host, self.port, app, threaded=True, ssl_context=self.ssl_context)
 
         # Run Flask app in a separate thread
-        def run_flask():
-            # lower werkzeug log level to avoid noisy HTTP logs
-            logging.getLogger('werkzeug').setLevel(logging.WARNING)
-            app.run(host='0.0.0.0', port=self.port, ssl_context=('/etc/QuanCha/cert.pem', '/etc/QuanCha/key.pem'))
-
-        self.flask_thread = threading.Thread(target=run_flask)
+        self.flask_thread = threading.Thread(target=self.http_server.serve_forever)
         self.flask_thread.daemon = True
         self.flask_thread.start()
 
+        self.start_background()
+
+    def start_background(self):
+        """Starts the session-state snapshots and the resumed fan-out to restored clients."""
+        self.state.start_autosave()
+        self._resume_thread = threading.Thread(target=self._resume, daemon=True)
+        self._resume_thread.start()
+        if self.multicast:
+            threading.Thread(target=self._heartbeat, name="pychat-multicast-heartbeat", daemon=True).start()
+        threading.Thread(target=self._reap, name="pychat-lease-reaper", daemon=True).start()
+
+    def _heartbeat(self):
+        while not self._heartbeat_stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.multicast.heartbeat(log_size(self.chat_filename))
+            except OSError as e:
+                logger.debug(f"Multicast heartbeat failed: {e}")
+
+    def _reap(self):
+        while not self._reaper_stop.wait(REAP_INTERVAL):
+            gone = self.state.reap(LEASE_GRACE)
+            for url in gone:
+                self._forget_push_lock(url)
+            if gone:
+                CLIENTS_REAPED.inc(len(gone))
+                CONNECTED_CLIENTS.set(len(self.state), chat_code=self.chat_code)
+                logger.info(f"Forgot {len(gone)} clients that stopped renewing their lease")
+
+    def _peer_key_stored(self, peer_id, key):
+        self.state.set_peer_key(peer_id, base64.b64encode(key).decode('utf-8'))
+        trusted = self.peer_keys.trusted()
+        self.state.set_trusted_key(fingerprint(trusted) if trusted else None)
+
+    def _public_key_b64(self):
+        return base64.b64encode(self.public_key).decode('utf-8') if self.public_key else None
+
+    def _resume(self):
+        # Restored clients still hold the key of the previous run
+        if self.public_key:
+            self.announce_public_key()
+        self.resume_fanout()
+
+    def set_public_key(self, public_key):
+        """Changes this host's key and tells every connected client, so they stop using the old one."""
+        self.public_key = public_key
+        self.announce_public_key()
+
+    def announce_public_key(self):
+        """Pushes this host's public key to every connected client's /peer_key endpoint."""
+        payload = {'public_key': self._public_key_b64(), 'chat_code': self.chat_code}
+
+        def announce(client_url):
+            try:
+                response = requests.post(f"{client_url}/peer_key", json=payload, timeout=2)
+                if response.status_code != 200:
+                    # Clients without end-to-end encryption (the GUI) don't take keys
+                    logger.debug(f"{client_url} did not take the key announcement: {response.status_code}")
+            except Exception as e:
+                logger.debug(f"Could not announce our key to {client_url}: {e}")
+
+        wait([self.outbound.submit('control', announce, client_url) for client_url in self.state.client_urls()])
+
+    def resume_fanout(self):
+        """Pushes restored clients whatever was stored after their cursor (e.g. while a push was in flight).
+
+        Each client that is behind gets the records it missed in log order.
+        A client that fails a push is dropped (or, with a lease, suspended),
+        like in a normal broadcast.
+        """
+        end = log_size(self.chat_filename)
+        lagging = [url for url, cursor in self.state.cursors().items() if cursor < end]
+        if not lagging:
+            return
+        logger.info(f"Resuming fan-out to {len(lagging)} restored clients")
+        for url in lagging:
+            self._catch_up(url)
+
+    def _push_lock(self, client_url):
+        with self._push_locks_lock:
+            lock = self._push_locks.get(client_url)
+            if lock is None:
+                lock = self._push_locks[client_url] = threading.Lock()
+            return lock
+
+    def _catch_up(self, url):
+        """Pushes `url` the records after its cursor in log order. Returns False if a push failed."""
+        with self._push_lock(url):
+            cursor = self.state.cursor(url)
+            return cursor is not None and self._send_from(url, cursor)
+
+    def _send_from(self, url, cursor, live_only=False):
+        """_catch_up() for a caller that holds the client's push lock.
+
+        With `live_only` it stops as soon as the client's lease lapses; a
+        catch-up of a lapsed client (before extend()) leaves it False.
+        """
+        while True:
+            cursor, records = read_records_after(self.chat_filename, cursor, 100)
+            if not records:
+                return True
+            for offset, record in records:
+                if live_only and not self.state.is_live(url):
+                    return False
+                if not self._push_one(url, record, offset + len(record) + 1):
+                    return False
+
+    def renew_client(self, client_url):
+        """Renews a client's lease. Returns None if the client isn't known.
+
+        A client whose lease had lapsed is first sent what it missed, in a
+        background thread, and rejoins the fan-out once it has caught up.
+        """
+        lapsed = self.state.renew(client_url)
+        if not lapsed:
+            return lapsed
+        with self._catching_up_lock:
+            if client_url in self._catching_up:
+                return lapsed
+            self._catching_up.add(client_url)
+
+        def catch_up():
+            try:
+                if self._catch_up(client_url):
+                    self.state.extend(client_url)
+                    # Anything stored between the last read and extend() went to the live clients only
+                    self._catch_up(client_url)
+                    events.record("client.resumed", client=client_url)
+            finally:
+                with self._catching_up_lock:
+                    self._catching_up.discard(client_url)
+
+        self.outbound.submit('bulk', catch_up)
+        return lapsed
+
+    def _client_failed(self, client_url):
+        """A push failed: a leased client stops getting pushes until it renews, others are dropped."""
+        if self.state.lapse(client_url):
+            LEASES_LAPSED.inc()
+            logger.info(f"Suspended pushes to unreachable client until it renews its lease: {client_url}")
+            return
+        # Remove disconnected client
+        self.state.remove_client(client_url)
+        self._forget_push_lock(client_url)
+        CONNECTED_CLIENTS.set(len(self.state), chat_code=self.chat_code)
+        logger.info(f"Removed disconnected client: {client_url}")
+
+    def _forget_push_lock(self, client_url):
+        with self._push_locks_lock:
+            self._push_locks.pop(client_url, None)
+
+    def _push_one(self, client_url, record, end_offset):
+        try:
+            response = requests.post(
+                f"{client_url}/client_message",
+                json={'message': base64.b64encode(record).decode('utf-8'), 'offset': end_offset - len(record) - 1},
+                timeout=2
+            )
+            if response.status_code == 200:
+                self.state.advance(client_url, end_offset)
+                return True
+            logger.error(f"Error from {client_url}: {response.status_code} - {response.text}")
+            BROADCAST_FAILURES.inc(reason='status')
+        except Exception as e:
+            logger.error(f"Error resuming pushes to {client_url}: {e}")
+            BROADCAST_FAILURES.inc(reason='unreachable')
+            self._client_failed(client_url)
+        return False
+
     def stop(self):
+        self.state.stop_autosave()
+        self._heartbeat_stop.set()
+        self._reaper_stop.set()
+        self.outbound.shutdown()
+        if self.multicast:
+            self.multicast.close()
         if self.service_info:
             self.zeroconf.unregister_service(self.service_info)
-        self.zeroconf.close()
\ No newline at end of file
+            self.service_info = None
+        if self.zeroconf and self._owns_zeroconf:
+            self.zeroconf.close()
+        if self.http_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
\ No newline at end of file
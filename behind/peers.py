@@ -0,0 +1,94 @@
+import hashlib
+import threading
+
+import logging
+
+logger = logging.getLogger('pychat')
+
+
+def fingerprint(public_key):
+    """Short hex fingerprint of a public key, for logs and prompts."""
+    return hashlib.sha256(public_key).hexdigest()[:16]
+
+
+class PeerKeyStore:
+    """In-memory public keys of a session's peers, with change notifications.
+
+    The send path reads keys from here and never goes to the network; the
+    key exchange (POST /public_key, or a /peer_key push from the server)
+    writes them, and listeners hear about every key that is new or changed.
+
+    Anyone who can reach the server can register a key, so storing a key
+    doesn't make it the one messages are encrypted for. The first key stored
+    is trusted (trust on first use); any later one, also a new key of the
+    same peer, is only used once the user confirms its fingerprint with
+    trust().
+    """
+
+    def __init__(self):
+        self._keys = {}  # peer ID -> public key bytes
+        self._trusted = None  # key messages are encrypted for
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def set(self, peer_id, public_key):
+        """Stores a peer's key. Returns True (and notifies listeners) if it is new or changed."""
+        with self._lock:
+            if self._keys.get(peer_id) == public_key:
+                return False
+            self._keys[peer_id] = public_key
+            if self._trusted is None:
+                self._trusted = public_key
+            listeners = list(self._listeners)
+        logger.info(f"Peer key for {peer_id} is now {fingerprint(public_key)}")
+        self._notify(listeners, peer_id, public_key)
+        return True
+
+    def restore(self, peer_id, public_key, trusted=False):
+        """Stores a key saved by an earlier run, without notifying listeners or trusting it (unless `trusted`)."""
+        with self._lock:
+            self._keys[peer_id] = public_key
+            if trusted:
+                self._trusted = public_key
+
+    def trust(self, key_fingerprint):
+        """Encrypts for the stored key with this fingerprint from now on. Returns the key, or None if none has it."""
+        key_fingerprint = key_fingerprint.strip().lower()
+        with self._lock:
+            match = next(((peer_id, key) for peer_id, key in self._keys.items()
+                          if fingerprint(key) == key_fingerprint), None)
+            if match is None:
+                return None
+            self._trusted = match[1]
+            listeners = list(self._listeners)
+        logger.info(f"Trusting {match[0]}'s key {key_fingerprint}")
+        self._notify(listeners, *match)
+        return match[1]
+
+    def trusted(self):
+        """Returns the key messages are encrypted for, or None before any peer registered."""
+        with self._lock:
+            return self._trusted
+
+    @staticmethod
+    def _notify(listeners, peer_id, public_key):
+        for listener in listeners:
+            try:
+                listener(peer_id, public_key)
+            except Exception as e:
+                logger.error(f"Error in peer key listener: {e}")
+
+    def get(self, peer_id):
+        return self._keys.get(peer_id)
+
+    def subscribe(self, listener):
+        """Calls `listener(peer_id, public_key)` whenever a key is added or changes, or becomes trusted."""
+        with self._lock:
+            self._listeners.append(listener)
+
+    def items(self):
+        with self._lock:
+            return list(self._keys.items())
+
+    def __len__(self):
+        return len(self._keys)
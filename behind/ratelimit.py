@@ -0,0 +1,173 @@
+import time
+import threading
+from collections import OrderedDict
+
+# --- Default limits ---
+# Messages per second (sustained) and burst size for one remote address
+CLIENT_MESSAGE_RATE = 5.0
+CLIENT_MESSAGE_BURST = 20
+# /connect registrations per second and burst size for one remote address
+CLIENT_CONNECT_RATE = 0.5
+CLIENT_CONNECT_BURST = 5
+# Messages per second and burst size for one room (chat code)
+ROOM_MESSAGE_RATE = 50.0
+ROOM_MESSAGE_BURST = 200
+# Messages per second and burst size across every room in this process
+GLOBAL_MESSAGE_RATE = 500.0
+GLOBAL_MESSAGE_BURST = 2000
+# File chunk bytes per second and burst size for one remote address
+CLIENT_TRANSFER_RATE = 8 * 1024 * 1024
+CLIENT_TRANSFER_BURST = 32 * 1024 * 1024
+# File chunk bytes per second and burst size for one room
+ROOM_TRANSFER_RATE = 32 * 1024 * 1024
+ROOM_TRANSFER_BURST = 128 * 1024 * 1024
+# Callback clients a room keeps for broadcasts
+MAX_CALLBACK_CLIENTS = 64
+# Seconds a client is told to wait when the room's callback list is full
+CLIENTS_FULL_RETRY_AFTER = 30.0
+# Remote addresses with their own buckets (least recently seen ones are dropped)
+MAX_TRACKED_CLIENTS = 4096
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self, tokens=1):
+        """Takes `tokens` if available.
+
+        Returns:
+            0 if the tokens were taken, otherwise the number of seconds until
+            they would be available.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            if self.rate <= 0:
+                return float('inf')
+            return (tokens - self._tokens) / self.rate
+
+    def refund(self, tokens=1):
+        """Gives back tokens taken for a request that was rejected further along."""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + tokens)
+
+
+class _BucketMap:
+    """Per-key token buckets, bounded to the most recently used `max_keys`."""
+
+    def __init__(self, rate, burst, max_keys=MAX_TRACKED_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+
+# Shared by every room served from this process
+global_message_bucket = TokenBucket(GLOBAL_MESSAGE_RATE, GLOBAL_MESSAGE_BURST)
+
+
+class AdmissionController:
+    """Decides whether a room accepts a request, so one noisy peer can't flood it.
+
+    Messages have to get past the sender's own bucket, the room's bucket and
+    the process-wide bucket. /connect registrations have their own per-sender
+    bucket and a cap on the number of callback clients. File chunks are
+    counted in bytes, in per-sender and per-room buckets of their own, so an
+    upload neither runs out of message tokens nor uses up the room's chat budget.
+    """
+
+    def __init__(self, client_rate=CLIENT_MESSAGE_RATE, client_burst=CLIENT_MESSAGE_BURST,
+                 connect_rate=CLIENT_CONNECT_RATE, connect_burst=CLIENT_CONNECT_BURST,
+                 room_rate=ROOM_MESSAGE_RATE, room_burst=ROOM_MESSAGE_BURST,
+                 max_clients=MAX_CALLBACK_CLIENTS, global_bucket=None,
+                 transfer_rate=CLIENT_TRANSFER_RATE, transfer_burst=CLIENT_TRANSFER_BURST,
+                 room_transfer_rate=ROOM_TRANSFER_RATE, room_transfer_burst=ROOM_TRANSFER_BURST):
+        self.max_clients = max_clients
+        self._client_messages = _BucketMap(client_rate, client_burst)
+        self._client_connects = _BucketMap(connect_rate, connect_burst)
+        self._room = TokenBucket(room_rate, room_burst)
+        self._global = global_bucket or global_message_bucket
+        self._client_transfers = _BucketMap(transfer_rate, transfer_burst)
+        self._room_transfers = TokenBucket(room_transfer_rate, room_transfer_burst)
+
+    @classmethod
+    def unlimited(cls):
+        """An admission controller that admits everything (for benchmarks and tests)."""
+        huge = 1e12
+        return cls(client_rate=huge, client_burst=huge, connect_rate=huge, connect_burst=huge,
+                   room_rate=huge, room_burst=huge, max_clients=10**9, global_bucket=TokenBucket(huge, huge),
+                   transfer_rate=huge, transfer_burst=huge, room_transfer_rate=huge, room_transfer_burst=huge)
+
+    def admit_message(self, client_key):
+        """Returns (0, None) if a message from `client_key` is admitted, else (retry_after, reason)."""
+        client_bucket = self._client_messages.get(client_key)
+        retry_after = client_bucket.take()
+        if retry_after:
+            return retry_after, "client"
+
+        retry_after = self._room.take()
+        if retry_after:
+            client_bucket.refund()
+            return retry_after, "room"
+
+        retry_after = self._global.take()
+        if retry_after:
+            client_bucket.refund()
+            self._room.refund()
+            return retry_after, "global"
+
+        return 0, None
+
+    def admit_transfer(self, client_key, nbytes):
+        """Returns (0, None) if a file chunk of `nbytes` from `client_key` is admitted, else (retry_after, reason)."""
+        client_bucket = self._client_transfers.get(client_key)
+        # A chunk bigger than a whole burst would never fit; it costs a full bucket instead
+        client_cost = min(nbytes, client_bucket.burst)
+        retry_after = client_bucket.take(client_cost)
+        if retry_after:
+            return retry_after, "client_transfer"
+
+        room_cost = min(nbytes, self._room_transfers.burst)
+        retry_after = self._room_transfers.take(room_cost)
+        if retry_after:
+            client_bucket.refund(client_cost)
+            return retry_after, "room_transfer"
+
+        return 0, None
+
+    def admit_connect(self, client_key, client_url, clients):
+        """Returns (0, None) if `client_url` may register, else (retry_after, reason).
+
+        Re-registering a URL that is already in `clients` never counts against the cap.
+        """
+        retry_after = self._client_connects.get(client_key).take()
+        if retry_after:
+            return retry_after, "client"
+        if client_url not in clients and len(clients) >= self.max_clients:
+            return CLIENTS_FULL_RETRY_AFTER, "clients_full"
+        return 0, None
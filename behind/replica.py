@@ -0,0 +1,198 @@
+"""Client-side replica of a room's log, so history is read from local disk.
+
+A client keeps its own append-only copy of the server's chat log in
+chats/<code>.replica.txt, in the same format (records separated by a null
+byte). Because the copy is byte-for-byte the server's log prefix, a
+record's offset in the server's log is also its offset in the replica, and
+offsets serve as sequence numbers: a record is only appended when it
+starts exactly at the replica's end. Syncs also check that the record
+before that end is the same one the server has there, so a replaced log
+is noticed even after it grew past the replica. A pushed or polled record that starts
+further on means something was missed, and the gap is filled from
+/messages?after=<end> before anything else is appended. An empty replica
+is seeded from a /snapshot download.
+
+.history, the daemon's history command and the GUI's backfill then read
+the replica with the usual history.read_records_* functions, without a
+round trip to the server.
+"""
+import os
+import base64
+import tempfile
+import threading
+
+import requests
+
+import logging
+
+from .history import RECORD_SEPARATOR, read_records_after, record_id, record_ending_at
+from .metrics import registry
+from .snapshot import fetch_snapshot
+
+logger = logging.getLogger('pychat')
+
+SYNC_BATCH = 500
+REPLICA_SUFFIX = ".replica.txt"
+
+REPLICA_RECORDS = registry.counter('pychat_replica_records_total', 'Records appended to local log replicas', ['source'])
+REPLICA_GAPS = registry.counter('pychat_replica_gaps_total', 'Records that arrived past the end of a replica')
+
+
+def replica_path(chats_dir, chat_code):
+    return os.path.join(chats_dir, f"{chat_code}{REPLICA_SUFFIX}")
+
+
+class LogReplica:
+    """Append-only local copy of the log of a room hosted elsewhere.
+
+    Args:
+        path: Replica file (see replica_path)
+        server_url: Base URL of the room's server, to fill gaps from
+        session: requests session for syncs
+        bulk_session: requests session for the /snapshot download (default: `session`)
+    """
+
+    def __init__(self, path, server_url=None, session=None, bulk_session=None):
+        self.path = os.path.abspath(path)
+        self.server_url = server_url
+        self.session = session or requests.Session()
+        self.bulk_session = bulk_session or self.session
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.end = self._recover()
+        self._last_id = None  # record ID of the replica's last record, read on first use
+
+    def _recover(self):
+        """Cuts off a record that was only partly written (e.g. a crash mid-append); returns the end."""
+        if not os.path.exists(self.path):
+            open(self.path, 'ab').close()
+            return 0
+        with open(self.path, "rb+") as f:
+            size = f.seek(0, os.SEEK_END)
+            pos = size
+            while pos > 0:
+                step = min(65536, pos)
+                f.seek(pos - step)
+                block = f.read(step)
+                cut = block.rfind(RECORD_SEPARATOR)
+                if cut != -1:
+                    pos = pos - step + cut + 1
+                    break
+                pos -= step
+            if pos != size:
+                logger.warning(f"Dropping {size - pos} bytes of an incomplete record from {self.path}")
+                f.truncate(pos)
+        return pos
+
+    def append(self, offset, record, source='push'):
+        """Appends the record the server stored at `offset`.
+
+        Returns True if it was appended, False if the replica already had it.
+
+        Raises:
+            ValueError: `offset` is past the replica's end; sync() first
+        """
+        with self._lock:
+            if offset < self.end:
+                return False
+            if offset > self.end:
+                REPLICA_GAPS.inc()
+                raise ValueError(f"record at {offset} is past the replica's end {self.end}")
+            with open(self.path, "ab") as f:
+                f.write(record + RECORD_SEPARATOR)
+            self.end = offset + len(record) + 1
+            self._last_id = record_id(record)
+        REPLICA_RECORDS.inc(source=source)
+        return True
+
+    def receive(self, offset, record):
+        """Takes a pushed record. Returns the records that became new, in log order.
+
+        That's the record itself when it follows on; if it skips ahead, the
+        gap is filled from the server first and its records come back too.
+        Without an offset (servers from before replicas) the replica syncs.
+        """
+        if offset is not None:
+            try:
+                return [(offset, record)] if self.append(offset, record) else []
+            except ValueError:
+                pass
+        return self.sync()
+
+    def sync(self):
+        """Appends everything the server stored after the replica's end. Returns the new (offset, record)s.
+
+        Raises:
+            requests.RequestException: The server couldn't be reached
+        """
+        added = []
+        while True:
+            response = self.session.get(f"{self.server_url}/messages",
+                                        params={'after': self.end, 'limit': SYNC_BATCH}, timeout=5)
+            response.raise_for_status()
+            page = response.json()
+            if not isinstance(page, dict):
+                raise ValueError(f"{self.server_url} doesn't support incremental /messages")
+            if page.get('log_end', self.end) < self.end or not self._lines_up(page):
+                # The server started a new log; what we have no longer lines up with it
+                self.reset()
+                continue
+            for entry in page['messages']:
+                record = base64.b64decode(entry['message'])
+                if self.append(entry['offset'], record, source='sync'):
+                    added.append((entry['offset'], record))
+            if len(page['messages']) < SYNC_BATCH:
+                return added
+
+    def _lines_up(self, page):
+        """Whether the server's record before the page (its 'prev_id') is the replica's last record.
+
+        Servers from before 'prev_id' are taken at their word.
+        """
+        if 'prev_id' not in page or self.end == 0:
+            return True
+        with self._lock:
+            if self._last_id is None:
+                last = record_ending_at(self.path, self.end)
+                self._last_id = record_id(last) if last is not None else ''
+            return page['prev_id'] == self._last_id
+
+    def bootstrap(self):
+        """Seeds an empty replica from a /snapshot (one ranged download), then syncs the rest.
+
+        Returns the (offset, record)s that are new. A replica that already
+        has records only syncs what it missed while the client was away.
+        """
+        added = []
+        if self.end == 0:
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path) + "-", dir=os.path.dirname(self.path))
+            os.close(fd)
+            try:
+                fetch_snapshot(self.server_url, tmp, session=self.bulk_session)
+                with self._lock:
+                    if self.end == 0:
+                        os.replace(tmp, self.path)
+                        self.end = self._recover()
+                        self._last_id = None
+                cursor = 0
+                while cursor < self.end:
+                    cursor, records = read_records_after(self.path, cursor, SYNC_BATCH)
+                    if not records:
+                        break
+                    added.extend(records)
+                REPLICA_RECORDS.inc(len(added), source='snapshot')
+            except Exception as e:
+                # Servers from before /snapshot: sync pulls the log page by page instead
+                logger.warning(f"No snapshot from {self.server_url}, syncing the replica instead: {e}")
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        return added + self.sync()
+
+    def reset(self):
+        """Empties the replica, e.g. because the server's log was replaced."""
+        logger.warning(f"Server log of {self.path} was reset; starting the replica over")
+        with self._lock:
+            open(self.path, 'wb').close()
+            self.end = 0
+            self._last_id = None
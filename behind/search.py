@@ -0,0 +1,221 @@
+import os
+import re
+import json
+import threading
+
+import logging
+
+from .history import record_id, read_records_after
+from .metrics import registry
+
+logger = logging.getLogger('pychat')
+
+# Krypton verification tag size, stored in front of each segment's ciphertext
+VERIF_SIZE = 160
+LENGTH_SIZE = 4
+# Segments appended before the index file is rewritten as a single segment
+COMPACT_AFTER = 256
+DEFAULT_LIMIT = 20
+
+SEARCH_SECONDS = registry.histogram('pychat_search_seconds', 'Time to answer a search query')
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Splits text into the lowercase terms the index is keyed by."""
+    return _TOKEN.findall(text.lower())
+
+
+def load_or_create_key(path):
+    """Returns the 64-byte index key stored at `path`, creating it (0600) on first use."""
+    try:
+        with open(path, "rb") as f:
+            key = f.read()
+        if len(key) == 64:
+            return key
+        logger.warning(f"Ignoring malformed search index key at {path}")
+    except FileNotFoundError:
+        pass
+    key = os.urandom(64)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+class SearchIndex:
+    """Encrypted-at-rest inverted index over the decrypted messages of one chat.
+
+    Messages are added as they are decrypted, so a query never has to decrypt
+    the chat log again. The index lives in memory; on disk it is a sequence
+    of Krypton-encrypted segments, each holding the messages added since the
+    previous one. Every add() appends a segment, and the file is rewritten as
+    a single segment once COMPACT_AFTER of them pile up.
+
+    Args:
+        path: Index file
+        key: 64-byte key the segments are encrypted with
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.log_offset = 0  # chat log offset catch_up() has indexed up to
+        self._docs = {}  # record ID -> (seq, log offset or None, text)
+        self._postings = {}  # term -> set of record IDs
+        self._segments = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    # --- Storage ---
+
+    def _seal(self, plaintext):
+        from quantcrypt.cipher import Krypton
+        k = Krypton(self.key)
+        k.begin_encryption()
+        ct = k.encrypt(plaintext)
+        return k.finish_encryption() + ct
+
+    def _open(self, blob):
+        from quantcrypt.cipher import Krypton
+        k = Krypton(self.key)
+        k.begin_decryption(blob[:VERIF_SIZE])
+        pt = k.decrypt(blob[VERIF_SIZE:])
+        k.finish_decryption()
+        return pt
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + LENGTH_SIZE <= len(data):
+            size = int.from_bytes(data[pos:pos + LENGTH_SIZE], 'big')
+            blob = data[pos + LENGTH_SIZE:pos + LENGTH_SIZE + size]
+            if len(blob) < size:
+                logger.warning(f"Search index {self.path} ends in a partial segment; ignoring it")
+                break
+            try:
+                segment = json.loads(self._open(blob))
+            except Exception as e:
+                logger.error(f"Could not read search index {self.path}: {e}")
+                break
+            for rid, offset, text in segment['docs']:
+                self._add_doc(rid, offset, text)
+            self.log_offset = max(self.log_offset, segment.get('log_offset', 0))
+            self._segments += 1
+            pos += LENGTH_SIZE + size
+        logger.debug(f"Loaded search index {self.path}: {len(self._docs)} messages in {self._segments} segments")
+
+    def _segment(self, docs):
+        plaintext = json.dumps({'docs': docs, 'log_offset': self.log_offset}).encode('utf-8')
+        blob = self._seal(plaintext)
+        return len(blob).to_bytes(LENGTH_SIZE, 'big') + blob
+
+    def _append(self, docs):
+        with open(self.path, "ab") as f:
+            f.write(self._segment(docs))
+        self._segments += 1
+        if self._segments >= COMPACT_AFTER:
+            self._compact()
+
+    def _compact(self):
+        docs = [[rid, offset, text] for rid, (_, offset, text) in sorted(self._docs.items(), key=lambda d: d[1][0])]
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self._segment(docs))
+        os.replace(tmp, self.path)
+        self._segments = 1
+
+    # --- Indexing ---
+
+    def _add_doc(self, rid, offset, text):
+        if rid in self._docs:
+            return False
+        self._docs[rid] = (len(self._docs), offset, text)
+        for term in set(tokenize(text)):
+            self._postings.setdefault(term, set()).add(rid)
+        return True
+
+    def add(self, record, text, offset=None):
+        """Indexes the decrypted `text` of a stored record. Returns False if it was already indexed."""
+        return self.add_many([(record, text, offset)]) > 0
+
+    def add_many(self, messages):
+        """Indexes (record, text, offset) tuples, writing them as one segment. Returns how many were new."""
+        with self._lock:
+            new = []
+            for record, text, offset in messages:
+                rid = record_id(record)
+                if self._add_doc(rid, offset, text):
+                    new.append([rid, offset, text])
+            if new:
+                self._append(new)
+            return len(new)
+
+    def catch_up(self, log_path, decode, batch_size=500):
+        """Indexes the records appended to `log_path` since the last catch-up.
+
+        `decode` turns a raw record into its text, or None to skip it.
+        Returns the number of records indexed.
+        """
+        added = 0
+        while True:
+            end, records = read_records_after(log_path, self.log_offset, batch_size)
+            if not records:
+                break
+            messages = []
+            for offset, record in records:
+                text = decode(record)
+                if text:
+                    messages.append((record, text, offset))
+            with self._lock:
+                self.log_offset = end
+            added += self.add_many(messages)
+        return added
+
+    # --- Queries ---
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """Returns the newest messages containing every term of `query`.
+
+        A term ending in '*' matches any word starting with it. Each result is
+        a dict with the record 'id', its chat log 'offset' (None if unknown)
+        and the message 'text'.
+        """
+        with SEARCH_SECONDS.time(), self._lock:
+            terms = tokenize(query)
+            if not terms:
+                return []
+            prefixes = {t for t, wildcard in zip(terms, self._wildcards(query, terms)) if wildcard}
+
+            matches = None
+            # Intersect the rarest terms first
+            for term in sorted(set(terms), key=lambda t: len(self._postings.get(t, ()))):
+                if term in prefixes:
+                    ids = set().union(*(ids for word, ids in self._postings.items() if word.startswith(term)))
+                else:
+                    ids = self._postings.get(term, set())
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+
+            newest = sorted(matches, key=lambda rid: self._docs[rid][0], reverse=True)[:limit]
+            return [{'id': rid, 'offset': self._docs[rid][1], 'text': self._docs[rid][2]} for rid in newest]
+
+    @staticmethod
+    def _wildcards(query, terms):
+        # A term is a prefix search when the word in the query is followed by '*'
+        wildcards = []
+        pos = 0
+        lowered = query.lower()
+        for term in terms:
+            pos = lowered.find(term, pos) + len(term)
+            wildcards.append(lowered[pos:pos + 1] == '*')
+        return wildcards
+
+    def __len__(self):
+        return len(self._docs)
@@ -0,0 +1,126 @@
+"""Point-in-time snapshots of a room log, for bootstrapping late joiners.
+
+A chat log only ever grows, so its first N bytes never change once written;
+a snapshot is just that prefix, cut at a record boundary. GET /snapshot
+streams it as the raw log bytes (records separated by a null byte) instead
+of a JSON array of base64 strings, and supports Range requests so a client
+can fetch parts of one snapshot in parallel. The snapshot's end offset
+(X-Log-End) is the cursor to continue from with /messages?after=<offset>.
+"""
+import os
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import logging
+
+from .history import last_record_end
+from .metrics import registry
+
+logger = logging.getLogger('pychat')
+
+SNAPSHOT_BLOCK = 256 * 1024
+DEFAULT_PARTS = 4
+# Snapshots smaller than this per part aren't worth splitting
+MIN_PART_SIZE = 1024 * 1024
+END_HEADER = 'X-Log-End'
+
+SNAPSHOT_BYTES = registry.counter('pychat_snapshot_bytes_sent_total', 'Bytes of chat log sent by /snapshot')
+SNAPSHOT_SENDFILE_BYTES = registry.counter('pychat_snapshot_sendfile_bytes_total', 'Bytes of chat log sent by /snapshot with sendfile')
+
+
+def snapshot_end(path, end=None):
+    """Returns the end offset of a snapshot of `path`.
+
+    Without `end` that's the end of the last complete record, so a snapshot
+    taken while a record is being appended stops before it. A given `end`
+    (to fetch more parts of an earlier snapshot) must lie within the log, on
+    a record boundary.
+
+    Raises:
+        ValueError: `end` is past the log or in the middle of a record
+    """
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if end is None:
+        return last_record_end(path, size) if size else 0
+    if end < 0 or end > size:
+        raise ValueError(f"snapshot end {end} is outside the log")
+    if end:
+        with open(path, "rb") as f:
+            f.seek(end - 1)
+            if f.read(1) != b'\0':
+                raise ValueError(f"snapshot end {end} is not a record boundary")
+    return end
+
+
+def stream_range(path, start, stop, sock=None):
+    """Yields bytes [start, stop) of `path` for a WSGI response.
+
+    Given the plain (non-TLS) client socket, the first item is empty, which
+    makes the server flush the headers, and the body then goes out with
+    os.sendfile without passing through Python. Under TLS it is read and
+    yielded in blocks.
+    """
+    with open(path, "rb") as f:
+        if sock is not None and hasattr(os, 'sendfile') and not isinstance(sock, ssl.SSLSocket):
+            yield b''
+            offset = start
+            while offset < stop:
+                sent = os.sendfile(sock.fileno(), f.fileno(), offset, min(SNAPSHOT_BLOCK, stop - offset))
+                if not sent:
+                    break
+                offset += sent
+            SNAPSHOT_BYTES.inc(offset - start)
+            SNAPSHOT_SENDFILE_BYTES.inc(offset - start)
+            return
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = f.read(min(SNAPSHOT_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            SNAPSHOT_BYTES.inc(len(block))
+            yield block
+
+
+def _fetch_part(session, url, end, start, stop, fd):
+    response = session.get(url, params={'end': end}, headers={'Range': f"bytes={start}-{stop - 1}"},
+                           stream=True, timeout=30)
+    if response.status_code not in (200, 206):
+        raise IOError(f"snapshot range {start}-{stop - 1} failed: {response.status_code}")
+    offset = start
+    for block in response.iter_content(SNAPSHOT_BLOCK):
+        os.pwrite(fd, block, offset)
+        offset += len(block)
+    if offset != stop:
+        raise IOError(f"snapshot range {start}-{stop - 1} ended at {offset}")
+
+
+def fetch_snapshot(server_url, dest, session=None, parts=DEFAULT_PARTS):
+    """Downloads a snapshot of a room's log to `dest` with parallel range requests.
+
+    Returns the snapshot's end offset, the cursor for incremental sync.
+    """
+    session = session or requests.Session()
+    url = f"{server_url}/snapshot"
+    head = session.head(url, timeout=10)
+    head.raise_for_status()
+    end = int(head.headers[END_HEADER])
+
+    parts = max(1, min(parts, end // MIN_PART_SIZE))
+    bounds = [end * i // parts for i in range(parts + 1)]
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.ftruncate(fd, end)
+        if end:
+            with ThreadPoolExecutor(max_workers=parts) as pool:
+                futures = [pool.submit(_fetch_part, session, url, end, bounds[i], bounds[i + 1], fd)
+                           for i in range(parts)]
+                for future in futures:
+                    future.result()
+    finally:
+        os.close(fd)
+    logger.debug(f"Fetched {end} byte snapshot from {server_url} in {parts} parts")
+    return end
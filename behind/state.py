@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import threading
+
+import logging
+
+logger = logging.getLogger('pychat')
+
+# Seconds between snapshots while the state is changing
+SAVE_INTERVAL = 1.0
+# Snapshots older than this are ignored on start (their clients are long gone)
+MAX_SNAPSHOT_AGE = 24 * 60 * 60
+# Client leases, in seconds: clients heartbeat about three times per lease
+DEFAULT_LEASE = 30
+MIN_LEASE = 5
+MAX_LEASE = 300
+# Seconds a leased client stays registered after its lease ran out; a heartbeat in that time resumes it
+LEASE_GRACE = 10 * 60
+STATE_VERSION = 1
+
+
+class ServerState:
+    """Session state of a chat server that survives restarts.
+
+    Holds the callback URLs registered through /connect, how far into the
+    chat log each of them has been pushed, their leases, and peer public
+    keys. A client that registered with a lease only gets pushes while it
+    keeps renewing it; one without a lease stays until a push fails. Changes
+    only mark the state dirty; a background thread writes the snapshot at
+    most every `save_interval` seconds (and once more on stop), so the
+    message path never waits on the disk.
+
+    Args:
+        path: Snapshot file (written atomically)
+        save_interval: Seconds between background snapshots
+    """
+
+    def __init__(self, path, save_interval=SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+        self.clients = {}  # callback URL -> log offset just past the last record pushed to it
+        self.lease_ttls = {}  # callback URL -> lease length in seconds, for clients that heartbeat
+        self._expires = {}  # callback URL -> time.monotonic() its lease runs out
+        self.peer_keys = {}  # peer ID -> base64 public key
+        self.trusted_key = None  # fingerprint of the peer key messages are encrypted for
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop = threading.Event()
+        self._writer = None
+
+    # --- Clients ---
+
+    def add_client(self, url, cursor, lease=None):
+        """Registers a callback URL, starting its pushes at log offset `cursor`. Returns False if it was known.
+
+        With `lease` (seconds) the client must call renew() before it runs out
+        to keep getting pushes. A known client only has its lease length
+        updated; renew() it to find out whether it missed anything.
+        """
+        with self._lock:
+            if lease:
+                if self.lease_ttls.get(url) != lease:
+                    self.lease_ttls[url] = lease
+                    self._dirty = True
+            if url in self.clients:
+                return False
+            if lease:
+                self._expires[url] = time.monotonic() + lease
+            self.clients[url] = cursor
+            self._dirty = True
+            return True
+
+    def remove_client(self, url):
+        with self._lock:
+            self.lease_ttls.pop(url, None)
+            self._expires.pop(url, None)
+            if self.clients.pop(url, None) is not None:
+                self._dirty = True
+
+    def renew(self, url):
+        """Extends a client's live lease.
+
+        Returns None if the client isn't known, False if it was renewed (or
+        has no lease), and True if its lease had lapsed. A lapsed lease is
+        left lapsed so the caller can push the missed records before calling
+        extend(); otherwise new pushes would overtake them.
+        """
+        with self._lock:
+            if url not in self.clients:
+                return None
+            ttl = self.lease_ttls.get(url)
+            if ttl is None:
+                return False
+            now = time.monotonic()
+            if self._expires.get(url, 0) <= now:
+                return True
+            self._expires[url] = now + ttl
+            return False
+
+    def extend(self, url):
+        """Starts a new lease for a leased client, e.g. once it has caught up."""
+        with self._lock:
+            if url in self.lease_ttls:
+                self._expires[url] = time.monotonic() + self.lease_ttls[url]
+
+    def lapse(self, url):
+        """Ends a leased client's lease now (e.g. a push to it failed); its cursor is kept for a renewal.
+
+        Returns False for clients without a lease, which the caller should remove instead.
+        """
+        with self._lock:
+            if url not in self.lease_ttls:
+                return False
+            # Expired as of now, so reap() still gives it the full grace period to come back
+            now = time.monotonic()
+            self._expires[url] = min(self._expires.get(url, now), now)
+            return True
+
+    def live_client_urls(self):
+        """Clients to push to: those without a lease and those whose lease hasn't run out."""
+        now = time.monotonic()
+        with self._lock:
+            return [url for url in self.clients if url not in self.lease_ttls or self._expires.get(url, 0) > now]
+
+    def is_live(self, url):
+        """Whether `url` should get pushes: it's registered and its lease, if it has one, hasn't run out."""
+        with self._lock:
+            if url not in self.clients:
+                return False
+            return url not in self.lease_ttls or self._expires.get(url, 0) > time.monotonic()
+
+    def reap(self, grace=LEASE_GRACE):
+        """Forgets leased clients whose lease ran out more than `grace` seconds ago. Returns their URLs."""
+        cutoff = time.monotonic() - grace
+        with self._lock:
+            gone = [url for url, expires in self._expires.items() if expires <= cutoff]
+            for url in gone:
+                self.clients.pop(url, None)
+                self.lease_ttls.pop(url, None)
+                self._expires.pop(url, None)
+            if gone:
+                self._dirty = True
+        return gone
+
+    def advance(self, url, cursor):
+        """Records that everything before `cursor` has been pushed to `url`."""
+        with self._lock:
+            if url in self.clients and cursor > self.clients[url]:
+                self.clients[url] = cursor
+                self._dirty = True
+
+    def cursor(self, url):
+        """Offset just past the last record pushed to `url`, or None if it isn't registered."""
+        with self._lock:
+            return self.clients.get(url)
+
+    def client_urls(self):
+        with self._lock:
+            return list(self.clients)
+
+    def cursors(self):
+        with self._lock:
+            return dict(self.clients)
+
+    def __contains__(self, url):
+        return url in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    # --- Peer keys ---
+
+    def set_peer_key(self, peer_id, public_key_b64):
+        with self._lock:
+            if self.peer_keys.get(peer_id) != public_key_b64:
+                self.peer_keys[peer_id] = public_key_b64
+                self._dirty = True
+
+    def set_trusted_key(self, key_fingerprint):
+        with self._lock:
+            if self.trusted_key != key_fingerprint:
+                self.trusted_key = key_fingerprint
+                self._dirty = True
+
+    # --- Persistence ---
+
+    def load(self):
+        """Restores the last snapshot, if there is a recent one. Returns True if state was restored."""
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable session state {self.path}: {e}")
+            return False
+
+        if snapshot.get('version') != STATE_VERSION:
+            logger.warning(f"Ignoring session state {self.path} with unknown version {snapshot.get('version')}")
+            return False
+        age = time.time() - snapshot.get('saved_at', 0)
+        if age > MAX_SNAPSHOT_AGE:
+            logger.info(f"Ignoring session state saved {age / 3600:.1f} hours ago")
+            return False
+
+        with self._lock:
+            self.clients = {url: int(cursor) for url, cursor in snapshot.get('clients', {}).items()}
+            self.lease_ttls = {url: ttl for url, ttl in snapshot.get('leases', {}).items() if url in self.clients}
+            # Leased clients get one lease from now to send their next heartbeat
+            now = time.monotonic()
+            self._expires = {url: now + ttl for url, ttl in self.lease_ttls.items()}
+            self.peer_keys = dict(snapshot.get('peer_keys', {}))
+            self.trusted_key = snapshot.get('trusted_key')
+            self._dirty = False
+        logger.info(f"Restored session state: {len(self.clients)} clients, {len(self.peer_keys)} peer keys")
+        return True
+
+    def save(self, force=False):
+        """Writes a snapshot if anything changed since the last one (or always, with `force`)."""
+        with self._lock:
+            if not self._dirty and not force:
+                return False
+            snapshot = {
+                'version': STATE_VERSION,
+                'saved_at': time.time(),
+                'clients': dict(self.clients),
+                'leases': dict(self.lease_ttls),
+                'peer_keys': dict(self.peer_keys),
+                'trusted_key': self.trusted_key,
+            }
+            self._dirty = False
+        tmp = self.path + ".tmp"
+        # Peer keys are public, but callback URLs say who is in the chat
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, self.path)
+        return True
+
+    def start_autosave(self):
+        if self._writer:
+            return
+
+        def run():
+            while not self._stop.wait(self.save_interval):
+                try:
+                    self.save()
+                except Exception as e:
+                    logger.error(f"Error saving session state: {e}")
+
+        self._stop.clear()
+        self._writer = threading.Thread(target=run, name="pychat-state", daemon=True)
+        self._writer.start()
+
+    def stop_autosave(self):
+        self._stop.set()
+        if self._writer:
+            self._writer.join(timeout=5)
+            self._writer = None
+        self.save()
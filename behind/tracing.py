@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from .history import record_id
+
+import logging
+
+logger = logging.getLogger('pychat')
+
+
+def trace_id(record):
+    """Returns the trace ID of an encrypted record.
+
+    The ID is derived from the record itself, so the sender, the server and
+    every receiver tag the same message with the same ID without any change
+    to the wire format.
+    """
+    return record_id(record)[:16]
+
+
+class Tracer:
+    """Records timed spans per message and appends them to a trace file.
+
+    The file uses the Chrome trace-event JSON array format, which Perfetto
+    (ui.perfetto.dev) and chrome://tracing open directly. The closing bracket
+    is optional in that format, so events are appended as they happen and a
+    crashed process still leaves a readable trace. Timestamps are wall-clock
+    so traces written by the sender, server and receivers line up when merged.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = bool(path)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+                self._file = open(self.path, "a", buffering=1)
+                if new_file:
+                    self._file.write("[\n")
+            self._file.write(line + ",\n")
+
+    def record(self, name, start, end, trace_id=None, **args):
+        """Records a span that already finished. `start` and `end` come from time.time()."""
+        if not self.enabled:
+            return
+        if trace_id:
+            args['trace_id'] = trace_id
+        try:
+            self._write({
+                'name': name,
+                'cat': 'pychat',
+                'ph': 'X',
+                'ts': int(start * 1_000_000),
+                'dur': max(0, int((end - start) * 1_000_000)),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+        except Exception as e:
+            logger.error(f"Error writing trace event: {e}")
+
+    @contextmanager
+    def span(self, name, trace_id=None, **args):
+        """Times the body of a `with` block as one span."""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time(), trace_id, **args)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def merge_traces(output_path, input_paths):
+    """Merges trace files from several processes into one file for the viewer."""
+    events = []
+    for path in input_paths:
+        with open(path) as f:
+            text = f.read().strip().rstrip(',')
+        if not text.endswith(']'):
+            text += ']'
+        events.extend(json.loads(text))
+    events.sort(key=lambda e: e.get('ts', 0))
+    with open(output_path, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
+
+
+# Tracing is opt-in: set PYCHAT_TRACE to the trace file path for this process
+tracer = Tracer(os.environ.get("PYCHAT_TRACE"))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python -m behind.tracing <merged.json> <trace.json> [<trace.json> ...]")
+        sys.exit(1)
+    count = merge_traces(sys.argv[1], sys.argv[2:])
+    print(f"Wrote {count} events to {sys.argv[1]}")
@@ -0,0 +1,367 @@
+import os
+import re
+import json
+import time
+import uuid
+import base64
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+
+logger = logging.getLogger('pychat')
+
+# Plaintext bytes per chunk; every chunk is encrypted and uploaded on its own
+CHUNK_SIZE = 256 * 1024
+# Chunks transferred at the same time
+DEFAULT_WORKERS = 4
+# Krypton verification tag size, stored in front of each chunk's ciphertext
+VERIF_SIZE = 160
+# Times a chunk request turned away with 429/503 is retried, and the longest Retry-After honoured
+MAX_RETRIES = 10
+MAX_RETRY_AFTER = 30.0
+
+FILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+_kem = None
+
+
+def _get_kem():
+    global _kem
+    if _kem is None:
+        from quantcrypt.kem import MLKEM_1024
+        _kem = MLKEM_1024()
+    return _kem
+
+
+def _session_key(shared_secret):
+    """Expands the transfer's 32-byte KEM shared secret into its 64-byte Krypton session key.
+
+    One key seals the metadata and every chunk: Krypton picks a fresh random
+    nonce and salt for each encryption, so reusing the key is safe.
+    """
+    from Cryptodome.Hash import SHA3_512
+    return SHA3_512.new(shared_secret + b'pychat-file').digest()
+
+
+def _chunk_label(index):
+    return b'chunk' + index.to_bytes(8, 'big')
+
+
+def _seal(key, label, plaintext):
+    """Encrypts `label` + `plaintext`; the label ties the ciphertext to its place in the transfer."""
+    from quantcrypt.cipher import Krypton
+    k = Krypton(key)
+    k.begin_encryption()
+    ct = k.encrypt(label + plaintext)
+    verif = k.finish_encryption()
+    return verif + ct
+
+
+def _open(key, label, blob):
+    """Decrypts a _seal() blob, checking it was sealed for `label` (a server can't swap chunks around)."""
+    from quantcrypt.cipher import Krypton
+    k = Krypton(key)
+    k.begin_decryption(blob[:VERIF_SIZE])
+    pt = k.decrypt(blob[VERIF_SIZE:])
+    k.finish_decryption()
+    if not pt.startswith(label):
+        raise ValueError(f"Sealed data belongs to {pt[:len(label)]!r}, not {label!r}")
+    return pt[len(label):]
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _send(http, method, url, **kwargs):
+    """Makes a request, waiting out the server's Retry-After while it is rate limited or busy.
+
+    Raises:
+        requests.HTTPError: The request failed, or was still turned away after MAX_RETRIES waits
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        response = http.request(method, url, **kwargs)
+        if response.status_code not in (429, 503) or attempt == MAX_RETRIES:
+            break
+        try:
+            retry_after = float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            retry_after = 1.0
+        logger.debug(f"{url} answered {response.status_code}; retrying in {retry_after}s")
+        time.sleep(min(max(retry_after, 0.0), MAX_RETRY_AFTER))
+    response.raise_for_status()
+    return response
+
+
+# --- Server-side storage ---
+
+class FileStore:
+    """Stores uploaded (still encrypted) file chunks out of band from the chat log.
+
+    Layout: <root>/<file_id>/manifest.json plus one chunk_<index> file per
+    chunk. The server never sees plaintext; it only checks that each chunk
+    matches the hash the uploader sent with it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _dir(self, file_id):
+        if not FILE_ID_PATTERN.match(file_id or ''):
+            raise ValueError("invalid file id")
+        return os.path.join(self.root, file_id)
+
+    def _manifest_path(self, file_id):
+        return os.path.join(self._dir(file_id), "manifest.json")
+
+    def _chunk_path(self, file_id, index):
+        return os.path.join(self._dir(file_id), f"chunk_{index}")
+
+    def _write_manifest(self, file_id, manifest):
+        path = self._manifest_path(file_id)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, path)
+
+    def create(self, file_id, encaps, meta, chunk_count):
+        """Registers a new upload. Creating an upload that already exists is a no-op (for resumes)."""
+        directory = self._dir(file_id)
+        with self._lock:
+            if os.path.exists(self._manifest_path(file_id)):
+                return self.manifest(file_id)
+            os.makedirs(directory, exist_ok=True)
+            manifest = {
+                'file_id': file_id,
+                'encaps': encaps,
+                'meta': meta,
+                'chunk_count': int(chunk_count),
+                'chunk_hashes': {},
+                'complete': False,
+            }
+            self._write_manifest(file_id, manifest)
+            return manifest
+
+    def manifest(self, file_id):
+        """Returns the manifest of an upload, or None if it doesn't exist."""
+        try:
+            with open(self._manifest_path(file_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_chunk(self, file_id, index, data, expected_hash):
+        """Stores one chunk after checking it against `expected_hash`."""
+        manifest = self.manifest(file_id)
+        if manifest is None:
+            raise KeyError(file_id)
+        if manifest['complete']:
+            raise ValueError("upload already complete")
+        if not 0 <= index < manifest['chunk_count']:
+            raise ValueError("chunk index out of range")
+        if sha256_hex(data) != expected_hash:
+            raise ValueError("chunk hash mismatch")
+
+        path = self._chunk_path(file_id, index)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            manifest = self.manifest(file_id)
+            manifest['chunk_hashes'][str(index)] = expected_hash
+            self._write_manifest(file_id, manifest)
+
+    def chunk_path(self, file_id, index):
+        """Returns the path of a stored chunk, or None."""
+        path = self._chunk_path(file_id, index)
+        return path if os.path.exists(path) else None
+
+    def complete(self, file_id):
+        """Marks an upload complete. Returns the indexes of chunks that are still missing."""
+        with self._lock:
+            manifest = self.manifest(file_id)
+            if manifest is None:
+                raise KeyError(file_id)
+            missing = [i for i in range(manifest['chunk_count']) if str(i) not in manifest['chunk_hashes']]
+            if not missing:
+                manifest['complete'] = True
+                self._write_manifest(file_id, manifest)
+            return missing
+
+
+# --- Client side ---
+
+def _state_path(state_dir, file_id):
+    return os.path.join(state_dir, f"upload_{file_id}.json")
+
+
+def find_upload(state_dir, path):
+    """Returns the file ID of an unfinished upload of `path`, or None."""
+    path = os.path.abspath(path)
+    if not os.path.isdir(state_dir):
+        return None
+    for entry in os.listdir(state_dir):
+        if not (entry.startswith("upload_") and entry.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(state_dir, entry)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if state.get('path') == path:
+            return entry[len("upload_"):-len(".json")]
+    return None
+
+
+def start_upload(server_url, path, public_key, state_dir, session=None, chunk_size=CHUNK_SIZE):
+    """Registers an upload of `path` for the holder of `public_key` and returns its file ID.
+
+    The session secret is kept in `state_dir` (created with 0700 permissions)
+    so an interrupted upload can be resumed with upload_file(..., file_id=...).
+    """
+    import requests
+    http = session or requests
+
+    size = os.path.getsize(path)
+    chunk_count = max(1, -(-size // chunk_size))
+    encaps, shared = _get_kem().encaps(public_key)
+    file_id = uuid.uuid4().hex
+
+    # Only the recipient can read the name and size
+    whole_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            whole_hash.update(block)
+    meta = {
+        'name': os.path.basename(path),
+        'size': size,
+        'chunk_size': chunk_size,
+        'sha256': whole_hash.hexdigest(),
+    }
+    sealed_meta = _seal(_session_key(shared), b'meta', json.dumps(meta).encode('utf-8'))
+
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    state_file = _state_path(state_dir, file_id)
+    with open(state_file, "w") as f:
+        json.dump({'path': os.path.abspath(path), 'secret': base64.b64encode(shared).decode('utf-8'),
+                   'chunk_size': chunk_size, 'chunk_count': chunk_count}, f)
+    os.chmod(state_file, 0o600)
+
+    response = http.post(f"{server_url}/files", json={
+        'file_id': file_id,
+        'encaps': base64.b64encode(encaps).decode('utf-8'),
+        'meta': base64.b64encode(sealed_meta).decode('utf-8'),
+        'chunk_count': chunk_count,
+    }, timeout=10)
+    response.raise_for_status()
+    return file_id
+
+
+def upload_file(server_url, path, public_key, state_dir, file_id=None, workers=DEFAULT_WORKERS,
+                session=None, progress=None):
+    """Uploads `path` in encrypted chunks, `workers` at a time, skipping chunks the server already has.
+
+    Pass the `file_id` of an interrupted upload to resume it. Returns the file ID.
+    """
+    import requests
+    http = session or requests
+
+    if file_id is None:
+        file_id = start_upload(server_url, path, public_key, state_dir, session=session)
+    with open(_state_path(state_dir, file_id)) as f:
+        state = json.load(f)
+    key = _session_key(base64.b64decode(state['secret']))
+    chunk_size = state['chunk_size']
+
+    status = http.get(f"{server_url}/files/{file_id}", timeout=10)
+    status.raise_for_status()
+    present = {int(i) for i in status.json().get('chunk_hashes', {})}
+    missing = [i for i in range(state['chunk_count']) if i not in present]
+    logger.info(f"Uploading {len(missing)} of {state['chunk_count']} chunks for {file_id}")
+
+    def send_chunk(index):
+        with open(state['path'], "rb") as f:
+            f.seek(index * chunk_size)
+            blob = _seal(key, _chunk_label(index), f.read(chunk_size))
+        _send(http, 'PUT', f"{server_url}/files/{file_id}/chunks/{index}",
+              data=blob,
+              headers={'Content-Type': 'application/octet-stream', 'X-Chunk-SHA256': sha256_hex(blob)},
+              timeout=30)
+        if progress:
+            progress(index)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(send_chunk, missing))
+
+    response = http.post(f"{server_url}/files/{file_id}/complete", timeout=10)
+    response.raise_for_status()
+    os.remove(_state_path(state_dir, file_id))
+    return file_id
+
+
+def download_file(server_url, file_id, private_key, dest_dir, workers=DEFAULT_WORKERS, session=None, progress=None):
+    """Downloads and decrypts a file, `workers` chunks at a time. Returns the saved path.
+
+    Chunks already written to the .part file by an interrupted download are
+    not fetched again.
+    """
+    import requests
+    http = session or requests
+
+    response = http.get(f"{server_url}/files/{file_id}", timeout=10)
+    response.raise_for_status()
+    manifest = response.json()
+    if not manifest.get('complete'):
+        raise ValueError(f"Upload {file_id} is not complete yet")
+
+    shared = _get_kem().decaps(private_key, base64.b64decode(manifest['encaps']))
+    key = _session_key(shared)
+    meta = json.loads(_open(key, b'meta', base64.b64decode(manifest['meta'])))
+    chunk_size = meta['chunk_size']
+
+    os.makedirs(dest_dir, exist_ok=True)
+    part_path = os.path.join(dest_dir, f".{file_id}.part")
+    done_path = part_path + ".done"
+    done = set()
+    if os.path.exists(part_path) and os.path.exists(done_path):
+        with open(done_path) as f:
+            done = {int(line) for line in f if line.strip()}
+    else:
+        with open(part_path, "wb") as f:
+            f.truncate(meta['size'])
+    done_lock = threading.Lock()
+
+    def fetch_chunk(index):
+        blob = _send(http, 'GET', f"{server_url}/files/{file_id}/chunks/{index}", timeout=30).content
+        if sha256_hex(blob) != manifest['chunk_hashes'][str(index)]:
+            raise ValueError(f"Chunk {index} of {file_id} failed hash verification")
+        data = _open(key, _chunk_label(index), blob)
+        with open(part_path, "r+b") as f:
+            f.seek(index * chunk_size)
+            f.write(data)
+        with done_lock:
+            with open(done_path, "a") as f:
+                f.write(f"{index}\n")
+        if progress:
+            progress(index)
+
+    missing = [i for i in range(manifest['chunk_count']) if i not in done]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(fetch_chunk, missing))
+
+    whole_hash = hashlib.sha256()
+    with open(part_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            whole_hash.update(block)
+    if whole_hash.hexdigest() != meta['sha256']:
+        raise ValueError(f"{meta['name']} failed hash verification")
+
+    final_path = os.path.join(dest_dir, os.path.basename(meta['name']))
+    os.replace(part_path, final_path)
+    os.remove(done_path)
+    return final_path
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import platform
+import subprocess
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize_latencies(latencies):
+    """Returns count, mean and p50/p99/p999/max in milliseconds."""
+    values = sorted(latencies)
+    if not values:
+        return {'count': 0}
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'count': len(values),
+        'mean_ms': ms(sum(values) / len(values)),
+        'p50_ms': ms(percentile(values, 50)),
+        'p99_ms': ms(percentile(values, 99)),
+        'p999_ms': ms(percentile(values, 99.9)),
+        'max_ms': ms(values[-1]),
+    }
+
+
+def process_stats(pid):
+    """Reads CPU seconds, current RSS and peak RSS of a process from /proc (Linux only)."""
+    stats = {'cpu_seconds': None, 'rss_mb': None, 'peak_rss_mb': None}
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+        stats['cpu_seconds'] = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss_mb'] = round(int(line.split()[1]) / 1024, 2)
+                elif line.startswith('VmHWM:'):
+                    stats['peak_rss_mb'] = round(int(line.split()[1]) / 1024, 2)
+    except (OSError, ValueError, IndexError):
+        pass
+    return stats
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, host='127.0.0.1', timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def make_self_signed_cert(directory):
+    """Creates a throwaway self-signed cert with openssl, like other/post_install.sh does."""
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-keyout", key, "-out", cert,
+         "-days", "1", "-nodes", "-subj", "/CN=localhost"],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def environment_info():
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def write_report(report, output_path=None):
+    """Writes a benchmark report as JSON to a file, or to stdout."""
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
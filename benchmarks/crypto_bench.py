@@ -0,0 +1,240 @@
+"""Micro-benchmarks for the message crypto path (encrypt_message/decrypt_message).
+
+Measures, for each payload size:
+- single-thread operations per second of the full encrypt and decrypt paths
+- the cost of each stage: ML-KEM encaps/decaps, the SHA3-512 key expansion and Krypton
+- peak traced memory and net allocated blocks per operation
+and, across payload sizes, multi-process encrypt/decrypt throughput.
+
+Results are written as JSON and can be saved as, or compared against, a baseline:
+
+    python -m benchmarks.crypto_bench --save-baseline benchmarks/baselines/crypto.json
+    python -m benchmarks.crypto_bench --baseline benchmarks/baselines/crypto.json --fail-on-regression
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .common import environment_info, write_report
+
+DEFAULT_SIZES = (16, 256, 1024, 4096, 16384, 65536)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "crypto.json")
+
+
+def measure_ops(fn, min_time=0.5, min_runs=5):
+    """Calls `fn` repeatedly for at least `min_time` seconds; returns ops/s and mean microseconds per op."""
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while runs < min_runs or elapsed < min_time:
+        fn()
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return {
+        'ops_per_s': round(runs / elapsed, 2),
+        'mean_us': round(elapsed / runs * 1_000_000, 2),
+        'runs': runs,
+    }
+
+
+def measure_allocations(fn, runs=20):
+    """Peak traced bytes and net allocated blocks for one call of `fn`, averaged over `runs`."""
+    fn()  # warm caches so one-off allocations don't count
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(runs):
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - base)
+    finally:
+        tracemalloc.stop()
+    return {
+        'peak_bytes_per_op': int(sum(peaks) / len(peaks)),
+        'net_blocks_per_op': round((sys.getallocatedblocks() - blocks_before) / runs, 2),
+    }
+
+
+def _stages(kem, public_key, private_key, size):
+    """Returns the individual stages of encrypt_message/decrypt_message as callables."""
+    from Cryptodome.Hash import SHA3_512
+    from quantcrypt.cipher import Krypton
+
+    plaintext = b"a" * size
+    encaps, shared = kem.encaps(public_key)
+    key64 = SHA3_512.new(shared).digest()
+    k = Krypton(key64)
+    k.begin_encryption()
+    ct = k.encrypt(plaintext)
+    verif = k.finish_encryption()
+
+    def krypton_encrypt():
+        k = Krypton(key64)
+        k.begin_encryption()
+        k.encrypt(plaintext)
+        k.finish_encryption()
+
+    def krypton_decrypt():
+        k = Krypton(key64)
+        k.begin_decryption(verif)
+        k.decrypt(ct)
+
+    return {
+        'kem_encaps': lambda: kem.encaps(public_key),
+        'kem_decaps': lambda: kem.decaps(private_key, encaps),
+        'kdf_sha3_512': lambda: SHA3_512.new(shared).digest(),
+        'krypton_encrypt': krypton_encrypt,
+        'krypton_decrypt': krypton_decrypt,
+    }
+
+
+def _throughput_worker(args):
+    op, size, duration = args
+    from behind.main import kem, encrypt_message, decrypt_message, decrypt_cache
+    # Measure the decrypt path itself, not cache hits on the same payload
+    decrypt_cache.enabled = False
+    public_key, private_key = kem.keygen()
+    message = "a" * size
+    payload = encrypt_message(message, public_key)
+    fn = (lambda: encrypt_message(message, public_key)) if op == 'encrypt' else (lambda: decrypt_message(payload, private_key))
+    runs = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        fn()
+        runs += 1
+    return runs, time.perf_counter() - start
+
+
+def measure_multiprocess(op, size, processes, duration):
+    """Aggregate ops/s of `op` ('encrypt' or 'decrypt') across `processes` worker processes."""
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=ctx) as pool:
+        results = list(pool.map(_throughput_worker, [(op, size, duration)] * processes))
+    return {
+        'processes': processes,
+        'ops_per_s': round(sum(runs / elapsed for runs, elapsed in results), 2),
+    }
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, min_time=0.5, processes=None, mp_duration=2.0, mp_size=1024):
+    """Runs the crypto benchmarks and returns the report as a dict."""
+    from behind.main import kem, encrypt_message, decrypt_message, decrypt_cache
+
+    # Measure the decrypt path itself, not cache hits on the same payload
+    decrypt_cache.enabled = False
+    public_key, private_key = kem.keygen()
+    results = {}
+    for size in sizes:
+        message = "a" * size
+        payload = encrypt_message(message, public_key)
+        encrypt = lambda: encrypt_message(message, public_key)
+        decrypt = lambda: decrypt_message(payload, private_key)
+
+        entry = {
+            'ciphertext_bytes': len(payload),
+            'encrypt_message': measure_ops(encrypt, min_time),
+            'decrypt_message': measure_ops(decrypt, min_time),
+            'stages': {name: measure_ops(fn, min_time) for name, fn in _stages(kem, public_key, private_key, size).items()},
+            'allocations': {
+                'encrypt_message': measure_allocations(encrypt),
+                'decrypt_message': measure_allocations(decrypt),
+            },
+        }
+        results[str(size)] = entry
+
+    processes = processes or os.cpu_count() or 1
+    multiprocess = {
+        'size_bytes': mp_size,
+        'encrypt_message': measure_multiprocess('encrypt', mp_size, processes, mp_duration),
+        'decrypt_message': measure_multiprocess('decrypt', mp_size, processes, mp_duration),
+    }
+
+    return {
+        'benchmark': 'crypto',
+        'environment': environment_info(),
+        'config': {'sizes': list(sizes), 'min_time_s': min_time, 'processes': processes},
+        'results': results,
+        'multiprocess': multiprocess,
+    }
+
+
+def _flatten(report):
+    """Maps 'size/op' (and 'size/stages/stage') to mean microseconds per op."""
+    flat = {}
+    for size, entry in report.get('results', {}).items():
+        for op in ('encrypt_message', 'decrypt_message'):
+            flat[f"{size}/{op}"] = entry[op]['mean_us']
+        for stage, timing in entry.get('stages', {}).items():
+            flat[f"{size}/stages/{stage}"] = timing['mean_us']
+    return flat
+
+
+def compare_to_baseline(report, baseline, threshold=0.10):
+    """Compares mean times against a baseline report.
+
+    Returns a dict of per-metric changes; an entry is a regression when it got
+    slower by more than `threshold` (a fraction).
+    """
+    current = _flatten(report)
+    previous = _flatten(baseline)
+    changes = {}
+    for key, value in current.items():
+        if key not in previous or not previous[key]:
+            continue
+        change = (value - previous[key]) / previous[key]
+        changes[key] = {
+            'baseline_us': previous[key],
+            'current_us': value,
+            'change': round(change, 4),
+            'regression': change > threshold,
+        }
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for encrypt_message/decrypt_message")
+    parser.add_argument("--sizes", type=lambda v: [int(s) for s in v.split(',')], default=list(DEFAULT_SIZES),
+                        help="comma-separated payload sizes in bytes")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run each measurement for")
+    parser.add_argument("--processes", type=int, help="worker processes for the multi-process run (default: CPU count)")
+    parser.add_argument("--mp-duration", type=float, default=2.0, help="seconds each worker process runs for")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help=f"compare against this baseline report (e.g. {DEFAULT_BASELINE})")
+    parser.add_argument("--save-baseline", help="also save this run as a baseline report")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown fraction counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 if anything regressed")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(sizes=args.sizes, min_time=args.min_time,
+                           processes=args.processes, mp_duration=args.mp_duration)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            changes = compare_to_baseline(report, json.load(f), args.threshold)
+        report['baseline_comparison'] = {'baseline': args.baseline, 'threshold': args.threshold, 'changes': changes}
+        regressions = [key for key, change in changes.items() if change['regression']]
+        report['baseline_comparison']['regressions'] = regressions
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        write_report(report, args.save_baseline)
+    write_report(report, args.output)
+
+    if regressions and args.fail_on_regression:
+        print(f"Regressions beyond {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
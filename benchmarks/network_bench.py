@@ -0,0 +1,421 @@
+"""Loopback load generator and latency benchmark for NetworkManager.
+
+Starts a NetworkManager in a separate process (no mDNS, self-signed TLS),
+then drives simulated senders against /message while push receivers (the
+/client_message callback path) and poll receivers (/messages) measure how long
+each message takes to arrive. The report is JSON so runs can be diffed.
+
+With --workers the server is a sharded cluster (behind/cluster.py) instead,
+and senders and receivers are spread round-robin over --rooms rooms.
+
+    python -m benchmarks.network_bench --senders 4 --rate 50 --size 2048 --duration 20 --output bench.json
+    python -m benchmarks.network_bench --workers 4 --rooms 16 --senders 32 --push-receivers 16 --no-tls
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .common import (
+    summarize_latencies,
+    process_stats,
+    free_port,
+    wait_for_port,
+    make_self_signed_cert,
+    environment_info,
+    write_report,
+)
+
+# Payloads are plain text so they can't contain the null byte the chat log uses as a separator
+PAYLOAD_MAGIC = "PCBM"
+
+
+def make_payload(sender, seq, size):
+    header = f"{PAYLOAD_MAGIC} {sender} {seq} {time.time():.6f} "
+    return (header + "x" * max(0, size - len(header))).encode('ascii')
+
+
+def parse_payload(payload):
+    """Returns (sender, seq, sent_at) for a benchmark payload, or None."""
+    parts = payload[:64].split(b' ', 4)
+    if len(parts) < 4 or parts[0] != PAYLOAD_MAGIC.encode('ascii'):
+        return None
+    try:
+        return int(parts[1]), int(parts[2]), float(parts[3])
+    except ValueError:
+        return None
+
+
+def _run_server(port, chats_dir, ssl_context, rate_limits, ready, stop):
+    # Keep Flask's startup banner out of a report written to stdout
+    sys.stdout = open(os.devnull, "w")
+    from behind.network import NetworkManager
+    from behind.ratelimit import AdmissionController
+    # Every simulated client shares 127.0.0.1, so per-address limits would throttle the whole run
+    admission = AdmissionController() if rate_limits else AdmissionController.unlimited()
+    manager = NetworkManager("bench", "bench", host='127.0.0.1', port=port, ssl_context=ssl_context,
+                             advertise=False, chats_dir=chats_dir, admission=admission)
+    manager.start()
+    ready.set()
+    stop.wait()
+    manager.stop()
+
+
+class BenchServer:
+    """Runs a NetworkManager on loopback in a child process."""
+
+    def __init__(self, workdir, tls=True, rate_limits=False):
+        self.workdir = workdir
+        self.port = free_port()
+        self.ssl_context = make_self_signed_cert(workdir) if tls else None
+        self.scheme = "https" if tls else "http"
+        ctx = multiprocessing.get_context("spawn")
+        self._ready = ctx.Event()
+        self._stop = ctx.Event()
+        self.process = ctx.Process(
+            target=_run_server,
+            args=(self.port, workdir, self.ssl_context, rate_limits, self._ready, self._stop),
+            daemon=True,
+        )
+
+    @property
+    def url(self):
+        return f"{self.scheme}://127.0.0.1:{self.port}"
+
+    def room_urls(self, rooms):
+        return [self.url]
+
+    def metrics_urls(self):
+        return [f"{self.url}/metrics"]
+
+    def start(self):
+        self.process.start()
+        if not self._ready.wait(30) or not wait_for_port(self.port):
+            raise RuntimeError("Benchmark server did not start")
+
+    def stats(self):
+        return process_stats(self.process.pid)
+
+    def stop(self):
+        self._stop.set()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class ClusterBenchServer:
+    """Runs a sharded cluster on loopback, with one worker process per shard."""
+
+    def __init__(self, workdir, workers, tls=True, rate_limits=False):
+        from behind.cluster import ShardedServer
+        self.cluster = ShardedServer("bench", workers=workers, host='127.0.0.1',
+                                     ssl_context=make_self_signed_cert(workdir) if tls else False,
+                                     chats_dir=workdir, advertise=False, rate_limits=rate_limits)
+
+    def room_urls(self, rooms):
+        return [self.cluster.room_url(f"bench{i}") for i in range(rooms)]
+
+    def metrics_urls(self):
+        return [f"{self.cluster.scheme}://127.0.0.1:{port}/metrics" for port in self.cluster.ports]
+
+    def start(self):
+        self.cluster.start()
+        for port in self.cluster.ports:
+            if not wait_for_port(port):
+                raise RuntimeError("Benchmark cluster did not start")
+
+    def stats(self):
+        """Totals over the worker processes."""
+        stats = [process_stats(pid) for pid in self.cluster.pids()]
+        total = {}
+        for key in ('cpu_seconds', 'rss_mb', 'peak_rss_mb'):
+            values = [s[key] for s in stats]
+            total[key] = round(sum(values), 3) if values and None not in values else None
+        return total
+
+    def stop(self):
+        self.cluster.stop()
+
+
+class PushReceiver:
+    """A client registered through /connect that records delivery latency of pushed messages."""
+
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.latencies = []
+        self.received = 0
+        self._lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                arrived = time.time()
+                try:
+                    payload = base64.b64decode(json.loads(body)['message'])
+                    info = parse_payload(payload)
+                    if info:
+                        with receiver._lock:
+                            receiver.received += 1
+                            receiver.latencies.append(arrived - info[2])
+                except Exception:
+                    pass
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"status": "ok"}')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self, session):
+        self.thread.start()
+        session.post(f"{self.server_url}/connect", json={'url': f"http://127.0.0.1:{self.port}"}, timeout=5)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class PollReceiver:
+    """A client that polls /messages like client_message_listener and records when messages show up."""
+
+    def __init__(self, server_url, interval, session):
+        self.server_url = server_url
+        self.interval = interval
+        self.session = session
+        self.latencies = []
+        self.poll_durations = []
+        self.errors = 0
+        self._seen = set()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        last_poll = 0
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                response = self.session.get(f"{self.server_url}/messages", params={'since': last_poll}, timeout=5)
+                arrived = time.time()
+                self.poll_durations.append(arrived - started)
+                for message_b64 in response.json():
+                    info = parse_payload(base64.b64decode(message_b64))
+                    if info and info[:2] not in self._seen:
+                        self._seen.add(info[:2])
+                        self.latencies.append(arrived - info[2])
+                last_poll = started
+            except Exception:
+                self.errors += 1
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join(timeout=10)
+
+
+class Sender:
+    """Posts messages to /message at a fixed rate."""
+
+    def __init__(self, sender_id, server_url, rate, size, session, room=0):
+        self.sender_id = sender_id
+        self.server_url = server_url
+        self.room = room
+        self.rate = rate
+        self.size = size
+        self.session = session
+        self.sent = 0
+        self.accepted = 0
+        self.errors = 0
+        self.request_latencies = []
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        start = time.time()
+        seq = 0
+        while not self._stop.is_set():
+            # Fixed schedule, so a slow server shows up as latency instead of a lower send rate
+            delay = start + seq / self.rate - time.time()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            payload = make_payload(self.sender_id, seq, self.size)
+            seq += 1
+            self.sent += 1
+            before = time.perf_counter()
+            try:
+                response = self.session.post(
+                    f"{self.server_url}/message",
+                    json={'message': base64.b64encode(payload).decode('utf-8')},
+                    timeout=5,
+                )
+                self.request_latencies.append(time.perf_counter() - before)
+                if response.ok:
+                    self.accepted += 1
+                else:
+                    self.errors += 1
+            except requests.exceptions.RequestException:
+                self.errors += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join(timeout=10)
+
+
+def _session(verify):
+    session = requests.Session()
+    session.verify = verify
+    # Loopback only: ignore proxy and CA-bundle environment variables (the latter would override verify)
+    session.trust_env = False
+    return session
+
+
+def run_benchmark(senders=2, push_receivers=2, poll_receivers=1, rate=20.0, size=1024,
+                  duration=10.0, drain=3.0, poll_interval=0.5, tls=True, rate_limits=False, workers=0, rooms=1):
+    """Runs one benchmark and returns the report as a dict."""
+    if tls:
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    if not workers:
+        # A single NetworkManager hosts one room
+        rooms = 1
+
+    with tempfile.TemporaryDirectory(prefix="pychat-bench-") as workdir:
+        if workers:
+            server = ClusterBenchServer(workdir, workers, tls=tls, rate_limits=rate_limits)
+        else:
+            server = BenchServer(workdir, tls=tls, rate_limits=rate_limits)
+        server.start()
+        room_urls = server.room_urls(rooms)
+        verify = False
+        try:
+            pushers = [PushReceiver(room_urls[i % rooms]) for i in range(push_receivers)]
+            for receiver in pushers:
+                receiver.start(_session(verify))
+            pollers = [PollReceiver(room_urls[i % rooms], poll_interval, _session(verify))
+                       for i in range(poll_receivers)]
+            for receiver in pollers:
+                receiver.start()
+
+            stats_before = server.stats()
+            started = time.time()
+            clients = [Sender(i, room_urls[i % rooms], rate, size, _session(verify), room=i % rooms)
+                       for i in range(senders)]
+            for client in clients:
+                client.start()
+            time.sleep(duration)
+            for client in clients:
+                client.stop()
+            elapsed = time.time() - started
+
+            # Let in-flight pushes and the next polls land
+            time.sleep(drain)
+            stats_after = server.stats()
+            metrics_text = "".join(_session(verify).get(url, timeout=5).text for url in server.metrics_urls())
+
+            for receiver in pollers:
+                receiver.stop()
+            for receiver in pushers:
+                receiver.stop()
+        finally:
+            server.stop()
+
+    accepted = sum(c.accepted for c in clients)
+    # Each accepted message is pushed to the receivers of its own room
+    pushes_expected = sum(c.accepted * sum(1 for r in pushers if r.server_url == room_urls[c.room]) for c in clients)
+    push_latencies = [v for r in pushers for v in r.latencies]
+    poll_latencies = [v for r in pollers for v in r.latencies]
+    cpu_seconds = None
+    if stats_before['cpu_seconds'] is not None and stats_after['cpu_seconds'] is not None:
+        cpu_seconds = round(stats_after['cpu_seconds'] - stats_before['cpu_seconds'], 3)
+
+    return {
+        'benchmark': 'network',
+        'environment': environment_info(),
+        'config': {
+            'senders': senders, 'push_receivers': push_receivers, 'poll_receivers': poll_receivers,
+            'rate_per_sender': rate, 'size_bytes': size, 'duration_s': duration,
+            'poll_interval_s': poll_interval, 'tls': tls, 'rate_limits': rate_limits,
+            'workers': workers, 'rooms': rooms,
+        },
+        'throughput': {
+            'sent': sum(c.sent for c in clients),
+            'accepted': accepted,
+            'send_errors': sum(c.errors for c in clients),
+            'accepted_per_s': round(accepted / elapsed, 2) if elapsed else None,
+            'pushes_expected': pushes_expected,
+            'pushes_delivered': sum(r.received for r in pushers),
+            'poll_errors': sum(r.errors for r in pollers),
+        },
+        'latency': {
+            'send_request': summarize_latencies([v for c in clients for v in c.request_latencies]),
+            'push_delivery': summarize_latencies(push_latencies),
+            'poll_delivery': summarize_latencies(poll_latencies),
+            'poll_request': summarize_latencies([v for r in pollers for v in r.poll_durations]),
+        },
+        'server': {
+            'cpu_seconds': cpu_seconds,
+            'cpu_utilization': round(cpu_seconds / elapsed, 3) if cpu_seconds is not None and elapsed else None,
+            'rss_mb': stats_after['rss_mb'],
+            'peak_rss_mb': stats_after['peak_rss_mb'],
+        },
+        'server_metrics': metrics_text,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback throughput and latency benchmark for NetworkManager")
+    parser.add_argument("--senders", type=int, default=2, help="simulated clients posting to /message")
+    parser.add_argument("--push-receivers", type=int, default=2, help="clients registered for /client_message pushes")
+    parser.add_argument("--poll-receivers", type=int, default=1, help="clients polling /messages")
+    parser.add_argument("--rate", type=float, default=20.0, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=1024, help="payload size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send for")
+    parser.add_argument("--drain", type=float, default=3.0, help="seconds to wait for deliveries after sending stops")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="seconds between polls")
+    parser.add_argument("--no-tls", action="store_true", help="serve plain HTTP instead of a self-signed cert")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the server's default admission limits")
+    parser.add_argument("--workers", type=int, default=0, help="run a sharded cluster with this many worker processes")
+    parser.add_argument("--rooms", type=int, default=1, help="rooms to spread clients over (needs --workers)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(
+        senders=args.senders,
+        push_receivers=args.push_receivers,
+        poll_receivers=args.poll_receivers,
+        rate=args.rate,
+        size=args.size,
+        duration=args.duration,
+        drain=args.drain,
+        poll_interval=args.poll_interval,
+        tls=not args.no_tls,
+        rate_limits=args.rate_limits,
+        workers=args.workers,
+        rooms=args.rooms,
+    )
+    write_report(report, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""Regression check: the log offsets pushed with each record match the server's chat log.
+
+Starts a NetworkManager in a child process (like network_bench), registers
+one push receiver, posts --messages records from --concurrency threads at
+once and then checks every push against the log file: the offset it
+carried must be where exactly that record starts, and every record must
+arrive once. Exits with status 1 if any push is off.
+
+    python -m benchmarks.push_offsets --messages 2000 --concurrency 64
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .common import environment_info, write_report
+from .network_bench import BenchServer, make_payload, _session
+
+
+class OffsetReceiver:
+    """A push client that keeps every (offset, record) it is sent."""
+
+    def __init__(self):
+        self.pushes = []
+        self._lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                with receiver._lock:
+                    receiver.pushes.append((body.get('offset'), base64.b64decode(body['message'])))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"status": "ok"}')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def count(self):
+        with self._lock:
+            return len(self.pushes)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def check_pushes(log, pushes, sent):
+    """Returns a list of problems with `pushes` given the server's `log` bytes and the `sent` records."""
+    problems = []
+    for offset, record in pushes:
+        end = offset + len(record) if offset is not None else -1
+        if offset is None or offset < 0 or end >= len(log):
+            problems.append(f"offset {offset} is outside the log")
+        elif (offset and log[offset - 1] != 0) or log[offset:end] != record or log[end] != 0:
+            problems.append(f"offset {offset} is not where the {len(record)}-byte record starts")
+    received = [record for _, record in pushes]
+    if len(set(received)) != len(received):
+        problems.append(f"{len(received) - len(set(received))} records were pushed more than once")
+    missing = set(sent) - set(received)
+    if missing:
+        problems.append(f"{len(missing)} records were never pushed")
+    return problems
+
+
+def run_check(messages=2000, concurrency=64, size=2048, timeout=30.0):
+    """Runs one check and returns the report as a dict."""
+    with tempfile.TemporaryDirectory() as workdir:
+        server = BenchServer(workdir, tls=False)
+        receiver = OffsetReceiver()
+        session = _session(False)
+        server.start()
+        receiver.thread.start()
+        try:
+            session.post(f"{server.url}/connect", json={'url': receiver.url}, timeout=5).raise_for_status()
+            sent = [make_payload(0, seq, size) for seq in range(messages)]
+
+            def post(record):
+                response = session.post(f"{server.url}/message",
+                                        json={'message': base64.b64encode(record).decode('ascii')}, timeout=10)
+                return response.status_code
+
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                statuses = list(pool.map(post, sent))
+            deadline = time.time() + timeout
+            while receiver.count() < messages and time.time() < deadline:
+                time.sleep(0.1)
+            with open(os.path.join(workdir, "bench.txt"), "rb") as f:
+                log = f.read()
+            problems = check_pushes(log, list(receiver.pushes), sent)
+        finally:
+            receiver.stop()
+            server.stop()
+
+    rejected = sum(1 for status in statuses if status != 200)
+    if rejected:
+        problems.append(f"{rejected} posts were rejected")
+    return {
+        'environment': environment_info(),
+        'config': {'messages': messages, 'concurrency': concurrency, 'size': size},
+        'pushes': len(receiver.pushes),
+        'problems': problems,
+        'passed': not problems,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the offsets pushed with concurrently posted records")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64, help="threads posting at once")
+    parser.add_argument("--size", type=int, default=2048, help="record size in bytes")
+    parser.add_argument("--timeout", type=float, default=30.0, help="seconds to wait for the pushes")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_check(args.messages, args.concurrency, args.size, args.timeout)
+    write_report(report, args.output)
+    return 0 if report['passed'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
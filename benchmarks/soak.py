@@ -0,0 +1,297 @@
+"""Long-running soak test that looks for memory growth.
+
+Runs a NetworkManager in a child process under sustained simulated traffic
+(senders, push receivers that come and go, pollers) while a ServiceListener
+in the same process sees a steady churn of services appearing and
+disappearing. The child samples its RSS and a tracemalloc snapshot every
+--interval seconds and reports the allocation sites that grew most since
+the baseline taken after --warmup. The run fails (exit status 1) when RSS
+grows by more than --max-rss-growth MB over the baseline, and is
+inconclusive (exit status 2) when it ends before a sample after the
+baseline was taken.
+
+    python -m benchmarks.soak --duration 14400 --interval 300 --output soak.json
+"""
+import os
+import gc
+import sys
+import time
+import queue
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+
+from .common import process_stats, free_port, wait_for_port, make_self_signed_cert, environment_info, write_report
+from .network_bench import PushReceiver, PollReceiver, Sender, _session
+
+# Samples from the baseline on needed to judge growth: the baseline and at least one later one
+MIN_SAMPLES = 2
+# Allocations made by the measuring itself aren't interesting
+TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+class _FakeInfo:
+    """Stands in for a zeroconf ServiceInfo of a peer that comes and goes."""
+
+    def __init__(self, chat_code):
+        self.properties = {b'chat_code': chat_code.encode('utf-8')}
+        self.port = 443
+
+    def addresses_by_version(self, version):
+        return [b'\x7f\x00\x00\x01']
+
+
+class _FakeZeroconf:
+    def get_service_info(self, type, name):
+        return _FakeInfo(name.split('.')[0])
+
+
+def _churn_discovery(listener, rate, stop):
+    """Adds and later removes a new service `rate` times a second, like peers joining and leaving."""
+    from behind.network import SERVICE_TYPE
+    zeroconf = _FakeZeroconf()
+    live = []
+    n = 0
+    while not stop.wait(1.0 / rate):
+        name = f"soak{n}.{SERVICE_TYPE}"
+        n += 1
+        listener.add_service(zeroconf, SERVICE_TYPE, name)
+        live.append(name)
+        if len(live) > 20:
+            listener.remove_service(zeroconf, SERVICE_TYPE, live.pop(0))
+
+
+def _sample(baseline, top, extra):
+    gc.collect()
+    # RSS first: the snapshot below allocates a lot, and the allocator keeps some of it
+    rss_mb = process_stats(os.getpid())['rss_mb']
+    if not tracemalloc.is_tracing():
+        sample = {'time': time.time(), 'rss_mb': rss_mb, 'top_growth': []}
+        sample.update(extra())
+        return None, sample
+    # tracemalloc's own bookkeeping grows with the number of live blocks; it isn't ours
+    overhead_mb = tracemalloc.get_tracemalloc_memory() / 1024 / 1024
+    snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+    stats = snapshot.compare_to(baseline, 'lineno')[:top] if baseline else []
+    traced, _ = tracemalloc.get_traced_memory()
+    sample = {
+        'time': time.time(),
+        'rss_mb': round(rss_mb - overhead_mb, 2),
+        'tracemalloc_overhead_mb': round(overhead_mb, 2),
+        'traced_mb': round(traced / 1024 / 1024, 3),
+        'top_growth': [
+            {'site': str(stat.traceback), 'size_diff_kb': round(stat.size_diff / 1024, 1), 'count_diff': stat.count_diff}
+            for stat in stats if stat.size_diff > 0
+        ],
+    }
+    sample.update(extra())
+    return snapshot, sample
+
+
+def _run_subject(port, chats_dir, ssl_context, churn_rate, interval, warmup, top, frames, samples, ready, stop):
+    # Keep Flask's startup banner out of a report written to stdout
+    sys.stdout = open(os.devnull, "w")
+    # Pushes to receivers that just vanished fail by design; don't drown the progress lines
+    logging.getLogger('pychat').setLevel(logging.CRITICAL)
+    if frames:
+        tracemalloc.start(frames)
+    from behind.network import NetworkManager
+    from behind.ratelimit import AdmissionController
+    from behind.discovery import ServiceListener
+    manager = NetworkManager("soak", "soak", host='127.0.0.1', port=port, ssl_context=ssl_context,
+                             advertise=False, chats_dir=chats_dir, admission=AdmissionController.unlimited())
+    manager.start()
+    listener = ServiceListener()
+    churn_stop = threading.Event()
+    if churn_rate:
+        threading.Thread(target=_churn_discovery, args=(listener, churn_rate, churn_stop), daemon=True).start()
+    ready.set()
+
+    extra = lambda: {'connected_clients': len(manager.state), 'found_services': len(listener.found_services),
+                     'threads': threading.active_count()}
+    baseline = None
+    taken = 0
+    next_sample = time.time() + warmup
+    while not stop.wait(max(0, next_sample - time.time())):
+        snapshot, sample = _sample(baseline, top, extra)
+        sample['baseline'] = taken == 0
+        if taken == 0:
+            baseline = snapshot
+        taken += 1
+        samples.put(sample)
+        next_sample += interval
+    churn_stop.set()
+    manager.stop()
+
+
+class SoakSubject:
+    """The NetworkManager (and discovery listener) under test, in a child process."""
+
+    def __init__(self, workdir, tls, churn_rate, interval, warmup, top, frames):
+        self.port = free_port()
+        self.ssl_context = make_self_signed_cert(workdir) if tls else None
+        self.url = f"{'https' if tls else 'http'}://127.0.0.1:{self.port}"
+        ctx = multiprocessing.get_context("spawn")
+        self.samples = ctx.Queue()
+        self._ready = ctx.Event()
+        self._stop = ctx.Event()
+        self.process = ctx.Process(
+            target=_run_subject,
+            args=(self.port, workdir, self.ssl_context, churn_rate, interval, warmup, top, frames,
+                  self.samples, self._ready, self._stop),
+            daemon=True,
+        )
+
+    def start(self):
+        self.process.start()
+        if not self._ready.wait(30) or not wait_for_port(self.port):
+            raise RuntimeError("Soak server did not start")
+
+    def drain(self):
+        samples = []
+        while True:
+            try:
+                samples.append(self.samples.get_nowait())
+            except queue.Empty:
+                return samples
+
+    def stop(self):
+        self._stop.set()
+        self.process.join(timeout=15)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def run_soak(duration=3600.0, interval=60.0, warmup=60.0, senders=4, rate=10.0, size=512,
+             push_receivers=4, poll_receivers=1, receiver_churn=10.0, discovery_churn=5.0,
+             max_rss_growth=50.0, top=10, frames=5, tls=False, progress=None):
+    """Runs one soak test and returns the report as a dict."""
+    if tls:
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    samples = []
+    with tempfile.TemporaryDirectory(prefix="pychat-soak-") as workdir:
+        subject = SoakSubject(workdir, tls, discovery_churn, interval, warmup, top, frames)
+        subject.start()
+        try:
+            pushers = [PushReceiver(subject.url) for _ in range(push_receivers)]
+            for receiver in pushers:
+                receiver.start(_session(False))
+            pollers = [PollReceiver(subject.url, 1.0, _session(False)) for _ in range(poll_receivers)]
+            for receiver in pollers:
+                receiver.start()
+            clients = [Sender(i, subject.url, rate, size, _session(False)) for i in range(senders)]
+            for client in clients:
+                client.start()
+
+            started = time.time()
+            next_churn = started + receiver_churn if receiver_churn else None
+            replaced = 0
+            while time.time() - started < duration:
+                time.sleep(1)
+                if next_churn and time.time() >= next_churn:
+                    # A client leaves without saying so and a new one connects, as laptops do
+                    pushers.pop(0).stop()
+                    receiver = PushReceiver(subject.url)
+                    receiver.start(_session(False))
+                    pushers.append(receiver)
+                    replaced += 1
+                    next_churn += receiver_churn
+                for sample in subject.drain():
+                    samples.append(sample)
+                    if progress:
+                        progress(sample)
+
+            for client in clients:
+                client.stop()
+            for receiver in pollers + pushers:
+                receiver.stop()
+        finally:
+            subject.stop()
+            samples.extend(subject.drain())
+
+    start = next((i for i, s in enumerate(samples) if s.get('baseline')), None)
+    measured = samples[start:] if start is not None else []
+    baseline, last = (measured[0], measured[-1]) if measured else (None, None)
+    growth = None
+    if len(measured) >= MIN_SAMPLES and baseline['rss_mb'] is not None and last['rss_mb'] is not None:
+        growth = round(last['rss_mb'] - baseline['rss_mb'], 2)
+    # Too short a run (or no RSS readings) says nothing about growth, so it doesn't pass either
+    status = 'inconclusive' if growth is None else 'passed' if growth <= max_rss_growth else 'failed'
+    return {
+        'benchmark': 'soak',
+        'environment': environment_info(),
+        'config': {
+            'duration_s': duration, 'interval_s': interval, 'warmup_s': warmup, 'senders': senders,
+            'rate_per_sender': rate, 'size_bytes': size, 'push_receivers': push_receivers,
+            'poll_receivers': poll_receivers, 'receiver_churn_s': receiver_churn,
+            'discovery_churn_per_s': discovery_churn, 'max_rss_growth_mb': max_rss_growth, 'tls': tls,
+        },
+        'traffic': {
+            'sent': sum(c.sent for c in clients),
+            'accepted': sum(c.accepted for c in clients),
+            'send_errors': sum(c.errors for c in clients),
+            'receivers_replaced': replaced,
+        },
+        'rss_growth_mb': growth,
+        'status': status,
+        'passed': status == 'passed',
+        'final_top_growth': last['top_growth'] if last else [],
+        'samples': samples,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Soak test NetworkManager and discovery for memory growth")
+    parser.add_argument("--duration", type=float, default=3600.0, help="seconds to run for")
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between memory samples")
+    parser.add_argument("--warmup", type=float, default=60.0, help="seconds before the baseline sample")
+    parser.add_argument("--senders", type=int, default=4, help="simulated clients posting to /message")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=512, help="payload size in bytes")
+    parser.add_argument("--push-receivers", type=int, default=4, help="clients registered for pushes")
+    parser.add_argument("--poll-receivers", type=int, default=1, help="clients polling /messages")
+    parser.add_argument("--receiver-churn", type=float, default=10.0,
+                        help="seconds between a push receiver vanishing and a new one connecting (0: off)")
+    parser.add_argument("--discovery-churn", type=float, default=5.0,
+                        help="services appearing (and later disappearing) per second (0: off)")
+    parser.add_argument("--max-rss-growth", type=float, default=50.0, help="fail above this RSS growth in MB")
+    parser.add_argument("--top", type=int, default=10, help="growing allocation sites to report")
+    parser.add_argument("--frames", type=int, default=5, help="traceback depth tracemalloc records (0: RSS only, no tracemalloc)")
+    parser.add_argument("--tls", action="store_true", help="serve a self-signed cert instead of plain HTTP")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    def progress(sample):
+        print(f"rss {sample['rss_mb']} MB, traced {sample.get('traced_mb')} MB, "
+              f"clients {sample['connected_clients']}, services {sample['found_services']}, "
+              f"threads {sample['threads']}", file=sys.stderr)
+
+    report = run_soak(
+        duration=args.duration, interval=args.interval, warmup=args.warmup, senders=args.senders,
+        rate=args.rate, size=args.size, push_receivers=args.push_receivers, poll_receivers=args.poll_receivers,
+        receiver_churn=args.receiver_churn, discovery_churn=args.discovery_churn,
+        max_rss_growth=args.max_rss_growth, top=args.top, frames=args.frames, tls=args.tls, progress=progress,
+    )
+    write_report(report, args.output)
+    if report['status'] == 'inconclusive':
+        print(f"Inconclusive: fewer than {MIN_SAMPLES} memory samples from the baseline on; "
+              f"run for longer than --warmup plus --interval", file=sys.stderr)
+        return 2
+    if not report['passed']:
+        print(f"RSS grew by {report['rss_growth_mb']} MB (limit {args.max_rss_growth} MB)", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
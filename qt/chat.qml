@@ -3,13 +3,6 @@ import QtQuick.Controls
 import QtQuick.Layouts
 
 Page {
-    Connections {
-        target: chatBridge
-        function onMessageReceived(sender, message) {
-            chatModel.append({ sender: sender, message: message });
-        }
-    }
-
     ColumnLayout {
         anchors.fill: parent
         spacing: 10
@@ -18,8 +11,18 @@ Page {
             id: messageView
             Layout.fillWidth: true
             Layout.fillHeight: true
-            model: ListModel {
-                id: chatModel
+            model: chatMessageModel
+
+            // Page history in from the chat log as the user scrolls
+            onAtYBeginningChanged: {
+                if (atYBeginning) {
+                    chatMessageModel.fetchOlder();
+                }
+            }
+            onAtYEndChanged: {
+                if (atYEnd) {
+                    chatMessageModel.fetchNewer();
+                }
             }
 
             delegate: Rectangle {
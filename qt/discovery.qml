@@ -33,7 +33,7 @@ Page {
                 
                 onClicked: {
                     console.log("Selected user: " + modelData.name + " at " + modelData.address + ":" + modelData.port)
-                    chatBridge.connect_to_peer(modelData.address, modelData.port)
+                    chatBridge.connect_to_service(modelData.name, modelData.addresses, modelData.port)
                     swipeView.currentIndex = 2
                 }
             }
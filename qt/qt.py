@@ -1,19 +1,24 @@
 import os
 import sys
+import time
+import json
 import logging
-from datetime import datetime
+import threading
+
+# Taken before the heavy imports so the startup report covers them
+_process_start = time.perf_counter()
+
 from PySide6.QtWidgets import QApplication, QMessageBox
-from PySide6.QtQuick import QQuickView
-from PySide6.QtCore import QUrl, QObject, Signal, Slot, Property, QTimer
+from PySide6.QtCore import QUrl, QObject, Signal, Slot, Property, QTimer, Qt, QAbstractListModel, QModelIndex, QMetaObject
 from PySide6.QtQml import QQmlApplicationEngine
-from zeroconf import ServiceBrowser, Zeroconf
 import socket
 
-# Import backend modules
+# Import backend modules. Only the lightweight ones are imported here; the
+# network stack (flask, zeroconf, requests) and the crypto backend (quantcrypt)
+# are imported after the first frame is on screen.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from behind import NetworkManager, main
 from behind.config import initialize_directories
-from behind.network import SERVER_PORT
+from behind.history import log_size, read_records_before, read_records_after
 
 def get_local_ip():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -27,7 +32,50 @@ def get_local_ip():
         s.close()
     return IP
 
+class StartupTimer:
+    """Records how long each startup phase took, for the startup report.
+
+    Set PYCHAT_STARTUP_REPORT to a file path to have the report written there
+    as JSON once background warm-up has finished; set PYCHAT_STARTUP_EXIT=1 to
+    quit right after writing it (used by `make startup-report`).
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        """Record that `phase` finished, in milliseconds since the process started."""
+        with self._lock:
+            if phase not in self.phases:
+                self.phases[phase] = round((time.perf_counter() - _process_start) * 1000, 2)
+                logger.debug(f"Startup phase {phase} at {self.phases[phase]} ms")
+
+    def write_report(self, path):
+        with self._lock:
+            report = {'phases_ms': dict(self.phases), 'python': sys.version.split()[0]}
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Wrote startup report to {path}")
+
+startup_timer = StartupTimer()
+
+def warm_up(on_done=None):
+    """Import and initialise the network and crypto backends off the GUI thread."""
+    def run():
+        try:
+            from behind import network  # flask, zeroconf, requests
+            startup_timer.mark('network_ready')
+            from behind import main  # quantcrypt; creates the ML-KEM instance
+            startup_timer.mark('crypto_ready')
+        except Exception as e:
+            logger.error(f"Background warm-up failed: {e}")
+        if on_done:
+            on_done()
 
+    thread = threading.Thread(target=run, name="pychat-warmup", daemon=True)
+    thread.start()
+    return thread
 
 # variables for qml
 class NameModel(QObject):
@@ -68,7 +116,238 @@ class ChatCodeModel(QObject):
             self._chat_code = value
             self.chatCodeChanged.emit()
 
-from zeroconf import ServiceBrowser, Zeroconf
+def parse_chat_line(text):
+    """Splits a "SenderName: The message" line into (sender, message)."""
+    parts = text.split(':', 1)
+    if len(parts) == 2:
+        return parts[0].strip(), parts[1].strip()
+    return "Unknown", text
+
+def decode_record(record):
+    """Decodes a stored chat record into (sender, message)."""
+    try:
+        return parse_chat_line(record.decode('utf-8'))
+    except UnicodeDecodeError:
+        return "Unknown", "[Encrypted message]"
+
+class ChatMessageModel(QAbstractListModel):
+    """Chat messages for the chat view, holding only a bounded window of the chat log.
+
+    Older (and, after scrolling back, newer) records are paged in from the log
+    on demand, and rows that fall out of the window are dropped. Each row
+    remembers the log offset it sits at, so dropped rows can be read back in.
+    Messages that were never written to the local log (our own sends to a
+    remote peer) only live in the window.
+    """
+
+    SenderRole = Qt.UserRole + 1
+    MessageRole = Qt.UserRole + 2
+
+    def __init__(self, window_size=500, page_size=100, parent=None):
+        super().__init__(parent)
+        self.window_size = window_size
+        self.page_size = page_size
+        self._rows = []  # (offset, sender, message)
+        self._path = None
+        self._head = 0  # log offset of the first row in the window
+        self._tail = 0  # log offset just past the last record in the window
+        self._following = True  # window ends at the live end of the log
+
+    def roleNames(self):
+        return {
+            self.SenderRole: b'sender',
+            self.MessageRole: b'message',
+        }
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self._rows):
+            return None
+        _, sender, message = self._rows[index.row()]
+        if role == self.SenderRole:
+            return sender
+        if role in (self.MessageRole, Qt.DisplayRole):
+            return message
+        return None
+
+    def open_log(self, path):
+        """Shows the most recent page of the chat log at `path`."""
+        self.beginResetModel()
+        self._path = path
+        self._tail = log_size(path)
+        self._head, records = read_records_before(path, self._tail, self.page_size)
+        self._rows = [(offset, *decode_record(record)) for offset, record in records]
+        self._following = True
+        self.endResetModel()
+        logger.debug(f"Opened chat log {path} with {len(self._rows)} recent messages")
+
+    def apply_batch(self, messages, log_changed):
+        """Applies a batch of updates as a single range insert.
+
+        Args:
+            messages: (sender, message) pairs that aren't in the local chat log
+            log_changed: Whether records were appended to the chat log
+
+        Returns:
+            The number of messages applied.
+        """
+        if messages and self._path and not self._following:
+            # The user is reading older history; jump back to the live end first
+            self._reload_tail()
+
+        rows = []
+        if log_changed and self._path and self._following:
+            while True:
+                end, records = read_records_after(self._path, self._tail, self.page_size)
+                if not records:
+                    break
+                self._tail = end
+                rows.extend((offset, *decode_record(record)) for offset, record in records)
+                # Rows that would be trimmed straight away are never inserted
+                del rows[:-self.window_size]
+        if self._following or not self._path:
+            rows.extend((self._tail, sender, message) for sender, message in messages)
+
+        applied = len(rows)
+        del rows[:-self.window_size]
+        self._insert_rows(len(self._rows), rows)
+        self._trim_front()
+        return applied
+
+    @Slot()
+    def fetchOlder(self):
+        """Pages in the records just before the first row."""
+        if not self._path or self._head == 0:
+            return
+        start, records = read_records_before(self._path, self._head, self.page_size)
+        if not records:
+            self._head = 0
+            return
+        self._head = start
+        self._insert_rows(0, [(offset, *decode_record(record)) for offset, record in records])
+
+        # Keep the window bounded by dropping rows off the bottom
+        excess = len(self._rows) - self.window_size
+        if excess > 0:
+            first = len(self._rows) - excess
+            self._tail = self._rows[first][0]
+            self.beginRemoveRows(QModelIndex(), first, len(self._rows) - 1)
+            del self._rows[first:]
+            self.endRemoveRows()
+            self._following = False
+
+    @Slot()
+    def fetchNewer(self):
+        """Pages in the records just after the last row when scrolled back from the live end."""
+        if not self._path or self._following:
+            return
+        end, records = read_records_after(self._path, self._tail, self.page_size)
+        self._tail = end
+        if records:
+            self._insert_rows(len(self._rows), [(offset, *decode_record(record)) for offset, record in records])
+        if len(records) < self.page_size:
+            self._following = True
+        self._trim_front()
+
+    def _reload_tail(self):
+        self.open_log(self._path)
+
+    def _insert_rows(self, first, rows):
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self._rows[first:first] = rows
+        self.endInsertRows()
+
+    def _trim_front(self):
+        excess = len(self._rows) - self.window_size
+        if excess <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+        del self._rows[:excess]
+        self.endRemoveRows()
+        self._head = self._rows[0][0] if self._rows else self._tail
+
+class MessageBatcher(QObject):
+    """Collects chat updates from any thread and applies them to the chat model once per frame.
+
+    Network callbacks only queue work here; a single-shot timer on the GUI
+    thread drains the queue so a burst of messages costs one model insert and
+    one layout pass instead of one per message.
+    """
+
+    flushRequested = Signal()
+    messagesPerFrameChanged = Signal()
+
+    def __init__(self, model, interval_ms=16, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self._lock = threading.Lock()
+        self._pending = []
+        self._log_changed = False
+        self._scheduled = False
+        self._messages_per_frame = 0
+        self._peak_messages_per_frame = 0
+        self._frames = 0
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self._flush)
+        # Queued across threads, so the timer is always started on the GUI thread
+        self.flushRequested.connect(self._start_timer)
+
+    @Property(int, notify=messagesPerFrameChanged)
+    def messagesPerFrame(self):
+        """Number of messages applied by the most recent flush."""
+        return self._messages_per_frame
+
+    @Property(int, notify=messagesPerFrameChanged)
+    def peakMessagesPerFrame(self):
+        """Largest number of messages applied by a single flush."""
+        return self._peak_messages_per_frame
+
+    @Slot(str, str)
+    def add_message(self, sender, message):
+        """Queue a message that isn't in the local chat log. Safe to call from any thread."""
+        with self._lock:
+            self._pending.append((sender, message))
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            self.flushRequested.emit()
+
+    def mark_log_changed(self):
+        """Note that records were appended to the chat log. Safe to call from any thread."""
+        with self._lock:
+            self._log_changed = True
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            self.flushRequested.emit()
+
+    @Slot()
+    def _start_timer(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+    @Slot()
+    def _flush(self):
+        with self._lock:
+            messages, self._pending = self._pending, []
+            log_changed, self._log_changed = self._log_changed, False
+            self._scheduled = False
+
+        applied = self.model.apply_batch(messages, log_changed)
+        self._frames += 1
+        self._messages_per_frame = applied
+        self._peak_messages_per_frame = max(self._peak_messages_per_frame, applied)
+        self.messagesPerFrameChanged.emit()
+        logger.debug(f"Applied {applied} messages in frame {self._frames}")
 
 class ServiceListener:
     def __init__(self, model):
@@ -94,9 +373,18 @@ class DiscoveryModel(QObject):
         super().__init__(parent)
         self._services = []
         self.chat_bridge = chat_bridge
-        self.zeroconf = Zeroconf()
+        self.zeroconf = None
         self.listener = ServiceListener(self)
+        self.browser = None
+
+    def start(self):
+        """Start browsing for chat services. Called once the window is up."""
+        if self.browser:
+            return
+        from zeroconf import ServiceBrowser, Zeroconf
+        self.zeroconf = Zeroconf()
         self.browser = ServiceBrowser(self.zeroconf, "_pychat._tcp.local.", self.listener)
+        startup_timer.mark('discovery_started')
 
     @Property(list, notify=servicesChanged)
     def services(self):
@@ -115,6 +403,8 @@ class DiscoveryModel(QObject):
             'name': info.name,
             'chat_code': chat_code,
             'address': info.parsed_addresses()[0],
+            # Every advertised IPv4 and IPv6 address; connect_to_service races them
+            'addresses': info.parsed_scoped_addresses(),
             'port': info.port
         }
         self._services.append(service_data)
@@ -134,6 +424,7 @@ class DiscoveryModel(QObject):
                     'name': info.name,
                     'chat_code': chat_code,
                     'address': info.parsed_addresses()[0],
+                    'addresses': info.parsed_scoped_addresses(),
                     'port': info.port
                 }
                 self.servicesChanged.emit()
@@ -145,25 +436,22 @@ class DiscoveryModel(QObject):
         self._services = []
         self.servicesChanged.emit()
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('pychat.log')
-    ]
-)
 logger = logging.getLogger('pychat.qt')
 
-import requests
-import base64
+def setup_logging():
+    """Configure logging for the GUI. Called from main() rather than at import time."""
+    from behind.diagnostics import setup_logging as setup_queued_logging, install_dump_signal
+    listener = setup_queued_logging(level=logging.INFO)
+    install_dump_signal()
+    return listener
 
 class ChatBridge(QObject):
     """Bridge between QML and Python for chat functionality"""
     
     # Signal emitted when a new message is received
     messageReceived = Signal(str, str)  # sender, message
+    # Emitted from the dialing thread once a discovered peer's address is picked
+    peerResolved = Signal(str, int)  # address, port
     
     def __init__(self, username="User"):
         super().__init__()
@@ -172,56 +460,164 @@ class ChatBridge(QObject):
         self.username = username
         self.chat_code = "default"  # Default chat code
         self.peer_url = None
+        self.search_index = None
+        # Set when running as a thin client of the daemon (PYCHAT_DAEMON=1)
+        self.daemon = None
+        self.daemon_session = None
+        # Renews our callback lease with the peer; set to stop
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = None
+        # One HTTP session per traffic lane for requests to the peer; see _sessions()
+        self._http = None
+        self._http_lock = threading.Lock()
+
+        # Messages shown in the chat view
+        self.chat_model = ChatMessageModel()
+        self.batcher = MessageBatcher(self.chat_model)
+        self.messageReceived.connect(self.batcher.add_message)
+        self.peerResolved.connect(self.connect_to_peer)
         
         # Initialize directories
         initialize_directories()
         
     def start_networking(self):
         """Initialize and start the network manager"""
+        if os.environ.get("PYCHAT_DAEMON") == "1":
+            return self._start_daemon_session()
         try:
+            from behind.network import NetworkManager
             self.network_manager = NetworkManager(
                 name=self.username,
                 chat_code=self.chat_code,
                 on_message=self._handle_incoming_message
             )
             self.network_manager.start()
+            self.chat_model.open_log(self.network_manager.chat_filename)
+            self._open_search_index()
             logger.info(f"Started network manager as {self.username}")
             return True
         except Exception as e:
             logger.error(f"Failed to start network manager: {e}", exc_info=True)
             return False
     
+    def _start_daemon_session(self):
+        """Hosts the chat in the background daemon instead of in this process"""
+        try:
+            from behind.daemon import DaemonClient
+            self.daemon = DaemonClient()
+            # The GUI sends plaintext, so the daemon session does too
+            reply = self.daemon.request('open', chat_code=self.chat_code, name=self.username, encrypt=False)
+            self.daemon_session = reply['session']
+            self.chat_model.open_log(self.daemon_session['log_path'])
+            threading.Thread(target=self._follow_daemon, args=(self.chat_code,), daemon=True).start()
+            logger.info(f"Attached to daemon session {self.chat_code} as {self.username}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to attach to the daemon: {e}", exc_info=True)
+            self.daemon = None
+            return False
+
+    def _follow_daemon(self, chat_code):
+        from behind.daemon import DaemonClient
+        try:
+            for event in DaemonClient().subscribe(chat_code):
+                if self.is_stopping:
+                    break
+                if event.get('event') == 'message' and not event.get('own'):
+                    # Appended to the session's log by the daemon's server
+                    self.batcher.mark_log_changed()
+        except Exception as e:
+            if not self.is_stopping:
+                logger.error(f"Lost the daemon event stream: {e}")
+
+    @property
+    def server_port(self):
+        """Port of the server hosting this chat (ours or the daemon's)"""
+        if self.daemon_session:
+            return self.daemon_session['port']
+        return self.network_manager.port
+
+    def _open_search_index(self):
+        """Opens the chat's search index and indexes whatever the log gained since the last run."""
+        from behind.config import CHATS_DIR, KEYS_DIR
+        from behind.search import SearchIndex, load_or_create_key
+        try:
+            self.search_index = SearchIndex(
+                os.path.join(CHATS_DIR, f"{self.chat_code}.index"),
+                load_or_create_key(os.path.join(KEYS_DIR, f"{self.chat_code}_index.key")),
+            )
+            added = self.search_index.catch_up(self.network_manager.chat_filename, self._record_text)
+            logger.info(f"Search index has {len(self.search_index)} messages ({added} new)")
+        except Exception as e:
+            logger.error(f"Failed to open search index: {e}")
+            self.search_index = None
+
+    @staticmethod
+    def _record_text(record):
+        try:
+            return record.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+
+    def _index_record(self, record):
+        if self.search_index is None:
+            return
+        try:
+            text = self._record_text(record)
+            if text:
+                self.search_index.add(record, text)
+        except Exception as e:
+            logger.error(f"Error updating search index: {e}")
+
+    @Slot(str, result='QVariantList')
+    def search(self, query):
+        """Returns the newest messages matching `query` as a list of {sender, message, offset} maps"""
+        if self.daemon:
+            found = self.daemon.request('search', chat_code=self.chat_code, query=query)['results']
+        elif self.search_index is not None:
+            found = self.search_index.search(query)
+        else:
+            return []
+        results = []
+        for result in found:
+            sender, message = parse_chat_line(result['text'])
+            results.append({'sender': sender, 'message': message,
+                            'offset': -1 if result['offset'] is None else result['offset']})
+        return results
+
     def stop_networking(self):
         """Stop the network manager"""
         if self.is_stopping:
             return
         self.is_stopping = True
+        self._heartbeat_stop.set()
+        if self.daemon:
+            # The session keeps running in the daemon; only detach from it
+            self.daemon.close()
+            logger.info("Detached from daemon")
         if self.network_manager:
             try:
                 self.network_manager.stop()
                 logger.info("Stopped network manager")
             except Exception as e:
                 logger.error(f"Error stopping network manager: {e}")
+        if self._http:
+            self._http.close()
     
+    def _sessions(self):
+        """The per-lane sessions to the peer, made on first use (requests is only imported after the first frame)."""
+        with self._http_lock:
+            if self._http is None:
+                from behind.lanes import LaneSessions
+                self._http = LaneSessions()
+            return self._http
+
     def _handle_incoming_message(self, encrypted_message_bytes):
         """Handle an incoming message from the network"""
-        try:
-            # In a real app, you would decrypt the message here
-            message_text = encrypted_message_bytes.decode('utf-8')
-            
-            # Simple parsing: "SenderName: The message"
-            parts = message_text.split(':', 1)
-            if len(parts) == 2:
-                sender = parts[0].strip()
-                message = parts[1].strip()
-                # Don't display our own messages that are broadcast back to us
-                if sender != self.username:
-                    self.messageReceived.emit(sender, message)
-            else:
-                # Handle messages without a clear sender
-                self.messageReceived.emit("Unknown", message_text)
-        except Exception as e:
-            logger.error(f"Error handling incoming message: {e}")
+        # The network manager has already appended the record to the chat log,
+        # so the chat model reads it from there on the next frame
+        self.batcher.mark_log_changed()
+        self._index_record(encrypted_message_bytes)
     
     @Slot(str)
     def send_message(self, message):
@@ -229,21 +625,32 @@ class ChatBridge(QObject):
         if not message.strip() or not self.peer_url:
             return
             
+        if self.daemon:
+            try:
+                self.daemon.request('send', chat_code=self.chat_code, text=message)
+                self.messageReceived.emit(self.username, message)
+            except Exception as e:
+                logger.error(f"Error sending message: {e}")
+            return
+
         try:
+            import base64
             full_message = f"{self.username}: {message}"
             # In a real app, you would encrypt the message here
             # For now, we send it in plain text for simplicity
             encrypted_message = full_message.encode('utf-8')
             
-            requests.post(
+            self._sessions().interactive.post(
                 f"{self.peer_url}/message",
                 json={'message': base64.b64encode(encrypted_message).decode('utf-8')},
                 timeout=2
             )
             # Also display our own message in the UI
             self.messageReceived.emit(self.username, message)
+            self._index_record(encrypted_message)
             
         except Exception as e:
+            self._check_reachable(e)
             logger.error(f"Error sending message: {e}")
     
     @Slot(str)
@@ -260,24 +667,71 @@ class ChatBridge(QObject):
             self.chat_code = chat_code.strip()
             logger.info(f"Chat code set to: {self.chat_code}")
 
+    @Slot(str, list, int)
+    def connect_to_service(self, name, addresses, port):
+        """Connect to a discovered peer through whichever of its addresses answers first."""
+        from behind.dialer import dialer
+
+        # The race can take a whole connect timeout, so it runs off the GUI thread
+        def resolve():
+            address = dialer.resolve(name, addresses, port) or addresses[0]
+            self.peerResolved.emit(address, port)
+
+        threading.Thread(target=resolve, name="pychat-dial", daemon=True).start()
+
     @Slot(str, int)
     def connect_to_peer(self, address, port):
         """Initiate a connection with a peer."""
-        self.peer_url = f"http://{address}:{port}"
+        from behind.dialer import peer_url
+        self.peer_url = peer_url(address, port)
         logger.info(f"Connecting to peer at {self.peer_url}")
+        if self.daemon:
+            try:
+                self.daemon.request('set_peer', chat_code=self.chat_code, peer_url=self.peer_url)
+            except Exception as e:
+                logger.error(f"Failed to set the daemon session's peer: {e}")
         
         # Register this client with the peer's server for callbacks
+        threading.Thread(target=self._register_with_peer, name="pychat-register", daemon=True).start()
+        if self._heartbeat_thread is None:
+            self._heartbeat_thread = threading.Thread(target=self._renew_lease, name="pychat-lease", daemon=True)
+            self._heartbeat_thread.start()
+
+    def _register_with_peer(self):
+        from behind.state import DEFAULT_LEASE
+        my_callback_url = f"http://{get_local_ip()}:{self.server_port}"
         try:
-            my_callback_url = f"http://{get_local_ip()}:{self.network_manager.port}"
-            requests.post(
+            # The lease lets the peer stop pushing to us once we're gone, instead of timing out on every message
+            self._sessions().control.post(
                 f"{self.peer_url}/connect",
-                json={'url': my_callback_url},
+                json={'url': my_callback_url, 'lease': DEFAULT_LEASE},
                 timeout=2
             )
             logger.info(f"Registered with peer for callbacks at {my_callback_url}")
         except Exception as e:
+            self._check_reachable(e)
             logger.error(f"Failed to register with peer: {e}")
 
+    def _check_reachable(self, error):
+        """Drops the cached route to the peer if `error` means its address didn't answer."""
+        import requests
+        from behind.dialer import dialer
+        if self.peer_url and isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            dialer.unreachable(self.peer_url)
+
+    def _renew_lease(self):
+        """Heartbeats to the current peer about three times per lease, re-registering if it forgot us."""
+        from behind.state import DEFAULT_LEASE
+        while not self._heartbeat_stop.wait(DEFAULT_LEASE / 3):
+            my_callback_url = f"http://{get_local_ip()}:{self.server_port}"
+            try:
+                response = self._sessions().control.post(f"{self.peer_url}/heartbeat", json={'url': my_callback_url}, timeout=2)
+                if response.status_code == 404:
+                    self._register_with_peer()
+            except Exception as e:
+                self._check_reachable(e)
+                logger.debug(f"Heartbeat to {self.peer_url} failed: {e}")
+
     @Slot()
     def start_chat(self):
         """Start the networking after the user has set their name and chat code."""
@@ -290,6 +744,9 @@ class ChatBridge(QObject):
 
 def main():
     """Main entry point for the Qt application"""
+    log_listener = setup_logging()
+    startup_timer.mark('imports_done')
+
     # Create the application
     app = QApplication(sys.argv)
     app.setQuitOnLastWindowClosed(False)
@@ -317,6 +774,8 @@ def main():
     
     # Expose objects to QML
     engine.rootContext().setContextProperty("chatBridge", chat_bridge)
+    engine.rootContext().setContextProperty("chatMessageModel", chat_bridge.chat_model)
+    engine.rootContext().setContextProperty("messageBatcher", chat_bridge.batcher)
     engine.rootContext().setContextProperty("nameModel", name_model)
     engine.rootContext().setContextProperty("chatCodeModel", chat_code_model)
     engine.rootContext().setContextProperty("discoveryModel", discovery_model)
@@ -327,10 +786,38 @@ def main():
     if not engine.rootObjects():
         logger.error("Failed to load QML file")
         return -1
+    startup_timer.mark('qml_loaded')
+
+    # Network and crypto setup waits until the first frame has been presented
+    report_path = os.environ.get("PYCHAT_STARTUP_REPORT")
+
+    first_frame_seen = False
+
+    def on_warmed_up():
+        # Runs on the warm-up thread
+        startup_timer.mark('warmup_done')
+        if report_path:
+            startup_timer.write_report(report_path)
+            if os.environ.get("PYCHAT_STARTUP_EXIT") == "1":
+                QMetaObject.invokeMethod(app, "quit", Qt.QueuedConnection)
+
+    def on_first_frame():
+        nonlocal first_frame_seen
+        if first_frame_seen:
+            return
+        first_frame_seen = True
+        startup_timer.mark('first_frame')
+        discovery_model.start()
+        warm_up(on_done=on_warmed_up)
+
+    # frameSwapped comes from the render thread; queue it onto the GUI thread
+    window = engine.rootObjects()[0]
+    window.frameSwapped.connect(on_first_frame, Qt.QueuedConnection)
     
     # Set up cleanup on exit
     def cleanup():
         chat_bridge.stop_networking()
+        log_listener.stop()
     
     # Connect cleanup to application aboutToQuit signal
     app.aboutToQuit.connect(cleanup)